@@ -35,6 +35,8 @@ GEO2D = "2d"
 """Index specifier for a 2-dimensional `geospatial index`"""
 
 from errors import (Error, InterfaceError, AuthenticationError, DatabaseError, RSConnectionError,
-                    DataError, IntegrityError, ProgrammingError, NotSupportedError)
+                    DataError, IntegrityError, ProgrammingError, NotSupportedError, NotMasterError)
 
 from client import Client
+from sharding import ShardedClient
+from topology import PRIMARY, PRIMARY_PREFERRED, SECONDARY, SECONDARY_PREFERRED, NEAREST
@@ -28,7 +28,7 @@ from bson import SON
 
 import message
 import helpers
-from errors import AuthenticationError, RSConnectionError, InterfaceError
+from errors import AuthenticationError, RSConnectionError
 
 
 class AsyncMessage(object):
@@ -37,10 +37,12 @@ class AsyncMessage(object):
         self.connection = connection
         self.message = message
         self.callback = callback
+        # set when the connection went back to the pool before this safe=False message was sent
+        self.released = False
 
     def process(self, *args, **kwargs):
         try:
-            self.connection._send_message(self.message, self.callback)
+            self.connection._send_message(self.message, self.callback, cache=not self.released)
         except Exception, e:
             if self.callback is None:
                 logging.error("Error occurred in safe update mode: %s", e)
@@ -67,6 +69,39 @@ class AsyncJob(object):
         return "%s at 0x%X, state = %r" % (self.__class__.__name__, id(self), self._state)
 
 
+class ConnectJob(AsyncJob):
+    def __init__(self, connection, err_callback):
+        super(ConnectJob, self).__init__(connection, "start", err_callback)
+
+    def process(self, response=None, error=None):
+        if error:
+            logging.debug("Problem connecting: %s", error)
+            self._error(error)
+            return
+
+        if self._state == "start":
+            self._state = "connect"
+            logging.debug("Connecting to %s:%s", self.connection._host, self.connection._port)
+            self.connection._socket_connect(self.process)
+        elif self._state == "connect":
+            self._state = "done"
+            self.connection._next_job()
+        else:
+            self._error(ValueError("Unexpected state: %s" % self._state))
+
+
+class WarmUpJob(AsyncJob):
+    """queued behind the connection jobs, tells `callback` they are all done"""
+    def __init__(self, connection, callback):
+        super(WarmUpJob, self).__init__(connection, "start", callback)
+        self._callback = callback
+
+    def process(self, response=None, error=None):
+        self._state = "done"
+        self.connection._next_job()
+        self._callback(None)
+
+
 class AuthorizeJob(AsyncJob):
     def __init__(self, connection, dbuser, dbpass, pool, err_callback):
         super(AuthorizeJob, self).__init__(connection, "start", err_callback)
@@ -146,7 +181,10 @@ class ConnectRSJob(AsyncJob):
         if error:
             logging.debug("Problem connecting: %s", error)
 
-            if self._state == "ismaster":
+            if self._state == "connect":
+                logging.error("Failed to connect to the host: %s", error)
+
+            if self._state in ("connect", "ismaster"):
                 self._state = "seed"
 
         if self._state == "seed":
@@ -157,33 +195,26 @@ class ConnectRSJob(AsyncJob):
             fresh = self.known_hosts ^ self._blacklisted
             logging.debug("Working through the rest of the host list: %r", fresh)
 
-            while fresh:
-                if self._primary and self._primary not in self._blacklisted:
-                    # Try primary first
-                    h = self._primary
-                else:
-                    h = random.choice(list(fresh))
-
-                if h in fresh:
-                    fresh.remove(h)
-
-                # Add tried host to blacklisted
-                self._blacklisted.add(h)
-
-                logging.debug("Connecting to %s:%s", *h)
-                self.connection._host, self.connection._port = h
-                try:
-                    self.connection._socket_connect()
-                    logging.debug("Connected to %s", h)
-                except InterfaceError, e:
-                    logging.error("Failed to connect to the host: %s", e)
-                else:
-                    break
-
-            else:
+            if not fresh:
                 self._error(RSConnectionError("No more hosts to try, tried: %s" % self.known_hosts))
                 return
 
+            if self._primary and self._primary not in self._blacklisted:
+                # Try primary first
+                h = self._primary
+            else:
+                h = random.choice(list(fresh))
+
+            # Add tried host to blacklisted
+            self._blacklisted.add(h)
+
+            logging.debug("Connecting to %s:%s", *h)
+            self.connection._host, self.connection._port = h
+            self._state = "connect"
+            self.connection._socket_connect(self.process)
+
+        elif self._state == "connect":
+            logging.debug("Connected to %s:%s", self.connection._host, self.connection._port)
             self._state = "ismaster"
             msg = message.query(
                 options=0,
@@ -211,7 +242,9 @@ class ConnectRSJob(AsyncJob):
 
             hosts = res.get("hosts")
             if hosts:
-                self.known_hosts.update(helpers._parse_host(h) for h in hosts)
+                hosts = set(helpers._parse_host(h) for h in hosts)
+                self.connection._prefetch_hosts(hosts - self.known_hosts)
+                self.known_hosts.update(hosts)
 
             ismaster = res.get("ismaster")
             hidden = res.get("hidden")
@@ -0,0 +1,143 @@
+#!/bin/env python
+#
+# Copyright 2014 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+import logging
+from collections import deque
+from functools import partial
+
+
+class Autoscaler(object):
+    """
+    Sizing policy for a `pool.ConnectionPool`. Every `interval` seconds it looks at how
+    many requests had to wait for a connection, how long they waited and how many
+    connections were in use at the peak, and moves `maxconnections` within
+    [`min_connections`, `max_connections`]. A change is only made once the same decision
+    came up `hysteresis` evaluations in a row, so the pool doesn't flap on short bursts.
+
+    Pass an instance as `autoscale` to the pool; one instance sizes one pool.
+
+    :Parameters:
+      - `min_connections`: lowest `maxconnections` to shrink to
+      - `max_connections`: highest `maxconnections` to grow to
+      - `interval` (optional): seconds between evaluations
+      - `grow_step` (optional): connections added per decision
+      - `shrink_step` (optional): connections removed per decision
+      - `high_water` (optional): fraction of `maxconnections` in use at the peak to grow at
+      - `low_water` (optional): fraction of `maxconnections` in use at the peak to shrink at
+      - `max_wait` (optional): average seconds waited for a connection to grow at
+      - `hysteresis` (optional): consecutive evaluations a decision needs before it is made
+    """
+    def __init__(self, min_connections, max_connections, interval=5, grow_step=2, shrink_step=1,
+                 high_water=0.9, low_water=0.5, max_wait=0.005, hysteresis=3):
+        assert isinstance(min_connections, int) and min_connections > 0
+        assert isinstance(max_connections, int) and max_connections >= min_connections
+        assert isinstance(interval, (int, float)) and interval > 0
+        assert isinstance(grow_step, int) and grow_step > 0
+        assert isinstance(shrink_step, int) and shrink_step > 0
+        assert 0 <= low_water < high_water <= 1
+        assert isinstance(max_wait, (int, float))
+        assert isinstance(hysteresis, int) and hysteresis > 0
+        self._min = min_connections
+        self._max = max_connections
+        self._interval = interval
+        self._grow_step = grow_step
+        self._shrink_step = shrink_step
+        self._high_water = high_water
+        self._low_water = low_water
+        self._max_wait = max_wait
+        self._hysteresis = hysteresis
+        self._pool = None
+        self._last = None # pool stats at the previous evaluation
+        self._votes = (None, 0) # (decision, consecutive evaluations it came up)
+        self._grows = 0
+        self._shrinks = 0
+        self.decisions = deque(maxlen=20) # (time, decision, old size, new size, reason)
+
+    def start(self, pool):
+        """size `pool` from now on, the pool schedules the evaluations once it is used"""
+        assert self._pool is None, "an Autoscaler sizes a single pool"
+        self._pool = pool
+        size = min(max(pool._maxconnections or self._min, self._min), self._max)
+        pool._resize(size)
+        self._last = pool.stats()
+
+    def _schedule(self, generation):
+        self._pool._backend.add_timeout(self._interval, partial(self._tick, generation),
+                                        io_loop=self._pool._kwargs.get('io_loop'))
+
+    def _tick(self, generation):
+        if generation != self._pool._generation:
+            # scheduled before the process forked
+            return
+        try:
+            self.evaluate()
+        except Exception:
+            logging.exception('Failed to evaluate pool size')
+        self._schedule(generation)
+
+    def evaluate(self):
+        """look at the pool's activity since the last evaluation and resize it if needed"""
+        pool = self._pool
+        stats = pool.stats()
+        peak = pool._take_peak()
+        size = pool._maxconnections
+        waits = stats['waits'] - self._last['waits']
+        waited = stats['wait_time_total'] - self._last['wait_time_total']
+        timeouts = stats['wait_timeouts'] - self._last['wait_timeouts']
+        self._last = stats
+
+        decision, reason = None, None
+        if timeouts or stats['waiting']:
+            decision, reason = 'grow', '%d waiting, %d timed out' % (stats['waiting'], timeouts)
+        elif waits and waited / waits > self._max_wait:
+            decision, reason = 'grow', 'waited %.4fs on average' % (waited / waits)
+        elif peak >= size * self._high_water:
+            decision, reason = 'grow', '%d of %d connections in use' % (peak, size)
+        elif not waits and peak <= size * self._low_water:
+            decision, reason = 'shrink', '%d of %d connections in use' % (peak, size)
+
+        if decision == 'grow' and size >= self._max or decision == 'shrink' and size <= self._min:
+            decision = None
+        if decision is None:
+            self._votes = (None, 0)
+            return None
+        votes = decision == self._votes[0] and self._votes[1] + 1 or 1
+        if votes < self._hysteresis:
+            self._votes = (decision, votes)
+            return None
+        self._votes = (None, 0)
+
+        if decision == 'grow':
+            new_size = min(size + self._grow_step, self._max)
+            self._grows += 1
+        else:
+            new_size = max(size - self._shrink_step, self._min)
+            self._shrinks += 1
+        logging.info('%s connection pool from %d to %d connections: %s' % (decision, size, new_size, reason))
+        self.decisions.append((time.time(), decision, size, new_size, reason))
+        pool._resize(new_size)
+        return decision
+
+    def stats(self):
+        """current bounds and the decisions made so far"""
+        return dict(maxconnections=self._pool and self._pool._maxconnections,
+                    min_connections=self._min,
+                    max_connections=self._max,
+                    grows=self._grows,
+                    shrinks=self._shrinks,
+                    pending=self._votes,
+                    decisions=list(self.decisions))
@@ -0,0 +1,7 @@
+import sys
+
+def load_backend(name):
+    """get the `AsyncBackend` instance of the backend module called `name`"""
+    __import__('asyncmongo.backends.%s_backend' % name)
+    mod = sys.modules['asyncmongo.backends.%s_backend' % name]
+    return mod.AsyncBackend()
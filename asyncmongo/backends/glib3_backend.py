@@ -14,14 +14,64 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import errno
+import os
+import socket
+
 from gi.repository import GObject
 
+from asyncmongo.resolver import Resolver
+
 class Glib3Stream(object):
     def __init__(self, socket, **kwargs):
         self.__socket = socket
         self.__close_id = None
         self.__read_id = None
         self.__read_queue = []
+        self.__connect_callback = None
+        self.__connect_id = None
+        self.__timeout_id = None
+
+    def connect(self, address, callback, timeout=None):
+        """connect the socket without blocking the main loop; `callback` is called
+        with None once connected, or with a `socket.error`"""
+        self.__connect_callback = callback
+        self.__socket.setblocking(0)
+        err = self.__socket.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            GObject.idle_add(self.__finish_connect, socket.error(err, os.strerror(err)))
+            return
+        self.__connect_id = GObject.io_add_watch(self.__socket,
+                                                 GObject.IO_OUT|GObject.IO_HUP|GObject.IO_ERR,
+                                                 self.__on_connect)
+        if timeout:
+            self.__timeout_id = GObject.timeout_add(int(timeout * 1000), self.__on_connect_timeout)
+
+    def __on_connect(self, source, condition):
+        self.__connect_id = None
+        err = self.__socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        self.__finish_connect(err and socket.error(err, os.strerror(err)) or None)
+        return False
+
+    def __on_connect_timeout(self):
+        self.__timeout_id = None
+        self.__finish_connect(socket.timeout("timed out connecting"))
+        return False
+
+    def __finish_connect(self, error):
+        if self.__connect_id:
+            GObject.source_remove(self.__connect_id)
+            self.__connect_id = None
+        if self.__timeout_id:
+            GObject.source_remove(self.__timeout_id)
+            self.__timeout_id = None
+        # reads and writes below expect a blocking socket
+        self.__socket.setblocking(1)
+        callback = self.__connect_callback
+        self.__connect_callback = None
+        if callback:
+            callback(error)
+        return False
 
     def write(self, data):
         self.__socket.send(data)
@@ -75,6 +125,8 @@ class Glib3Stream(object):
 
 class AsyncBackend(object):
     _instance = None
+    # host name resolver shared by all connections, replace it to plug in another one
+    resolver = None
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
             cls._instance = super(AsyncBackend, cls).__new__(
@@ -83,3 +135,36 @@ class AsyncBackend(object):
 
     def register_stream(self, socket, **kwargs):
         return Glib3Stream(socket, **kwargs)
+
+    def loop_kwargs(self):
+        """keyword arguments that bind streams and timers to the calling thread's loop"""
+        return {}
+
+    def add_callback(self, callback, **kwargs):
+        """run `callback` from the main loop; safe to call from any thread"""
+        def run_once():
+            callback()
+            return False
+        GObject.idle_add(run_once)
+
+    def add_timeout(self, delay, callback, **kwargs):
+        """run `callback` in `delay` seconds; returns a handle for `remove_timeout`"""
+        def run_once():
+            callback()
+            return False
+        return GObject.timeout_add(int(delay * 1000), run_once)
+
+    def remove_timeout(self, timeout, **kwargs):
+        """cancel a timeout returned by `add_timeout`"""
+        GObject.source_remove(timeout)
+
+    def resolve(self, host, port, callback, **kwargs):
+        """resolve `host`:`port` without blocking; see `resolver.Resolver.resolve`"""
+        if self.resolver is None:
+            AsyncBackend.resolver = Resolver(self)
+        self.resolver.resolve(host, port, callback, **kwargs)
+
+    def invalidate(self, host, port):
+        """forget the cached address of `host`:`port`; see `resolver.Resolver.invalidate`"""
+        if self.resolver is not None:
+            self.resolver.invalidate(host, port)
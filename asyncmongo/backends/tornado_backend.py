@@ -14,7 +14,14 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import socket
+import threading
+import time
+
 import tornado.iostream
+import tornado.ioloop
+
+from asyncmongo.resolver import Resolver
 
 class TornadoStream(object):
     def __init__(self, socket, **kwargs):
@@ -27,6 +34,47 @@ class TornadoStream(object):
             - `read_chunk_size` (optional):
         """
         self.__stream = tornado.iostream.IOStream(socket, **kwargs)
+        self.__close_callback = None
+        self.__connect_callback = None
+        self.__connect_timeout = None
+
+    def connect(self, address, callback, timeout=None):
+        """connect the socket without blocking the IOLoop
+
+        :Parameters:
+          - `address`: (host, port) to connect to
+          - `callback`: called with None once connected, or with a `socket.error`
+          - `timeout` (optional): seconds to wait for the connection
+        """
+        self.__connect_callback = callback
+        # a failed connect closes the stream
+        self.__stream.set_close_callback(self.__on_connect_close)
+        if timeout:
+            self.__connect_timeout = self.__stream.io_loop.add_timeout(
+                time.time() + timeout, self.__on_connect_timeout)
+        self.__stream.connect(address, callback=self.__on_connect)
+
+    def __on_connect(self):
+        self.__finish_connect(None)
+
+    def __on_connect_close(self):
+        self.__finish_connect(self.__stream.error or socket.error("connection closed"))
+
+    def __on_connect_timeout(self):
+        self.__connect_timeout = None
+        self.__stream.set_close_callback(None)
+        self.__stream.close()
+        self.__finish_connect(socket.timeout("timed out connecting"))
+
+    def __finish_connect(self, error):
+        if self.__connect_timeout:
+            self.__stream.io_loop.remove_timeout(self.__connect_timeout)
+            self.__connect_timeout = None
+        callback = self.__connect_callback
+        self.__connect_callback = None
+        self.__stream.set_close_callback(self.__close_callback)
+        if callback:
+            callback(error)
 
     def write(self, data):
         self.__stream.write(data)
@@ -35,7 +83,9 @@ class TornadoStream(object):
         self.__stream.read_bytes(size, callback=callback)
 
     def set_close_callback(self, callback):
-        self.__stream.set_close_callback(callback)
+        self.__close_callback = callback
+        if not self.__connect_callback:
+            self.__stream.set_close_callback(callback)
 
     def close(self):
         self.__stream._close_callback = None
@@ -43,6 +93,8 @@ class TornadoStream(object):
 
 class AsyncBackend(object):
     _instance = None
+    # host name resolver shared by all connections, replace it to plug in another one
+    resolver = None
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
             cls._instance = super(AsyncBackend, cls).__new__(
@@ -59,3 +111,50 @@ class AsyncBackend(object):
             - `read_chunk_size` (optional):
         """
         return TornadoStream(socket, **kwargs)
+
+    def loop_kwargs(self):
+        """keyword arguments that bind streams and timers to the calling thread's IOLoop,
+        None if the thread's IOLoop can't be told"""
+        current = getattr(tornado.ioloop.IOLoop, 'current', None)
+        if current is not None:
+            return {'io_loop': current()}
+        # before tornado 3 only the global instance is known, it runs on the main thread
+        if isinstance(threading.current_thread(), threading._MainThread):
+            return {}
+        return None
+
+    def add_callback(self, callback, **kwargs):
+        """run `callback` on the next IOLoop iteration; safe to call from any thread
+
+        :Parameters:
+          - `**kwargs`:
+            - `io_loop` (optional): Tornado IOLoop instance.
+        """
+        io_loop = kwargs.get('io_loop') or tornado.ioloop.IOLoop.instance()
+        io_loop.add_callback(callback)
+
+    def add_timeout(self, delay, callback, **kwargs):
+        """run `callback` in `delay` seconds; returns a handle for `remove_timeout`
+
+        :Parameters:
+          - `**kwargs`:
+            - `io_loop` (optional): Tornado IOLoop instance.
+        """
+        io_loop = kwargs.get('io_loop') or tornado.ioloop.IOLoop.instance()
+        return io_loop.add_timeout(time.time() + delay, callback)
+
+    def remove_timeout(self, timeout, **kwargs):
+        """cancel a timeout returned by `add_timeout`"""
+        io_loop = kwargs.get('io_loop') or tornado.ioloop.IOLoop.instance()
+        io_loop.remove_timeout(timeout)
+
+    def resolve(self, host, port, callback, **kwargs):
+        """resolve `host`:`port` without blocking; see `resolver.Resolver.resolve`"""
+        if self.resolver is None:
+            AsyncBackend.resolver = Resolver(self)
+        self.resolver.resolve(host, port, callback, **kwargs)
+
+    def invalidate(self, host, port):
+        """forget the cached address of `host`:`port`; see `resolver.Resolver.invalidate`"""
+        if self.resolver is not None:
+            self.resolver.invalidate(host, port)
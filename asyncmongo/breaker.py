@@ -0,0 +1,102 @@
+#!/bin/env python
+#
+# Copyright 2014 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+import random
+import logging
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for the connects to one host, shared by all connections of a pool.
+
+    After `threshold` connects in a row failed the breaker opens: connects fail right
+    away instead of waiting on the host. Once the backoff passed a single connect goes
+    through as a probe (half-open); if it succeeds the breaker closes, if it fails the
+    breaker opens again for twice as long, up to `max_backoff`. Every backoff is
+    jittered, so processes that saw the host go down don't all probe it at once.
+
+    :Parameters:
+      - `host`, `port`: the host, for messages
+      - `threshold` (optional): connects in a row that have to fail to open the breaker
+      - `backoff` (optional): seconds the breaker stays open the first time
+      - `max_backoff` (optional): longest seconds the breaker stays open
+    """
+    def __init__(self, host, port, threshold=1, backoff=0.5, max_backoff=30):
+        assert isinstance(threshold, int) and threshold > 0
+        assert isinstance(backoff, (int, float)) and backoff > 0
+        assert isinstance(max_backoff, (int, float)) and max_backoff >= backoff
+        self.host = host
+        self.port = port
+        self._threshold = threshold
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self.state = CLOSED
+        self.failures = 0 # connects in a row that failed
+        self.opened = 0 # times opened since the last successful connect
+        self.retry_at = 0
+        self._probe_started = None
+        self.rejected = 0
+
+    def allow(self):
+        """True if a connect may go ahead, False to fail it right away"""
+        if self.state == CLOSED:
+            return True
+        now = time.time()
+        if self.state == HALF_OPEN and self._probe_started + self._max_backoff > now:
+            # a probe is on its way
+            self.rejected += 1
+            return False
+        if self.state == OPEN and self.retry_at > now:
+            self.rejected += 1
+            return False
+        # the backoff passed, or the probe never came back
+        self.state = HALF_OPEN
+        self._probe_started = now
+        return True
+
+    def succeeded(self):
+        """a connect went through"""
+        if self.state != CLOSED:
+            logging.info("%s:%s is reachable again, closing circuit breaker", self.host, self.port)
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+
+    def failed(self):
+        """a connect failed"""
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self._threshold:
+            backoff = min(self._backoff * 2 ** self.opened, self._max_backoff)
+            # anywhere in the upper half, so the probes of many processes spread out
+            backoff = random.uniform(backoff / 2.0, backoff)
+            self.opened += 1
+            self.state = OPEN
+            self.retry_at = time.time() + backoff
+            logging.warning("%s:%s failed %d times, circuit breaker open for %.2f seconds",
+                            self.host, self.port, self.failures, backoff)
+
+    def retry_in(self):
+        """seconds until the next probe may go out"""
+        return max(self.retry_at - time.time(), 0)
+
+    def describe(self):
+        return dict(host=self.host, port=self.port, state=self.state, failures=self.failures,
+                    retry_in=self.state == OPEN and self.retry_in() or 0, rejected=self.rejected)
@@ -14,7 +14,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-from errors import DataError
+from errors import DataError, ProgrammingError
 from pool import ConnectionPools
 from cursor import Cursor
 from bson.son import SON
@@ -33,6 +33,18 @@ class Client(object):
           - `maxcached` (optional): maximum inactive cached connections for this pool. 0 for unlimited
           - `maxconnections` (optional): maximum open connections for this pool. 0 for unlimited
           - `maxusage` (optional): number of requests allowed on a connection before it is closed. 0 for unlimited
+          - `max_in_flight` (optional): maximum requests pipelined on a single connection. 1 dedicates a connection to each request, 0 for unlimited
+          - `wait_queue_timeout` (optional): seconds to wait for a connection once maxconnections is reached. 0 to raise TooManyConnections right away, None to wait forever
+          - `wait_queue_size` (optional): maximum requests waiting for a connection. 0 for unlimited
+          - `max_idle_time` (optional): seconds after which an idle connection is closed, mincached connections are kept open. 0 to keep idle connections open
+          - `warmup` (optional): connect, authenticate and discover the replica set for the mincached connections in the background
+          - `ready_callback` (optional): called with None once the warm up finished, or with the first error
+          - `autoscale` (optional): an `autoscale.Autoscaler` that sizes maxconnections to the load
+          - `threadsafe` (optional): False to skip locking when the pool is only used from the IOLoop's thread
+          - `partitioned` (optional): keep a separate pool for each thread (and its IOLoop), maxconnections applies to all of them together. With tornado before 3, threads other than the main one call `bind_io_loop` before their first request
+          - `breaker_threshold` (optional): failed connects in a row after which connects to the host fail right away for a jittered, growing backoff. 0 to always connect
+          - `breaker_backoff` (optional): seconds connects fail right away the first time
+          - `breaker_max_backoff` (optional): longest seconds connects fail right away
           - `dbname`: mongo database name
           - `backend': async loop backend, default = tornado
       - `**kwargs`: passed to `connection.Connection`
@@ -40,6 +52,22 @@ class Client(object):
           - `port`: port to connect to
           - `slave_okay` (optional): is it okay to connect directly to and perform queries on a slave instance
           - `autoreconnect` (optional): auto reconnect on interface errors
+          - `rs` (optional): replica set name, with `seed`: list of (host, port) to discover it from
+          - `heartbeat_interval` (optional): with `rs`, seconds between the ismaster heartbeats of the
+            pool's topology monitor. Connections then go straight to the right member instead of
+            discovering the replica set on their own
+          - `read_preference` (optional): with `heartbeat_interval`, where queries go: primary, primaryPreferred, secondary, secondaryPreferred or nearest. Writes always go to the primary
+          - `tag_sets` (optional): list of tag dicts secondaries have to match to take queries
+          - `local_threshold` (optional): seconds of round trip time, queries are spread over the eligible members at most this much slower than the fastest one
+          - `max_staleness` (optional): seconds a secondary may lag behind the primary and still take queries
+          - `standby` (optional): with `heartbeat_interval`, connections to keep connected and authenticated to every primary and secondary, ready for failover
+          - `topology_cache` (optional): with `heartbeat_interval`, file the member table is saved to, new processes start from it instead of the seed list
+          - `topology_cache_ttl` (optional): seconds a saved member table is used for
+          - `mongos` (optional): list of (host, port) of mongos routers to spread the requests over, instead of `host` and `port`
+          - `balance` (optional): with `mongos`, send each request to the router with the `least_outstanding` requests or the lowest `latency`
+          - `ping_interval` (optional): with `mongos`, seconds between the pings that measure the routers' latency and take ejected routers back
+          - `eject_time` (optional): with `mongos`, seconds a router a request failed on gets no requests
+          - `connect_timeout` (optional): seconds to wait for a new connection to be established
     
     @returns a `Client` instance that wraps a `pool.ConnectionPool`
     
@@ -51,6 +79,16 @@ class Client(object):
     def __init__(self, pool_id=None, **kwargs):
         self._pool = ConnectionPools.get_connection_pool(pool_id, **kwargs)
     
+    def bind_io_loop(self, io_loop):
+        """Send the requests of the calling thread on `io_loop`, for `partitioned` pools.
+
+        :Parameters:
+          - `io_loop`: the IOLoop running on the calling thread
+        """
+        if not hasattr(self._pool, 'bind_io_loop'):
+            raise ProgrammingError("only partitioned pools keep an IOLoop per thread")
+        self._pool.bind_io_loop(io_loop)
+
     def __getattr__(self, name):
         """Get a collection by name.
 
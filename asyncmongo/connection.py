@@ -14,7 +14,6 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import sys
 import socket
 import struct
 import logging
@@ -22,6 +21,7 @@ from types import NoneType
 import functools
 
 from errors import ProgrammingError, IntegrityError, InterfaceError
+from backends import load_backend
 import helpers
 import asyncjobs
 
@@ -38,6 +38,10 @@ class Connection(object):
       - `seed`: seed list to connect to a replica set (required when replica sets are used)
       - `secondary_only`: (optional, only useful for replica set connections)
          if true, connect to a secondary member only
+      - `connect_timeout` (optional): seconds to wait for the socket to connect, None to
+         leave it to the operating system
+      - `pipelined` (optional): if true, several requests may be outstanding on this
+         connection at once; replies are matched to their callbacks by `responseTo`
       - `**kwargs`: passed to `backends.AsyncBackend.register_stream`
 
     """
@@ -52,6 +56,8 @@ class Connection(object):
                  rs=None,
                  seed=None,
                  secondary_only=False,
+                 connect_timeout=None,
+                 pipelined=False,
                  **kwargs):
         assert isinstance(autoreconnect, bool)
         assert isinstance(dbuser, (str, unicode, NoneType))
@@ -59,6 +65,8 @@ class Connection(object):
         assert isinstance(rs, (str, NoneType))
         assert pool
         assert isinstance(secondary_only, bool)
+        assert isinstance(connect_timeout, (int, float, NoneType))
+        assert isinstance(pipelined, bool)
         
         if rs:
             assert host is None
@@ -77,25 +85,34 @@ class Connection(object):
         self.__dbuser = dbuser
         self.__dbpass = dbpass
         self.__stream = None
+        self.__connect_timeout = connect_timeout
         self.__callback = None
+        self.__pipelined = pipelined
+        # request_id -> callback for requests outstanding on a pipelined connection
+        self.__callbacks = {}
+        self.__reading = False
+        # ids of exhaust queries waiting for more replies, the server streams them one after
+        # another, each in response to the previous reply
+        self.__exhausting = set()
+        # id of the reply being read
+        self.__reply_id = None
+        # connection job (connect, auth, replica set discovery) waiting for a response
+        self.__current_job = None
         self.__alive = False
         self.__autoreconnect = autoreconnect
         self.__pool = pool
         self.__kwargs = kwargs
-        self.__backend = self.__load_backend(backend)
+        self.__backend = load_backend(backend)
         self.__job_queue = []
         self.usage_count = 0
+        # when this connection was put into the pool's idle cache, None while it is out of it
+        self.idle_since = None
 
         self.__connect(self.connection_error)
 
     def connection_error(self, error):
         raise error
 
-    def __load_backend(self, name):
-        __import__('asyncmongo.backends.%s_backend' % name)
-        mod = sys.modules['asyncmongo.backends.%s_backend' % name]
-        return mod.AsyncBackend()
-    
     def __connect(self, err_callback):
         # The callback is only called in case of exception by async jobs
         if self.__dbuser and self.__dbpass:
@@ -103,29 +120,98 @@ class Connection(object):
 
         if self.__rs:
             self._put_job(asyncjobs.ConnectRSJob(self, self.__seed, self.__rs, self.__secondary_only, err_callback))
-            # Mark the connection as alive, even though it's not alive yet to prevent double-connecting
-            self.__alive = True
         else:
-            self._socket_connect()
+            self._put_job(asyncjobs.ConnectJob(self, err_callback))
+        # Mark the connection as alive, even though it's not alive yet to prevent double-connecting
+        self.__alive = True
 
-    def _socket_connect(self):
-        """create a socket, connect, register a stream with the async backend"""
+    def _socket_connect(self, callback):
+        """create a socket, register a stream with the async backend and connect it
+        without blocking; `callback(None, error)` is called once the connect finished"""
         self.usage_count = 0
+        if self.__stream:
+            # replica set discovery moves on to another host
+            self.__stream.close()
+            self.__stream = None
+        breaker = self.__breaker()
+        if breaker and not breaker.allow():
+            # the host is down, don't make every request wait for it
+            error = InterfaceError('%s:%s is unreachable, circuit breaker open for %.2f more seconds' %
+                                   (self._host, self._port, breaker.retry_in()))
+            self.__backend.add_callback(functools.partial(callback, None, error), **self.__kwargs)
+            return
+        self.__backend.resolve(self._host, self._port,
+                               functools.partial(self._on_resolve, callback), **self.__kwargs)
+
+    def __breaker(self):
+        """the circuit breaker the pool keeps for the host this connection connects to, if any;
+        monitor connections have none"""
+        breaker = getattr(self.__pool, 'breaker', None)
+        return breaker and breaker(self._host, self._port)
+
+    def _on_resolve(self, callback, address, error):
+        if error:
+            self.__connect_failed()
+            callback(None, InterfaceError(error))
+            return
+        family, sockaddr = address
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-            s.connect((self._host, self._port))
+            s = socket.socket(family, socket.SOCK_STREAM, 0)
             self.__stream = self.__backend.register_stream(s, **self.__kwargs)
-            self.__stream.set_close_callback(self._socket_close)
-            self.__alive = True
+            self.__stream.connect(sockaddr,
+                                  functools.partial(self._on_socket_connect, callback),
+                                  timeout=self.__connect_timeout)
         except socket.error, error:
-            raise InterfaceError(error)
+            self.__connect_failed()
+            callback(None, InterfaceError(error))
+
+    def __connect_failed(self):
+        breaker = self.__breaker()
+        if breaker:
+            breaker.failed()
+        # the host may have moved (ie: DNS based failover), look it up again on the next connect
+        self.__backend.invalidate(self._host, self._port)
+
+    def _prefetch_hosts(self, hosts):
+        """warm the resolver cache for hosts found during replica set discovery"""
+        for host, port in hosts:
+            self.__backend.resolve(host, port, None, **self.__kwargs)
+
+    def _on_socket_connect(self, callback, error):
+        if error:
+            self.__stream.close()
+            self.__connect_failed()
+            callback(None, InterfaceError(error))
+            return
+        breaker = self.__breaker()
+        if breaker:
+            breaker.succeeded()
+        self.__stream.set_close_callback(self._socket_close)
+        callback(None, None)
     
+    @property
+    def in_flight(self):
+        """number of requests sent or queued on this connection that still wait for a response"""
+        queued = [job for job in self.__job_queue
+                  if isinstance(job, asyncjobs.AsyncMessage) and job.callback]
+        return len(self.__callbacks) + len(queued) + (self.__callback is not None)
+
+    def _pending_callbacks(self):
+        """detach and return the callbacks of all requests waiting for a response"""
+        callbacks = self.__callbacks.values()
+        if self.__callback:
+            callbacks.append(self.__callback)
+        self.__callback = None
+        self.__callbacks = {}
+        self.__reading = False
+        self.__exhausting = set()
+        return callbacks
+
     def _socket_close(self):
         """cleanup after the socket is closed by the other end"""
-        callback = self.__callback
-        self.__callback = None
+        callbacks = self._pending_callbacks()
         try:
-            if callback:
+            for callback in callbacks:
                 callback(None, InterfaceError('connection closed'))
         finally:
             # Flush the job queue, don't call the callbacks associated with the remaining jobs
@@ -136,17 +222,27 @@ class Connection(object):
     
     def _close(self):
         """close the socket and cleanup"""
-        callback = self.__callback
-        self.__callback = None
+        callbacks = self._pending_callbacks()
         try:
-            if callback:
+            for callback in callbacks:
                 callback(None, InterfaceError('connection closed'))
         finally:
             # Flush the job queue, don't call the callbacks associated with the remaining jobs
             # since they have already been called as error callback on connection closing
             self.__job_queue = []
+            # a failed connect or auth job must not keep the next request from starting over
+            self.__current_job = None
             self.__alive = False
-            self.__stream.close()
+            if self.__stream:
+                self.__stream.close()
+
+    def _fail_queued(self, queue, error):
+        """error callback for connection jobs on a pipelined connection: every message
+        queued behind the failed job gets `error`"""
+        # the queue is popped from the end, so walk it backwards to keep the send order
+        for job in reversed(queue):
+            if isinstance(job, asyncjobs.AsyncMessage) and job.callback:
+                job.callback(None, error)
 
     def close(self):
         """close this connection; re-cache this connection object"""
@@ -155,19 +251,27 @@ class Connection(object):
         finally:
             self.__pool.cache(self)
 
+    def release(self):
+        """give this connection back to its pool without sending anything on it"""
+        self.__pool.cache(self)
+
     def send_message(self, message, callback):
         """ send a message over the wire; callback=None indicates a safe=False call where we write and forget about it"""
         
-        if self.__callback is not None:
+        if self.__callback is not None and not (self.__pipelined or self.__current_job):
             raise ProgrammingError('connection already in use')
 
-        if callback:
+        if self.__pipelined:
+            # _close() replaces the job queue, so this still refers to the messages
+            # that were waiting when a connection job fails
+            err_callback = functools.partial(self._fail_queued, self.__job_queue)
+        elif callback:
             err_callback = functools.partial(callback, None)
         else:
             err_callback = None
 
         # Go and update err_callback for async jobs in queue if any
-        for job in self.__job_queue:
+        for job in self.__job_queue + [self.__current_job]:
             # this is a dirty hack and I hate it, but there is no way of setting the correct
             # err_callback during the connection time
             if isinstance(job, asyncjobs.AsyncJob):
@@ -180,50 +284,114 @@ class Connection(object):
                 raise InterfaceError('connection invalid. autoreconnect=False')
         
         # Put the current message on the bottom of the queue
-        self._put_job(asyncjobs.AsyncMessage(self, message, callback), 0)
-        self._next_job()
+        job = asyncjobs.AsyncMessage(self, message, callback)
+        self._put_job(job, 0)
+        if not self.__current_job:
+            # otherwise the running connection job sends it once it is done
+            self._next_job()
+        if callback is None and job in self.__job_queue:
+            # nothing waits for a reply to a safe=False message, so the connection can go back
+            # to the pool while the message sits behind connect/auth jobs
+            job.released = True
+            self.__pool.cache(self)
         
+    def warm_up(self, callback):
+        """connect, authenticate and discover the replica set now instead of on first use
+
+        :Parameters:
+          - `callback`: called with None once the connection is ready, or with the error
+            that made it fail
+        """
+        for job in self.__job_queue + [self.__current_job]:
+            if isinstance(job, asyncjobs.AsyncJob):
+                job.update_err_callback(callback)
+
+        if not self.__alive:
+            self.__connect(callback)
+
+        self._put_job(asyncjobs.WarmUpJob(self, callback), 0)
+        if not self.__current_job:
+            self._next_job()
+
     def _put_job(self, job, pos=None):
         if pos is None:
             pos = len(self.__job_queue)
         self.__job_queue.insert(pos, job)
 
     def _next_job(self):
-        """execute the next job from the top of the queue"""
-        if self.__job_queue:
+        """execute jobs from the top of the queue until one of them waits for a response"""
+        while self.__job_queue:
             # Produce message from the top of the queue
             job = self.__job_queue.pop()
             # logging.debug("queue = %s, popped %r", self.__job_queue, job)
+            self.__current_job = isinstance(job, asyncjobs.AsyncJob) and job or None
             job.process()
+            # a pipelined connection doesn't have to wait for the reply to send the next message
+            if not isinstance(job, asyncjobs.AsyncMessage) or (job.callback and not self.__pipelined):
+                break
+        else:
+            self.__current_job = None
     
-    def _send_message(self, message, callback):
+    def _send_message(self, message, callback, cache=True):
         # logging.debug("_send_message, msg = %r: queue = %r, self.__callback = %r, callback = %r", 
         #               message, self.__job_queue, self.__callback, callback)
 
+        if self.__pipelined:
+            self._send_pipelined(message, callback)
+            return
+
         self.__callback = callback
         self.usage_count +=1
         # __request_id used by get_more()
         (self.__request_id, data) = message
+        if _is_exhaust(data):
+            self.__exhausting = set([self.__request_id])
         try:
             self.__stream.write(data)
             if self.__callback:
                 self.__stream.read(16, callback=self._parse_header)
             else:
                 self.__request_id = None
-                self.__pool.cache(self)
+                if cache:
+                    self.__pool.cache(self)
         
         except IOError:
             self.__alive = False
             raise
         # return self.__request_id 
+
+    def _send_pipelined(self, message, callback):
+        self.usage_count += 1
+        (request_id, data) = message
+        try:
+            self.__stream.write(data)
+            if callback:
+                self.__callbacks[request_id] = callback
+                if _is_exhaust(data):
+                    self.__exhausting.add(request_id)
+                if not self.__reading:
+                    self.__reading = True
+                    self.__stream.read(16, callback=self._parse_header)
+            else:
+                self.__pool.cache(self)
+        except IOError:
+            self.__alive = False
+            raise
     
     def _parse_header(self, header):
         # return self.__receive_data_on_socket(length - 16, sock)
         length = int(struct.unpack("<i", header[:4])[0])
+        self.__reply_id = struct.unpack("<i", header[4:8])[0]
         request_id = struct.unpack("<i", header[8:12])[0]
-        assert request_id == self.__request_id, \
-            "ids don't match %r %r" % (self.__request_id,
-                                       request_id)
+        if self.__pipelined:
+            # replies can come back in any order, responseTo tells whose reply this is
+            assert request_id in self.__callbacks, \
+                "unexpected response to %r" % request_id
+            self.__request_id = request_id
+        else:
+            assert request_id == self.__request_id, \
+                "ids don't match %r %r" % (self.__request_id,
+                                           request_id)
         operation = 1 # who knows why
         assert operation == struct.unpack("<i", header[12:])[0]
         try:
@@ -233,15 +401,45 @@ class Connection(object):
             raise
     
     def _parse_response(self, response):
-        callback = self.__callback
         request_id = self.__request_id
         self.__request_id = None
-        self.__callback = None
-        if not self.__job_queue:
-            # skip adding to the cache because there is something else
-            # that needs to be called on this connection for this request
-            # (ie: we authenticated, but still have to send the real req)
-            self.__pool.cache(self)
+        # an exhaust query with an open cursor gets another reply, in response to this one
+        more = request_id in self.__exhausting and struct.unpack("<q", response[4:12])[0] != 0
+        self.__exhausting.discard(request_id)
+        if more:
+            self.__exhausting.add(self.__reply_id)
+        if self.__pipelined:
+            callback = self.__callbacks.pop(request_id)
+            if more:
+                self.__callbacks[self.__reply_id] = callback
+            try:
+                if self.__callbacks:
+                    self.__stream.read(16, callback=self._parse_header)
+                else:
+                    self.__reading = False
+            except IOError:
+                self.__alive = False
+                raise
+            if not self.__current_job:
+                # the pool keeps the connection checked out while other requests are in flight
+                self.__pool.cache(self)
+        elif more:
+            # keep the connection until the last reply arrived
+            callback = self.__callback
+            self.__request_id = self.__reply_id
+            try:
+                self.__stream.read(16, callback=self._parse_header)
+            except IOError:
+                self.__alive = False
+                raise
+        else:
+            callback = self.__callback
+            self.__callback = None
+            if not self.__job_queue:
+                # skip adding to the cache because there is something else
+                # that needs to be called on this connection for this request
+                # (ie: we authenticated, but still have to send the real req)
+                self.__pool.cache(self)
 
         try:
             response = helpers._unpack_response(response, request_id) # TODO: pass tz_awar
@@ -254,3 +452,10 @@ class Connection(object):
             callback(response, IntegrityError(response['data'][0]['err'], code=response['data'][0]['code']))
             return
         callback(response)
+
+
+def _is_exhaust(data):
+    """True if `data` is a query with the exhaust flag, the server answers it with all batches"""
+    op_code, flags = struct.unpack("<ii", data[12:20])
+    return op_code == 2004 and bool(flags & 64)
+
@@ -15,18 +15,38 @@
 # under the License.
 
 import logging
+import threading
+import weakref
+from collections import deque
 
 from bson.son import SON
 
 import helpers
 import message
 import functools
+from errors import InterfaceError, RSConnectionError, IntegrityError, NotMasterError, ProgrammingError
 
 _QUERY_OPTIONS = {
     "tailable_cursor": 2,
     "slave_okay": 4,
     "oplog_replay": 8,
-    "no_timeout": 16}
+    "no_timeout": 16,
+    "await_data": 32,
+    "exhaust": 64}
+
+# error codes of writes and commands sent to a member that is no longer the primary
+_NOT_MASTER_CODES = (10054, 10058, 10107, 13435, 13436)
+
+# commands that only read, so they can be sent again when the member that got them failed
+_READ_COMMANDS = frozenset(["buildinfo", "collstats", "count", "dbstats", "distinct", "geonear",
+                            "geosearch", "group", "ismaster", "listcollections", "listindexes",
+                            "ping", "serverstatus"])
+
+# pool, or partition of a partitioned pool -> _CursorReaper of that pool
+_reapers = weakref.WeakKeyDictionary()
+
+# pool, or partition of a partitioned pool -> {query: callbacks waiting for its reply} of the coalesced queries in flight
+_coalesced = weakref.WeakKeyDictionary()
 
 class Cursor(object):
     """ Cursor is a class used to call oeprations on a given db/collection using a specific connection pool.
@@ -41,6 +61,7 @@ class Cursor(object):
         self.__collection = collection
         self.__pool = pool
         self.__slave_okay = False
+        self.__read_preference = None
     
     @property
     def full_collection_name(self):
@@ -114,14 +135,9 @@ class Cursor(object):
         if callback:
             callback = functools.partial(self._handle_response, orig_callback=callback)
 
-        connection = self.__pool.connection()
-        try:
-            connection.send_message(
-                message.insert(self.full_collection_name, docs,
-                    check_keys, safe, kwargs), callback=callback)
-        except:
-            connection.close()
-            raise
+        self.__send_message(
+            message.insert(self.full_collection_name, docs,
+                check_keys, safe, kwargs), callback=callback)
     
     def remove(self, spec_or_id=None, safe=True, callback=None, **kwargs):
         if not isinstance(safe, bool):
@@ -144,14 +160,9 @@ class Cursor(object):
         if callback:
             callback = functools.partial(self._handle_response, orig_callback=callback)
 
-        connection = self.__pool.connection()
-        try:
-            connection.send_message(
-                message.delete(self.full_collection_name, spec_or_id, safe, kwargs),
-                    callback=callback)
-        except:
-            connection.close()
-            raise
+        self.__send_message(
+            message.delete(self.full_collection_name, spec_or_id, safe, kwargs),
+                callback=callback)
 
     
     def update(self, spec, document, upsert=False, manipulate=False,
@@ -243,14 +254,9 @@ class Cursor(object):
             callback = functools.partial(self._handle_response, orig_callback=callback)
 
         self.__limit = None
-        connection = self.__pool.connection()
-        try:
-            connection.send_message(
-                message.update(self.full_collection_name, upsert, multi,
-                    spec, document, safe, kwargs), callback=callback)
-        except:
-            connection.close()
-            raise
+        self.__send_message(
+            message.update(self.full_collection_name, upsert, multi,
+                spec, document, safe, kwargs), callback=callback)
 
     
     def find_one(self, spec_or_id, **kwargs):
@@ -270,7 +276,9 @@ class Cursor(object):
                  timeout=True, snapshot=False, tailable=False, sort=None,
                  max_scan=None, slave_okay=False,
                  _must_use_master=False, _is_command=False, hint=None, debug=False,
-                 comment=None, callback=None):
+                 comment=None, read_preference=None, tag_sets=None, hedge_delay=None, batch_size=0,
+                 await_data=False, oplog_replay=False, exhaust=False, coalesce=False, callback=None,
+                 _stream=None):
         """Query the database.
         
         The `spec` argument is a prototype document that all results
@@ -318,6 +326,24 @@ class Cursor(object):
             continue from the last document received. For details, see
             the `tailable cursor documentation
             <http://www.mongodb.org/display/DOCS/Tailable+Cursors>`_.
+            See :meth:`tail` to keep reading from a tailable cursor
+          - `await_data` (optional): with `tailable`, the server waits a
+            while for new data before it answers a getMore with no
+            documents
+          - `oplog_replay` (optional): with `tailable`, a query on the
+            oplog with a `ts` condition starts near that time instead
+            of scanning the whole oplog
+          - `exhaust` (optional): the server sends all batches right
+            away instead of waiting for a getMore for each one, the
+            connection stays with this query until the last one
+            arrived. For reading large results quickly; batches that
+            arrive faster than they are processed are held in memory.
+            Not for replica sets without `heartbeat_interval`
+          - `coalesce` (optional): if the same query (collection,
+            spec, fields, sort, skip, limit and read preference) is
+            already in flight with `coalesce`, wait for its reply
+            instead of sending another one. Every caller gets the same
+            documents (or error), so they must not be modified
           - `sort` (optional): a list of (key, direction) pairs
             specifying the sort order for this query. See
             :meth:`~pymongo.cursor.Cursor.sort` for details.
@@ -325,6 +351,20 @@ class Cursor(object):
             examined when performing the query
           - `slave_okay` (optional): is it okay to connect directly
             to and perform queries on a slave instance
+          - `read_preference` (optional): which replica set member to
+            query, one of `topology.READ_PREFERENCES`. Defaults to the
+            pool's `read_preference`, ignored without a topology monitor
+          - `tag_sets` (optional): list of tag dicts a secondary has
+            to match to be queried
+          - `hedge_delay` (optional): seconds to wait for the first
+            member's reply before the query is also sent to another
+            member the read preference allows; the first reply is
+            used. None to send the query once
+          - `batch_size` (optional): documents the server returns per
+            reply, the rest are fetched with getMore until `limit` or
+            all results are retrieved. 0 for the server's default.
+            Replica sets without `heartbeat_interval` only get the
+            first reply, their getMores could reach another member
         
         .. mongodoc:: find
         """
@@ -347,6 +387,25 @@ class Cursor(object):
             raise TypeError("snapshot must be an instance of bool")
         if not isinstance(tailable, bool):
             raise TypeError("tailable must be an instance of bool")
+        if not isinstance(hedge_delay, (int, float, None.__class__)):
+            raise TypeError("hedge_delay must be an instance of int or float")
+        if not isinstance(batch_size, int) or batch_size < 0:
+            raise TypeError("batch_size must be a positive int")
+        if not isinstance(await_data, bool):
+            raise TypeError("await_data must be an instance of bool")
+        if not isinstance(oplog_replay, bool):
+            raise TypeError("oplog_replay must be an instance of bool")
+        if not isinstance(exhaust, bool):
+            raise TypeError("exhaust must be an instance of bool")
+        if exhaust and (tailable or hedge_delay is not None):
+            raise TypeError("exhaust can not be used with tailable or hedge_delay")
+        if exhaust and not self.__pool._routes_cursors:
+            # the replies are read by a stream, which these pools can't follow a cursor with
+            raise ProgrammingError("exhaust can not be used with replica sets without heartbeat_interval")
+        if not isinstance(coalesce, bool):
+            raise TypeError("coalesce must be an instance of bool")
+        if coalesce and (tailable or _stream is not None):
+            raise TypeError("coalesce can not be used with tailable or streams")
         if not callable(callback):
             raise TypeError("callback must be callable")
         
@@ -360,10 +419,13 @@ class Cursor(object):
         self.__fields = fields
         self.__skip = skip
         self.__limit = limit
-        self.__batch_size = 0
+        self.__batch_size = batch_size
         
         self.__timeout = timeout
         self.__tailable = tailable
+        self.__await_data = await_data
+        self.__oplog_replay = oplog_replay
+        self.__exhaust = exhaust
         self.__snapshot = snapshot
         self.__ordering = sort and helpers._index_document(sort) or None
         self.__max_scan = max_scan
@@ -376,36 +438,281 @@ class Cursor(object):
         self.__tz_aware = False #collection.database.connection.tz_aware
         self.__must_use_master = _must_use_master
         self.__is_command = _is_command
+        if _must_use_master:
+            self.__read_preference = None
+        else:
+            self.__read_preference = read_preference or self.__pool._read_preference
         
-        connection = self.__pool.connection()
+        if self.__debug:
+            logging.debug('QUERY_SPEC: %r' % self.__query_spec())
+
+        msg = message.query(self.__query_options(),
+                            self.full_collection_name,
+                            self.__skip, 
+                            self.__num_to_return(),
+                            self.__query_spec(),
+                            self.__fields)
+        route = dict(read_preference=self.__read_preference, tag_sets=tag_sets)
+        if coalesce:
+            # the message without its request id: namespace, options, skip, spec and fields. It
+            # only has the size of the first batch, the limit is applied while following the cursor
+            key = (msg[1][16:], limit, batch_size, self.__read_preference, repr(tag_sets))
+            in_flight = _coalesced.setdefault(self.__local_pool(), {})
+            if key in in_flight:
+                in_flight[key].append(callback)
+                return
+            in_flight[key] = [callback]
+            callback = functools.partial(_coalesced_response, in_flight, key)
+        stream = _stream
+        if stream is None and not (limit and limit < 0) and not _is_command and not tailable and \
+                self.__pool._routes_cursors:
+            # all results, not just those that fit into the first reply
+            stream = CursorStream(self.__send_message, self._kill_cursor, self.full_collection_name, limit, batch_size,
+                                  prefetch=False, exhaust=exhaust)
+            stream.to_list(callback)
+        retry = None
+        if not _is_command or spec and spec.keys()[0].lower() in _READ_COMMANDS:
+            retry = functools.partial(self.__retry, msg, route, stream)
+        handle = functools.partial(self._handle_response, orig_callback=callback, retry=retry, stream=stream)
         try:
-            if self.__debug:
-                logging.debug('QUERY_SPEC: %r' % self.__query_spec())
-
-            connection.send_message(
-                message.query(self.__query_options(),
-                              self.full_collection_name,
-                              self.__skip, 
-                              self.__limit,
-                              self.__query_spec(),
-                              self.__fields), 
-                callback=functools.partial(self._handle_response, orig_callback=callback))
+            if hedge_delay is not None:
+                self.__send_hedged(msg, handle, hedge_delay, route)
+                return
+            self.__send_message(msg, callback=handle, **route)
         except Exception, e:
             logging.debug('Error sending query %s' % e)
+            if coalesce:
+                in_flight.pop(key, None)
+            raise
+    
+    def stream(self, spec=None, batch_size=100, prefetch=True, poll_interval=None, **kwargs):
+        """Query the database and get the results one batch at a time.
+
+        Returns a `CursorStream` right away, its `next_batch` or `each_batch` hand out the
+        results as they arrive. Stop early with `CursorStream.close`, so the server can
+        free the cursor. Not for replica sets without `heartbeat_interval`, whose pools can't
+        send the getMores to the member that has the cursor.
+
+        :Parameters:
+          - `spec` (optional): the query, see :meth:`find`
+          - `batch_size` (optional): documents to fetch per round trip
+          - `prefetch` (optional): ask for the next batch as soon as one is handed out, so it
+            arrives while the current one is processed
+          - `poll_interval` (optional): seconds to wait before asking a tailable cursor again
+            after it had no new documents, None to ask right away (ie: with `await_data`)
+          - `**kwargs`: passed to :meth:`find`, except `callback`
+        """
+        if not self.__pool._routes_cursors:
+            raise ProgrammingError("the pool can't send getMores to the server of a cursor, "
+                                   "use heartbeat_interval with rs")
+        wait = None
+        if poll_interval is not None:
+            wait = functools.partial(self._add_timeout, poll_interval)
+        stream = CursorStream(self.__send_message, self._kill_cursor, self.full_collection_name, kwargs.get('limit') or 0,
+                              batch_size, prefetch, wait, kwargs.get('exhaust', False))
+        self.find(spec, batch_size=batch_size, callback=stream._on_error, _stream=stream, **kwargs)
+        return stream
+    
+    def tail(self, spec=None, callback=None, resume_field='_id', await_data=True, retry_delay=1,
+             batch_size=100, **kwargs):
+        """Read new documents from a capped collection (or the oplog) as they are inserted.
+
+        Keeps a tailable cursor open and calls `callback(documents, error)` with every batch
+        of new documents. When the cursor dies, the connection fails or the primary changes
+        the query is sent again after `retry_delay` seconds, for the documents after the last
+        one handed out by `resume_field`; errors go to `callback(None, error)` on the way.
+        Return False from `callback`, or call `close` on the returned `TailingCursor`, to stop.
+
+        The next batch is asked for once `callback` returned, so at most one batch is held
+        in memory however slow the consumer is.
+
+        :Parameters:
+          - `spec` (optional): the query, see :meth:`find`
+          - `callback`: called with each batch of documents
+          - `resume_field` (optional): a field that grows with every document inserted,
+            `_id` for ObjectIds or `ts` for the oplog
+          - `await_data` (optional): let the server wait for new documents instead of
+            polling every `retry_delay` seconds
+          - `retry_delay` (optional): seconds to wait before querying again
+          - `batch_size` (optional): documents to fetch per round trip
+          - `**kwargs`: passed to :meth:`find`, ie: `fields` or `oplog_replay`
+        """
+        if not callable(callback):
+            raise TypeError("callback must be callable")
+        if not isinstance(resume_field, (str, unicode)):
+            raise TypeError("resume_field must be an instance of str or unicode")
+        if not isinstance(retry_delay, (int, float)) or retry_delay <= 0:
+            raise TypeError("retry_delay must be a positive int or float")
+        tail = TailingCursor(self, spec, callback, resume_field, retry_delay,
+                             dict(kwargs, tailable=True, await_data=await_data, batch_size=batch_size,
+                                  poll_interval=not await_data and retry_delay or None, prefetch=False))
+        tail._start()
+        return tail
+    
+    def _kill_cursor(self, cursor_id, address):
+        """kill a cursor on the server at `address`; the cursors killed in one loop iteration go
+        out together, in a single killCursors message per server"""
+        pool = self.__local_pool()
+        reaper = _reapers.get(pool)
+        if reaper is None:
+            reaper = _reapers.setdefault(pool, _CursorReaper(pool))
+        reaper.kill(self.__send_message, cursor_id, address)
+    
+    def _add_timeout(self, delay, callback):
+        """run `callback` in `delay` seconds on the calling thread's loop"""
+        pool = self.__local_pool()
+        return pool._backend.add_timeout(delay, callback, io_loop=pool._kwargs.get('io_loop'))
+    
+    def __remove_timeout(self, timeout):
+        pool = self.__local_pool()
+        pool._backend.remove_timeout(timeout, io_loop=pool._kwargs.get('io_loop'))
+    
+    def __local_pool(self):
+        """the pool whose IOLoop runs on the calling thread, its own partition of a partitioned pool"""
+        partition = getattr(self.__pool, 'partition', None)
+        return partition and partition() or self.__pool
+    
+    def __send_hedged(self, msg, handle, delay, route):
+        """send a query, and after `delay` seconds without a reply the same query to another
+        member the read preference allows. The first reply goes to `handle`"""
+        hedge = dict(addresses=[], outstanding=1, done=False, timeout=None)
+        callback = functools.partial(self.__hedged_response, hedge, handle)
+        self.__send_message(msg, callback=callback, sent=hedge['addresses'].append, **route)
+        if not hedge['done']:
+            hedge['timeout'] = self._add_timeout(delay, functools.partial(self.__hedge, msg, callback, hedge, route))
+    
+    def __hedge(self, msg, callback, hedge, route):
+        hedge['timeout'] = None
+        if hedge['done'] or not hedge['addresses']:
+            # answered already, or still waiting for a connection: another request won't help
+            return
+        try:
+            connection = self.__pool.connection(exclude=hedge['addresses'], **route)
+        except Exception, e:
+            # no other member to go to, or no connection to spare
+            logging.debug('%s not hedging: %s' % (self.full_collection_name, e))
+            return
+        address = (connection._host, connection._port)
+        if connection._host is None or address in hedge['addresses']:
+            # a pool without a topology monitor only knows the one server
+            connection.release()
+            return
+        logging.debug('%s hedging to %s:%s' % (self.full_collection_name, address[0], address[1]))
+        hedge['outstanding'] += 1
+        hedge['addresses'].append(address)
+        try:
+            connection.send_message(msg, callback=self.__bind_address(callback, connection))
+        except Exception:
+            connection.close()
+            hedge['outstanding'] -= 1
+    
+    def __hedged_response(self, hedge, handle, result, error=None, address=None):
+        hedge['outstanding'] -= 1
+        if hedge['done']:
+            # the other member was faster, close the cursor this one opened
+            if result and result.get('cursor_id'):
+                self._kill_cursor(result['cursor_id'], address)
+            return
+        if error and hedge['outstanding']:
+            # the other member may still answer
+            logging.debug('%s %s:%s failed: %s' % (self.full_collection_name, address and address[0],
+                                                   address and address[1], error))
+            return
+        hedge['done'] = True
+        if hedge['timeout'] is not None:
+            self.__remove_timeout(hedge['timeout'])
+        handle(result, error, address=address)
+    
+    def __send_message(self, msg, callback, sent=None, **route):
+        """send `msg` on a pooled connection; when the pool is exhausted it is sent
+        once the pool's wait queue hands this request a connection
+
+        :Parameters:
+          - `sent` (optional): called with the (host, port) `msg` was sent to
+          - `**route`: passed to the pool's `connection`
+        """
+        connection = self.__pool.connection(
+            callback=functools.partial(self.__send_waiting, msg, callback, sent), **route)
+        if connection is None:
+            return
+        try:
+            connection.send_message(msg, callback=self.__bind_address(callback, connection))
+        except:
             connection.close()
             raise
+        if sent:
+            sent((connection._host, connection._port))
     
-    def _handle_response(self, result, error=None, orig_callback=None):
-        if result and result.get('cursor_id'):
-            connection = self.__pool.connection()
+    def __send_waiting(self, msg, callback, sent, connection, error):
+        if not error:
             try:
-                connection.send_message(
-                    message.kill_cursors([result['cursor_id']]),
-                    callback=None)
+                connection.send_message(msg, callback=self.__bind_address(callback, connection))
+                if sent:
+                    sent((connection._host, connection._port))
+                return
             except Exception, e:
-                logging.debug('Error killing cursor %s: %s' % (result['cursor_id'], e))
                 connection.close()
-                raise
+                error = e
+        if callback:
+            callback(None, error)
+        else:
+            logging.error('%s %s' % (self.full_collection_name, error))
+    
+    def __bind_address(self, callback, connection):
+        """tell the response handler which server answered, cursors only live on that one"""
+        if callback is None:
+            return None
+        return functools.partial(callback, address=(connection._host, connection._port))
+    
+    def __retry(self, msg, route, stream, orig_callback):
+        """send a query again after the member that got it failed, the pool picks a member
+        by the same read preference; a failure this time goes to `orig_callback`"""
+        try:
+            self.__send_message(msg,
+                callback=functools.partial(self._handle_response, orig_callback=orig_callback, stream=stream),
+                **route)
+        except Exception, e:
+            logging.debug('Error retrying query %s' % e)
+            self._handle_response(None, e, orig_callback=orig_callback, stream=stream)
+
+    def __member_failure(self, result, error):
+        """the error that tells the member which answered can't take requests right now, or None"""
+        if isinstance(error, RSConnectionError):
+            # no member was found to send the request to
+            return None
+        if isinstance(error, (NotMasterError, InterfaceError)):
+            return error
+        if isinstance(error, IntegrityError) and error.code in _NOT_MASTER_CODES:
+            return NotMasterError(error.msg)
+        if self.__collection == "$cmd" and not error and result and result["data"]:
+            # commands report failures in the reply document
+            reply = result['data'][0]
+            if not reply.get('ok') and (reply.get('code') in _NOT_MASTER_CODES or
+                                        reply.get('errmsg') == 'not master'):
+                return NotMasterError(reply.get('errmsg'))
+        return None
+
+    def _handle_response(self, result, error=None, orig_callback=None, address=None, retry=None,
+                         stream=None):
+        failure = address is not None and self.__member_failure(result, error)
+        if stream is not None and stream._address is not None:
+            # a later reply of an exhaust query, the query can't be sent again
+            retry = None
+        if failure and self.__pool.member_failed(address, failure) and retry:
+            logging.debug('%s retrying after %s:%s failed: %s' % (self.full_collection_name,
+                                                                  address[0], address[1], failure))
+            retry(orig_callback)
+            return
+
+        if stream is not None:
+            # the stream fetches the rest of the results and closes the cursor
+            if error:
+                logging.debug('%s %s' % (self.full_collection_name , error))
+            stream._on_reply(result, error, address)
+            return
+
+        if result and result.get('cursor_id'):
+            self._kill_cursor(result['cursor_id'], address)
         
         if error:
             logging.debug('%s %s' % (self.full_collection_name , error))
@@ -418,12 +725,24 @@ class Cursor(object):
                 orig_callback(result['data'], error=None)
 
     
+    def __num_to_return(self):
+        """documents the first reply should have"""
+        if self.__batch_size and (not self.__limit or self.__batch_size < self.__limit):
+            return self.__batch_size
+        return self.__limit
+
     def __query_options(self):
         """Get the query options string to use for this query."""
         options = 0
         if self.__tailable:
             options |= _QUERY_OPTIONS["tailable_cursor"]
-        if self.__slave_okay or self.__pool._slave_okay:
+            if self.__await_data:
+                options |= _QUERY_OPTIONS["await_data"]
+            if self.__oplog_replay:
+                options |= _QUERY_OPTIONS["oplog_replay"]
+        if self.__exhaust:
+            options |= _QUERY_OPTIONS["exhaust"]
+        if self.__slave_okay or self.__pool._slave_okay or self.__read_preference not in (None, "primary"):
             options |= _QUERY_OPTIONS["slave_okay"]
         if not self.__timeout:
             options |= _QUERY_OPTIONS["no_timeout"]
@@ -449,3 +768,266 @@ class Cursor(object):
         return spec
     
     
+
+
+class CursorStream(object):
+    """
+    Results of a query, fetched from the server one batch at a time with getMore on the
+    member the query went to.
+
+    Get them with `next_batch` (pull) or `each_batch` (push); `to_list` collects all of
+    them. Batches that arrive before they are asked for are kept, at most one ahead with
+    `prefetch`. Once all results are handed out the server has closed the cursor; a
+    consumer that stops early calls `close` so the cursor is killed.
+
+    :Parameters:
+      - `send`: sends a message on a pooled connection, `Cursor.__send_message`
+      - `kill`: kills a cursor on a server, `Cursor._kill_cursor`
+      - `collection_name`: full name of the collection queried
+      - `limit` (optional): most documents to hand out, 0 for all. Negative for at most
+        that many in a single batch, without getMores
+      - `batch_size` (optional): documents to ask for per getMore, 0 for the server's default
+      - `prefetch` (optional): ask for the next batch when one is handed out instead of
+        when the next one is asked for
+      - `wait` (optional): called with a function to run a while later, before a tailable
+        cursor that had no new documents is asked again. None to ask right away
+      - `exhaust` (optional): the query was sent with the exhaust flag, the server sends all
+        batches without getMores
+    """
+    def __init__(self, send, kill, collection_name, limit=0, batch_size=0, prefetch=True, wait=None,
+                 exhaust=False):
+        self._send = send
+        self._kill_cursor = kill
+        self._collection_name = collection_name
+        self._limit = abs(limit)
+        self._single_batch = limit < 0
+        self._batch_size = batch_size
+        self._prefetch = prefetch
+        self._wait = wait
+        self._exhaust = exhaust
+        self._address = None
+        self._cursor_id = None # None until the query was answered, 0 once the cursor is closed
+        self._received = 0
+        self._batches = deque()
+        self._error = None
+        self._fetching = True # the query itself
+        self._waiting = None # callback of `next_batch` waiting for a batch
+        self.closed = False
+
+    @property
+    def alive(self):
+        """True while there are batches left to hand out"""
+        return not self.closed and (bool(self._batches) or self._cursor_id is None or
+                                    bool(self._cursor_id) and self._error is None)
+
+    def next_batch(self, callback):
+        """call `callback(documents, error)` with the next batch, or with None once all of
+        them were handed out"""
+        assert self._waiting is None, "already waiting for a batch"
+        if self._batches:
+            batch = self._batches.popleft()
+            if self._prefetch:
+                self._fetch()
+            callback(batch, None)
+        elif self._error is not None or self.closed or self._cursor_id == 0:
+            callback(None, self._error)
+        else:
+            self._waiting = callback
+            self._fetch()
+
+    def each_batch(self, callback):
+        """call `callback(documents, error)` for every batch, and `callback(None, error)` at
+        the end. Return False from `callback` to stop early and close the cursor"""
+        self.next_batch(functools.partial(self._each, callback))
+
+    def _each(self, callback, batch, error):
+        if callback(batch, error) is False:
+            self.close()
+        elif batch is not None:
+            self.next_batch(functools.partial(self._each, callback))
+
+    def to_list(self, callback):
+        """call `callback(documents, error)` with all documents"""
+        self.each_batch(functools.partial(self._collect, [], callback))
+
+    def _collect(self, documents, callback, batch, error):
+        if batch is not None:
+            documents.extend(batch)
+        elif error:
+            callback(None, error=error)
+        else:
+            callback(documents, error=None)
+
+    def close(self):
+        """stop fetching and kill the cursor on the server"""
+        if self.closed:
+            return
+        self.closed = True
+        self._batches.clear()
+        if not self._fetching:
+            self._kill()
+
+    def _fetch(self):
+        """ask for the next batch, unless it is on its way or there is none"""
+        if self._fetching or self.closed or not self._cursor_id or self._error is not None:
+            return
+        num_to_return = self._batch_size
+        if self._limit:
+            num_to_return = min(num_to_return or self._limit, self._limit - self._received)
+        self._fetching = True
+        try:
+            self._send(message.get_more(self._collection_name, num_to_return, self._cursor_id),
+                       callback=self._on_reply, address=self._address)
+        except Exception, e:
+            self._on_reply(None, e)
+
+    def _on_reply(self, result, error=None, address=None):
+        self._fetching = False
+        if error:
+            self._error = error
+            self._cursor_id = 0
+        else:
+            if self._address is None:
+                self._address = address
+            self._cursor_id = result.get('cursor_id') or 0
+            # the server sends the rest of an exhaust query's batches by itself and
+            # finishes with the cursor, the connection is busy until then
+            self._fetching = self._exhaust and bool(self._cursor_id)
+            documents = result['data']
+            if self._limit:
+                documents = documents[:self._limit - self._received]
+            self._received += len(documents)
+            if (self._single_batch or self._limit and self._received >= self._limit) and not self._exhaust:
+                self._kill()
+            if self.closed:
+                if not self._exhaust:
+                    self._kill()
+            elif documents:
+                self._batches.append(documents)
+            elif self._cursor_id:
+                # an empty batch from an open cursor, ie: a tailable one, keep waiting
+                pass
+        if self._waiting is not None:
+            callback, self._waiting = self._waiting, None
+            if not self._batches and self.alive:
+                self._waiting = callback
+                if self._wait is not None and not error:
+                    self._wait(self._fetch)
+                else:
+                    self._fetch()
+                return
+            self.next_batch(callback)
+
+    def _on_error(self, response, error=None):
+        """callback of a query that failed before it was sent"""
+        self._on_reply(None, error)
+
+    def _kill(self):
+        cursor_id, self._cursor_id = self._cursor_id, 0
+        if cursor_id:
+            self._kill_cursor(cursor_id, self._address)
+
+
+def _coalesced_response(in_flight, key, response, error=None):
+    """hand the reply of a coalesced query to everyone waiting for it"""
+    for callback in in_flight.pop(key):
+        try:
+            callback(response, error=error)
+        except Exception:
+            logging.exception('Error in callback of a coalesced query')
+
+
+class _CursorReaper(object):
+    """
+    Cursors to kill on the servers of a pool. The ids queued in one loop iteration are sent
+    on the next one, in a single killCursors message per server, so a busy pool checks out a
+    connection once per iteration instead of once per abandoned cursor.
+    """
+    def __init__(self, pool):
+        self._pool = pool
+        self._pending = {} # address -> cursor ids
+        self._send = None
+        self._lock = threading.Lock()
+
+    def kill(self, send, cursor_id, address):
+        """queue `cursor_id` of the server at `address`, `send` sends a message on the pool"""
+        self._lock.acquire()
+        try:
+            flush = not self._pending
+            self._pending.setdefault(address, []).append(cursor_id)
+            self._send = send
+        finally:
+            self._lock.release()
+        if flush:
+            self._pool._backend.add_callback(self._flush, io_loop=self._pool._kwargs.get('io_loop'))
+
+    def _flush(self):
+        self._lock.acquire()
+        try:
+            pending, self._pending = self._pending, {}
+            send, self._send = self._send, None
+        finally:
+            self._lock.release()
+        for address, cursor_ids in pending.items():
+            try:
+                send(message.kill_cursors(cursor_ids), callback=None, address=address)
+            except Exception, e:
+                logging.debug('Error killing cursors %s: %s' % (cursor_ids, e))
+
+
+class TailingCursor(object):
+    """
+    A tailable query that is sent again after its cursor died, see `Cursor.tail`.
+
+    `last` is the `resume_field` value of the last document handed out.
+    """
+    def __init__(self, cursor, spec, callback, resume_field, retry_delay, kwargs):
+        self._cursor = cursor
+        self._spec = spec or {}
+        self._callback = callback
+        self._resume_field = resume_field
+        self._retry_delay = retry_delay
+        self._kwargs = kwargs
+        self._stream = None
+        self.last = None
+        self.closed = False
+
+    def close(self):
+        """stop tailing and kill the cursor"""
+        self.closed = True
+        if self._stream is not None:
+            self._stream.close()
+
+    def _start(self):
+        if self.closed:
+            return
+        spec = self._spec
+        if self.last is not None:
+            # only what was inserted after the last document handed out
+            spec = SON(spec)
+            spec[self._resume_field] = {'$gt': self.last}
+        try:
+            self._stream = self._cursor.stream(spec, **self._kwargs)
+        except Exception, e:
+            self._on_batch(None, e)
+            return
+        self._stream.each_batch(self._on_batch)
+
+    def _on_batch(self, documents, error):
+        if self.closed:
+            return False
+        if documents:
+            value = documents[-1].get(self._resume_field)
+            if value is not None:
+                self.last = value
+        if documents or error:
+            if self._callback(documents, error) is False:
+                self.close()
+                return False
+        if documents is None:
+            # the cursor is gone: nothing matched yet, it was killed or the server failed
+            logging.debug('%s tailable cursor ended (%s), querying again in %s seconds'
+                          % (self._cursor.full_collection_name, error, self._retry_delay))
+            self._stream = None
+            self._cursor._add_timeout(self._retry_delay, self._start)
+
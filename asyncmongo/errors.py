@@ -19,6 +19,7 @@
 #          |__InterfaceError
 #          |__DatabaseError
 #             |__DataError
+#             |__NotMasterError
 #             |__IntegrityError
 #             |__ProgrammingError
 #             |__NotSupportedError
@@ -38,6 +39,9 @@ class DatabaseError(Error):
 class DataError(DatabaseError):
     pass
 
+class NotMasterError(DatabaseError):
+    pass
+
 class IntegrityError(DatabaseError):
     def __init__(self, msg, code=None):
         self.code = code
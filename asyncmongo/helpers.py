@@ -4,7 +4,7 @@ import bson
 from bson.son import SON
 import struct
 from asyncmongo import ASCENDING, DESCENDING, GEO2D
-from asyncmongo.errors import (DatabaseError, InterfaceError)
+from asyncmongo.errors import (DatabaseError, InterfaceError, NotMasterError)
 
 
 def _parse_host(h):
@@ -39,7 +39,7 @@ def _unpack_response(response, cursor_id=None, as_class=dict, tz_aware=False):
     elif response_flag & 2:
         error_object = bson.BSON(response[20:]).decode()
         if error_object["$err"] == "not master":
-            raise DatabaseError("master has changed")
+            raise NotMasterError("master has changed")
         raise DatabaseError("database error: %s" %
                                error_object["$err"])
 
@@ -14,14 +14,43 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-from threading import Condition
+from threading import Condition, Lock, local, current_thread
+from collections import deque
+from functools import partial
 import logging
-from errors import TooManyConnections, ProgrammingError
+import random
+import time
+import os
+from bson import SON
+import message
+from errors import TooManyConnections, ProgrammingError, RSConnectionError, NotMasterError
 from connection import Connection
+from topology import TopologyMonitor, PRIMARY, SECONDARY, READ_PREFERENCES
+from autoscale import Autoscaler
+from breaker import CircuitBreaker
+from backends import load_backend
+
+
+class _NoCondition(object):
+    """stands in for the pool's `threading.Condition` when the pool is only used from one thread"""
+    def acquire(self):
+        pass
+
+    def release(self):
+        pass
+
+    def notify(self):
+        pass
+
+    def notifyAll(self):
+        pass
 
 
 class ConnectionPools(object):
     """ singleton to keep track of named connection pools """
+    _lock = Lock()
+    _pid = os.getpid()
+
     @classmethod
     def get_connection_pool(self, pool_id, *args, **kwargs):
         """get a connection pool, transparently creating it if it doesn't already exist
@@ -30,10 +59,26 @@ class ConnectionPools(object):
             - `pool_id`: unique id for a connection pool
         """
         assert isinstance(pool_id, (str, unicode))
-        if not hasattr(self, '_pools'):
-            self._pools = {}
-        if pool_id not in self._pools:
-            self._pools[pool_id] = ConnectionPool(*args, **kwargs)
+        if self._pid != os.getpid():
+            # a thread of the parent may have held the lock when the process forked.
+            # the pools themselves notice the fork on their next use
+            self._lock = Lock()
+            self._pid = os.getpid()
+        self._lock.acquire()
+        try:
+            if not hasattr(self, '_pools'):
+                self._pools = {}
+            if pool_id not in self._pools:
+                if kwargs.pop('partitioned', False):
+                    self._pools[pool_id] = PartitionedConnectionPool(*args, **kwargs)
+                elif kwargs.get('mongos'):
+                    self._pools[pool_id] = MongosConnectionPool(*args, **kwargs)
+                elif kwargs.get('rs') and kwargs.get('heartbeat_interval'):
+                    self._pools[pool_id] = ReplicaSetConnectionPool(*args, **kwargs)
+                else:
+                    self._pools[pool_id] = ConnectionPool(*args, **kwargs)
+        finally:
+            self._lock.release()
         # logging.debug("%s: _connections = %d", pool_id, self._pools[pool_id]._connections)
         return self._pools[pool_id]
     
@@ -53,6 +98,18 @@ class ConnectionPools(object):
             for pool_id, pool in self._pools.items():
                 pool.close()
 
+    @classmethod
+    def stats(self, pool_id=None):
+        """get usage statistics of one connection pool, or a dict of them by pool_id"""
+        if not hasattr(self, '_pools'):
+            self._pools = {}
+
+        if pool_id:
+            if pool_id not in self._pools:
+                raise ProgrammingError("pool %r does not exist" % pool_id)
+            return self._pools[pool_id].stats()
+        return dict((pool_id, pool.stats()) for pool_id, pool in self._pools.items())
+
 class ConnectionPool(object):
     """Connection Pool to a single mongo instance.
     
@@ -63,6 +120,27 @@ class ConnectionPool(object):
       - `maxusage` (optional): number of requests allowed on a connection before it is closed. 0 for unlimited
       - `dbname`: mongo database name
       - `slave_okay` (optional): is it okay to connect directly to and perform queries on a slave instance
+      - `max_in_flight` (optional): maximum requests pipelined on a single connection. 1 dedicates
+         a connection to each request, 0 for unlimited
+      - `wait_queue_timeout` (optional): seconds a request waits for a connection once
+         `maxconnections` is reached. 0 to raise `TooManyConnections` right away, None to wait forever
+      - `wait_queue_size` (optional): maximum requests waiting for a connection. 0 for unlimited
+      - `max_idle_time` (optional): seconds after which an idle connection is closed, `mincached`
+         connections are kept open. 0 to keep idle connections open
+      - `warmup` (optional): open the `mincached` connections in the background and have them
+         connect, authenticate and discover the replica set before they are first used
+      - `ready_callback` (optional): called with None once the warm up finished, or with the
+         first error a connection ran into. In a process forked from the one that created the
+         pool it is called again when the child's connections are ready
+      - `autoscale` (optional): an `autoscale.Autoscaler` that moves `maxconnections` between its
+         bounds as the load changes, `maxcached` is capped at `maxconnections`
+      - `threadsafe` (optional): False when the pool is only used from the IOLoop's thread, to
+         skip locking on every checkout and return
+      - `breaker_threshold` (optional): connects in a row that have to fail before connects to
+         the host fail right away for a while, see `breaker.CircuitBreaker`. 0 to always connect
+      - `breaker_backoff` (optional): seconds connects fail right away after the breaker opened
+         the first time, doubled every time the probe after it fails
+      - `breaker_max_backoff` (optional): longest seconds connects fail right away
       - `**kwargs`: passed to `connection.Connection`
     
     """
@@ -73,6 +151,17 @@ class ConnectionPool(object):
                 maxusage=0, 
                 dbname=None, 
                 slave_okay=False, 
+                max_in_flight=1,
+                wait_queue_timeout=0,
+                wait_queue_size=0,
+                max_idle_time=0,
+                warmup=False,
+                ready_callback=None,
+                autoscale=None,
+                threadsafe=True,
+                breaker_threshold=0,
+                breaker_backoff=0.5,
+                breaker_max_backoff=30,
                 *args, **kwargs):
         assert isinstance(mincached, int)
         assert isinstance(maxcached, int)
@@ -80,6 +169,15 @@ class ConnectionPool(object):
         assert isinstance(maxusage, int)
         assert isinstance(dbname, (str, unicode, None.__class__))
         assert isinstance(slave_okay, bool)
+        assert isinstance(max_in_flight, int)
+        assert isinstance(wait_queue_timeout, (int, float, None.__class__))
+        assert isinstance(wait_queue_size, int)
+        assert isinstance(max_idle_time, (int, float))
+        assert isinstance(warmup, bool)
+        assert ready_callback is None or callable(ready_callback)
+        assert isinstance(autoscale, (Autoscaler, None.__class__))
+        assert isinstance(threadsafe, bool)
+        assert isinstance(breaker_threshold, int)
         if mincached and maxcached:
             assert mincached <= maxcached
         if maxconnections:
@@ -90,77 +188,896 @@ class ConnectionPool(object):
         self._mincached = mincached
         self._maxcached = maxcached
         self._maxconnections = maxconnections
-        self._idle_cache = [] # the actual connections that can be used
-        self._condition = Condition()
+        # the actual connections that can be used. used as a stack so the most recently used
+        # connections are reused and the ones on the left get idle long enough to be reaped
+        self._idle_cache = deque()
+        self._condition = threadsafe and Condition() or _NoCondition()
         self._dbname = dbname
         self._slave_okay = slave_okay
         self._connections = 0
+        self._max_in_flight = max_in_flight
+        self._busy = set() # pipelined connections that have requests in flight
+        if max_in_flight != 1:
+            self._kwargs['pipelined'] = True
+        self._backend = load_backend(kwargs.get('backend', 'tornado'))
+        self._wait_queue_timeout = wait_queue_timeout
+        self._wait_queue_size = wait_queue_size
+        # [callback, timeout, start time] of requests waiting for a connection, oldest first.
+        # a timed out waiter has its callback set to None and is skipped when it comes up
+        self._waiters = deque()
+        self._waiting = 0
+        self._stats = dict(waits=0, wait_timeouts=0, wait_time_total=0.0, wait_time_max=0.0,
+                           max_waiting=0, reaped=0)
+        self._max_idle_time = max_idle_time
+        self._configured_maxcached = maxcached
+        self._peak = 0 # most connections in use since the autoscaler last looked
+        self._autoscale = autoscale
+        self._group = None # the PartitionedConnectionPool this pool is a partition of
+        self._read_preference = None
+        # getMores can only follow a cursor if they reach the server that opened it, with `rs`
+        # every connection discovers a member of its own
+        self._routes_cursors = not kwargs.get('rs')
+        self._breaker_kwargs = dict(threshold=breaker_threshold, backoff=breaker_backoff,
+                                    max_backoff=breaker_max_backoff)
+        self._breakers = {} # (host, port) -> CircuitBreaker
+        if autoscale:
+            autoscale.start(self)
+        self._warmup = warmup
+        self._ready_callback = ready_callback
+        # connections can't be shared with a forked process, see `_after_fork`
+        self._pid = os.getpid()
+        # timers start with the first request so that creating a pool doesn't touch the
+        # IOLoop before a pre-fork server forks. they stop once their generation is outdated
+        self._generation = 0
+        self._started = False
+        self._establish()
 
-        
-        # Establish an initial number of idle database connections:
-        idle = [self.connection() for i in range(mincached)]
+    def _establish(self):
+        """Establish an initial number of idle database connections"""
+        if self._warmup:
+            self.warm_up(self._ready_callback)
+            return
+        self._condition.acquire()
+        try:
+            idle = [self._checkout() for i in range(self._mincached)]
+        finally:
+            self._condition.release()
         while idle:
             self.cache(idle.pop())
+        if self._ready_callback:
+            self._ready_callback(None)
+
+    def _start(self):
+        """start the periodic jobs of this pool in this process"""
+        self._started = True
+        if self._max_idle_time:
+            self._schedule_reap(self._generation)
+        if self._autoscale:
+            self._autoscale._schedule(self._generation)
+
+    def _after_fork(self):
+        """forget the connections inherited from the parent process and set the pool up again
+
+        The parent's sockets are dropped without closing them, the parent still uses them and
+        closing them from here would hang up the parent's connections on the server too.
+        """
+        logging.debug('process forked, dropping %d idle connections of the parent' % len(self._idle_cache))
+        self._pid = os.getpid()
+        self._condition = isinstance(self._condition, _NoCondition) and _NoCondition() or Condition()
+        self._idle_cache = deque()
+        self._busy = set()
+        self._waiters = deque()
+        self._waiting = 0
+        self._connections = 0
+        self._peak = 0
+        self._generation += 1
+        self._started = False
+        self._establish()
+
+    def warm_up(self, callback=None):
+        """get `mincached` connections ready for use in parallel, without blocking
+
+        :Parameters:
+          - `callback` (optional): called with None once all connections are ready, or with
+            the first error a connection ran into
+        """
+        self._condition.acquire()
+        try:
+            count = max(self._mincached - len(self._idle_cache), 0)
+            if self._maxconnections:
+                # connections in use count against the limit too
+                count = min(count, max(self._maxconnections - self._connections, 0))
+            warming = [self._checkout() for i in range(count)]
+        finally:
+            self._condition.release()
+        if not warming:
+            if callback:
+                callback(None)
+            return
+        state = dict(pending=len(warming), error=None)
+        for con in warming:
+            con.warm_up(partial(self._warmed_up, con, state, callback))
+
+    def _warmed_up(self, con, state, callback, error):
+        if error:
+            # the failed connection closed itself, which put it back into the pool
+            logging.error('Failed to warm up connection: %s' % error)
+            state['error'] = state['error'] or error
+        else:
+            self.cache(con)
+        state['pending'] -= 1
+        if not state['pending'] and callback:
+            callback(state['error'])
     
+    def breaker(self, host, port):
+        """the circuit breaker for connects to `host`:`port` shared by the pool's connections,
+        None without `breaker_threshold`"""
+        if not self._breaker_kwargs['threshold']:
+            return None
+        breaker = self._breakers.get((host, port))
+        if breaker is None:
+            breaker = self._breakers.setdefault((host, port), CircuitBreaker(host, port, **self._breaker_kwargs))
+        return breaker
+
     def new_connection(self):
         kwargs = self._kwargs
         kwargs['pool'] = self
         return Connection(*self._args, **kwargs)
     
-    def connection(self):
-        """ get a cached connection from the pool """
+    def connection(self, callback=None, timeout=None, **route):
+        """ get a cached connection from the pool
+
+        When `maxconnections` is reached and `callback` is given the request joins the wait
+        queue: None is returned and `callback(connection, error)` is called from the IOLoop
+        with the next connection given back to the pool, or with `TooManyConnections` once
+        the wait timed out.
+
+        :Parameters:
+          - `callback` (optional): called with a connection when one was not available right away
+          - `timeout` (optional): seconds to wait, overrides `wait_queue_timeout`
+          - `**route`: where a `ReplicaSetConnectionPool` sends the request, ignored by a pool
+            to a single mongo instance
+        """
+        if self._pid != os.getpid():
+            self._after_fork()
+        if not self._started:
+            self._start()
         
         self._condition.acquire()
         try:
-            if (self._maxconnections and self._connections >= self._maxconnections):
-                raise TooManyConnections("%d connections are already equal to the max: %d" % (self._connections, self._maxconnections))
+            if self._max_in_flight != 1:
+                # share a connection that still has room for more requests
+                con = self._shared_connection()
+                if con is not None:
+                    return con
+            if self._at_limit() or self._waiting:
+                if timeout is None:
+                    timeout = self._wait_queue_timeout
+                if callback is None or timeout == 0:
+                    raise TooManyConnections("%d connections are already equal to the max: %d" % (self._connections, self._maxconnections))
+                if self._wait_queue_size and self._waiting >= self._wait_queue_size:
+                    raise TooManyConnections("%d requests are already waiting for a connection" % self._waiting)
+                self._wait(callback, timeout)
+                return None
             # connection limit not reached, get a dedicated connection
-            try: # first try to get it from the idle cache
-                con = self._idle_cache.pop(0)
-            except IndexError: # else get a fresh connection
-                con = self.new_connection()
-            self._connections += 1
+            con = self._checkout()
         finally:
             self._condition.release()
         return con
 
+    def _checkout(self):
+        """take a dedicated connection out of the idle cache or open a new one"""
+        try: # first try to get it from the idle cache
+            con = self._pop_idle()
+        except IndexError: # else get a fresh connection
+            con = self.new_connection()
+        self._connections += 1
+        if self._connections > self._peak:
+            self._peak = self._connections
+        if self._max_in_flight != 1:
+            self._busy.add(con)
+        return con
+
+    def _pop_idle(self, oldest=False):
+        """take the most recently (or least recently) used connection out of the idle cache"""
+        if oldest:
+            con = self._idle_cache.popleft()
+        else:
+            con = self._idle_cache.pop()
+        con.idle_since = None
+        return con
+
+    def _wait(self, callback, timeout):
+        waiter = [callback, None, time.time()]
+        if timeout is not None:
+            waiter[1] = self._backend.add_timeout(timeout, partial(self._wait_timeout, waiter),
+                                                  io_loop=self._kwargs.get('io_loop'))
+        self._waiters.append(waiter)
+        self._waiting += 1
+        self._stats['waits'] += 1
+        self._stats['max_waiting'] = max(self._stats['max_waiting'], self._waiting)
+
+    def _wait_timeout(self, waiter):
+        self._condition.acquire()
+        try:
+            callback = waiter[0]
+            if callback is None:
+                # got its connection in the meantime
+                return
+            waiter[0] = None
+            self._waiting -= 1
+            self._record_wait(waiter)
+            self._stats['wait_timeouts'] += 1
+        finally:
+            self._condition.release()
+        callback(None, TooManyConnections("timed out waiting for a connection, %d connections are in use" % self._connections))
+
+    def _record_wait(self, waiter):
+        waited = time.time() - waiter[2]
+        self._stats['wait_time_total'] += waited
+        self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+
+    def _next_waiter(self):
+        """pop the oldest request still waiting for a connection, or None. needs the lock"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if waiter[0] is None:
+                continue
+            if waiter[1] is not None:
+                self._backend.remove_timeout(waiter[1], io_loop=self._kwargs.get('io_loop'))
+            self._waiting -= 1
+            self._record_wait(waiter)
+            callback, waiter[0] = waiter[0], None
+            return callback
+        return None
+
+    def _hand_over(self, callback, con):
+        """give `con` to a waiting request on the next IOLoop iteration"""
+        self._backend.add_callback(partial(callback, con, None), io_loop=self._kwargs.get('io_loop'))
+
+    def _serve_waiters(self):
+        """open connections for waiting requests while there is room below `maxconnections`"""
+        self._condition.acquire()
+        try:
+            while self._waiting and not self._at_limit():
+                callback = self._next_waiter()
+                if callback is None:
+                    break
+                self._hand_over(callback, self._checkout())
+        finally:
+            self._condition.release()
+
+    def _outstanding(self):
+        """requests sent on a connection of this pool or waiting for one"""
+        if self._max_in_flight != 1:
+            return sum(con.in_flight for con in list(self._busy)) + self._waiting
+        return self._connections + self._waiting
+
+    def _at_limit(self):
+        """True when no more connections may be opened"""
+        if self._group:
+            return self._group._at_limit()
+        return self._maxconnections and self._connections >= self._maxconnections
+
+    def _shared_connection(self):
+        """the least loaded pipelined connection below the `max_in_flight` limit, or None"""
+        best = None
+        for con in self._busy:
+            in_flight = con.in_flight
+            if self._max_in_flight and in_flight >= self._max_in_flight:
+                continue
+            if best is None or in_flight < best[0]:
+                best = (in_flight, con)
+        return best and best[1]
+
     def cache(self, con):
         """Put a dedicated connection back into the idle cache."""
+        if self._max_in_flight != 1:
+            self._condition.acquire()
+            try:
+                if con not in self._busy:
+                    # already cached
+                    return
+                if con.in_flight:
+                    # still carrying requests for other cursors, but it may have room for a waiter
+                    if self._waiting and con.in_flight < self._max_in_flight:
+                        callback = self._next_waiter()
+                        if callback:
+                            self._hand_over(callback, con)
+                    return
+                self._busy.remove(con)
+            finally:
+                self._condition.release()
         if self._maxusage and con.usage_count > self._maxusage:
             self._connections -=1
             logging.debug('dropping connection %s uses past max usage %s' % (con.usage_count, self._maxusage))
             con._close()
+            self._serve_waiters()
+            if self._group:
+                self._group._slot_freed(self)
             return
         self._condition.acquire()
-        if con in self._idle_cache:
+        if con.idle_since is not None:
             # called via socket close on a connection in the idle cache
             self._condition.release()
             return
         try:
+            callback = self._waiting and self._next_waiter()
+            if callback:
+                # skip the idle cache, the oldest waiting request gets this connection
+                if self._max_in_flight != 1:
+                    self._busy.add(con)
+                self._hand_over(callback, con)
+                return
             if not self._maxcached or len(self._idle_cache) < self._maxcached:
                 # the idle cache is not full, so put it there
+                con.idle_since = time.time()
                 self._idle_cache.append(con)
             else: # if the idle cache is already full,
                 logging.debug('dropping connection. connection pool (%s) is full. maxcached %s' % (len(self._idle_cache), self._maxcached))
                 con._close() # then close the connection
             self._condition.notify()
-        finally:
             self._connections -= 1
+        finally:
             self._condition.release()
+        if self._group:
+            self._group._slot_freed(self)
     
     def close(self):
         """Close all connections in the pool."""
         self._condition.acquire()
         try:
             while self._idle_cache: # close all idle connections
-                con = self._idle_cache.pop(0)
+                con = self._pop_idle()
                 try:
                     con._close()
                 except Exception:
                     pass
-                self._connections -=1
             self._condition.notifyAll()
         finally:
             self._condition.release()
-    
+
+    def member_failed(self, address, error):
+        """a request to `address` failed with `error`. There is no other server to go to,
+        so the request can't be retried elsewhere
+
+        @returns False
+        """
+        return False
+
+    def _schedule_reap(self, generation):
+        # check twice per max_idle_time, so no connection stays idle much longer than that
+        self._backend.add_timeout(self._max_idle_time / 2.0, partial(self._reap_idle, generation),
+                                  io_loop=self._kwargs.get('io_loop'))
+
+    def _reap_idle(self, generation):
+        """close connections idle for longer than `max_idle_time`, keeping `mincached` of them"""
+        if generation != self._generation:
+            # scheduled before a fork
+            return
+        deadline = time.time() - self._max_idle_time
+        reaped = []
+        self._condition.acquire()
+        try:
+            # the least recently used connections are on the left
+            while len(self._idle_cache) > self._mincached and self._idle_cache[0].idle_since < deadline:
+                reaped.append(self._pop_idle(oldest=True))
+            self._stats['reaped'] += len(reaped)
+        finally:
+            self._condition.release()
+        if reaped:
+            logging.debug('closing %d connections idle for more than %s seconds' % (len(reaped), self._max_idle_time))
+        for con in reaped:
+            try:
+                con._close()
+            except Exception:
+                pass
+        self._schedule_reap(generation)
+
+    def _take_peak(self):
+        """most connections in use since the last call"""
+        self._condition.acquire()
+        try:
+            peak, self._peak = max(self._peak, self._connections), self._connections
+        finally:
+            self._condition.release()
+        return peak
+
+    def _resize(self, maxconnections):
+        """change `maxconnections`, closing idle connections that no longer fit in the cache"""
+        surplus = []
+        self._condition.acquire()
+        try:
+            grown = maxconnections > self._maxconnections
+            self._maxconnections = maxconnections
+            if self._configured_maxcached:
+                self._maxcached = min(self._configured_maxcached, maxconnections)
+            while self._maxcached and len(self._idle_cache) > self._maxcached:
+                surplus.append(self._pop_idle(oldest=True))
+        finally:
+            self._condition.release()
+        for con in surplus:
+            try:
+                con._close()
+            except Exception:
+                pass
+        if grown:
+            self._serve_waiters()
+
+    def stats(self):
+        """usage statistics of this pool; use them to size `maxconnections` and the wait queue"""
+        self._condition.acquire()
+        try:
+            stats = dict(self._stats)
+            stats.update(connections=self._connections,
+                         idle=len(self._idle_cache),
+                         waiting=self._waiting,
+                         maxconnections=self._maxconnections)
+            if self._autoscale:
+                stats['autoscale'] = self._autoscale.stats()
+            if self._breakers:
+                stats['breakers'] = [breaker.describe() for breaker in self._breakers.values()]
+        finally:
+            self._condition.release()
+        return stats
+
+
+class PartitionedConnectionPool(object):
+    """Connection pools to a single mongo instance, one for each thread that uses it.
+
+    Every thread running its own IOLoop gets its own `ConnectionPool`, bound to that loop,
+    so connections are never shared across loops. `maxconnections` applies to all
+    partitions together; it is checked without a common lock, so threads racing for the
+    last connection can briefly go over it by one each.
+
+    :Parameters:
+      - `maxconnections` (optional): maximum open connections for all partitions. 0 for unlimited
+      - `*args`, `**kwargs`: passed to `ConnectionPool` for every partition, ie: `mincached`
+        connections are opened per partition
+    """
+    def __init__(self, maxconnections=0, *args, **kwargs):
+        assert isinstance(maxconnections, int)
+        assert not kwargs.get('autoscale'), "an Autoscaler sizes a single pool"
+        self._args, self._kwargs = args, kwargs
+        self._maxconnections = maxconnections
+        self._dbname = kwargs.get('dbname')
+        self._slave_okay = kwargs.get('slave_okay', False)
+        self._read_preference = None
+        self._routes_cursors = not kwargs.get('rs')
+        self._backend = load_backend(kwargs.get('backend', 'tornado'))
+        self._local = local()
+        self._lock = Lock()
+        self._partitions = []
+        self._pid = os.getpid()
+
+    def partition(self):
+        """the pool of the calling thread, created on first use"""
+        if self._pid != os.getpid():
+            # the other threads' partitions did not survive the fork, start over
+            self._local = local()
+            self._lock = Lock()
+            self._partitions = []
+            self._pid = os.getpid()
+        pool = getattr(self._local, 'pool', None)
+        if pool is None:
+            kwargs = dict(self._kwargs)
+            io_loop = getattr(self._local, 'io_loop', None)
+            if io_loop is not None:
+                kwargs['io_loop'] = io_loop
+            elif 'io_loop' not in kwargs:
+                loop_kwargs = self._backend.loop_kwargs()
+                if loop_kwargs is None:
+                    raise ProgrammingError("the IOLoop of thread %r is unknown, call bind_io_loop first"
+                                           % current_thread().name)
+                kwargs.update(loop_kwargs)
+            pool = ConnectionPool(maxconnections=self._maxconnections, *self._args, **kwargs)
+            pool._group = self
+            self._local.pool = pool
+            self._lock.acquire()
+            try:
+                self._partitions.append(pool)
+            finally:
+                self._lock.release()
+        return pool
+
+    def bind_io_loop(self, io_loop):
+        """use `io_loop` for the calling thread's partition. Threads whose loop the backend
+        can't tell (other threads than the main one before tornado 3) have to call this
+        before their first request"""
+        pool = getattr(self._local, 'pool', None)
+        if pool is not None and pool._kwargs.get('io_loop') is not io_loop:
+            raise ProgrammingError("the partition of thread %r already uses another IOLoop"
+                                   % current_thread().name)
+        self._local.io_loop = io_loop
+
+    def connection(self, callback=None, timeout=None, **route):
+        """get a connection from the calling thread's pool; see `ConnectionPool.connection`"""
+        return self.partition().connection(callback=callback, timeout=timeout)
+
+    def warm_up(self, callback=None):
+        """warm up the calling thread's pool; see `ConnectionPool.warm_up`"""
+        self.partition().warm_up(callback)
+
+    def member_failed(self, address, error):
+        """see `ConnectionPool.member_failed`"""
+        return False
+
+    def _at_limit(self):
+        if not self._maxconnections:
+            return False
+        return sum(pool._connections for pool in self._partitions) >= self._maxconnections
+
+    def _slot_freed(self, freed_by):
+        """a connection went back to `freed_by`, requests waiting in other partitions may take its place"""
+        for pool in self._partitions:
+            if pool is not freed_by and pool._waiting:
+                pool._backend.add_callback(pool._serve_waiters, io_loop=pool._kwargs.get('io_loop'))
+
+    def close(self):
+        """Close all idle connections in all partitions."""
+        for pool in list(self._partitions):
+            pool.close()
+
+    def stats(self):
+        """usage statistics summed up over all partitions"""
+        stats = dict(connections=0, idle=0, waiting=0, waits=0, wait_timeouts=0, wait_time_total=0.0,
+                     wait_time_max=0.0, max_waiting=0, reaped=0)
+        partitions = list(self._partitions)
+        for pool in partitions:
+            for key, value in pool.stats().items():
+                if key in ('wait_time_max', 'max_waiting'):
+                    stats[key] = max(stats[key], value)
+                elif key in stats:
+                    stats[key] += value
+        stats.update(maxconnections=self._maxconnections, partitions=len(partitions))
+        return stats
+
+
+class ReplicaSetConnectionPool(object):
+    """Connection pools to the members of a replica set.
+
+    A `topology.TopologyMonitor` shared by all connections keeps the member table up to
+    date, and every member gets a `ConnectionPool` of its own. Requests go to the pool of
+    the member they need, so new connections connect straight to it without walking the
+    seed list and sending ismaster first.
+
+    :Parameters:
+      - `rs`: replica set name
+      - `seed`: list of (host, port) to discover the replica set from
+      - `heartbeat_interval`: seconds between the ismaster heartbeats to every member
+      - `secondary_only` (optional): send all requests to secondaries
+      - `read_preference` (optional): one of `topology.READ_PREFERENCES`, where queries go
+         unless they ask for something else. Writes and commands always go to the primary
+      - `tag_sets` (optional): list of tag dicts that secondaries have to match to take reads
+      - `local_threshold` (optional): seconds of round trip time; reads are spread over the
+         eligible members at most this much slower than the fastest one
+      - `max_staleness` (optional): seconds a secondary may lag behind the primary and still
+         take reads. None to read from lagging secondaries too
+      - `standby` (optional): connections to keep connected and authenticated to every primary
+         and secondary the heartbeats find, so a new primary or a change of read preference
+         finds them ready. Their pools are warmed up after each heartbeat round
+      - `topology_cache` (optional): path of a file to share the member table with other
+         processes, see `topology.TopologyMonitor`
+      - `topology_cache_ttl` (optional): seconds a member table from `topology_cache` is used for
+      - `*args`, `**kwargs`: passed to `ConnectionPool` for every member, ie: `maxconnections`
+        is a limit per member
+    """
+    def __init__(self, rs, seed, heartbeat_interval, secondary_only=False, read_preference=None,
+                 tag_sets=None, local_threshold=0.015, max_staleness=None, standby=0,
+                 topology_cache=None, topology_cache_ttl=300, *args, **kwargs):
+        assert isinstance(secondary_only, bool)
+        assert read_preference is None or read_preference in READ_PREFERENCES
+        assert isinstance(tag_sets, (list, None.__class__))
+        assert isinstance(local_threshold, (int, float))
+        assert isinstance(max_staleness, (int, float, None.__class__))
+        assert isinstance(standby, int)
+        assert not kwargs.get('autoscale'), "an Autoscaler sizes a single pool"
+        if standby:
+            assert not kwargs.get('maxcached') or kwargs['maxcached'] >= standby
+            assert not kwargs.get('maxconnections') or kwargs['maxconnections'] >= standby
+        monitor_kwargs = {}
+        if 'io_loop' in kwargs:
+            monitor_kwargs['io_loop'] = kwargs['io_loop']
+        self._topology = TopologyMonitor(seed, rs, heartbeat_interval,
+                                         backend=kwargs.get('backend', 'tornado'),
+                                         connect_timeout=kwargs.get('connect_timeout'),
+                                         cache_file=topology_cache, cache_ttl=topology_cache_ttl,
+                                         **monitor_kwargs)
+        # secondary_only sends everything to secondaries, as the connections of a pool
+        # without a topology monitor do
+        self._write_preference = secondary_only and SECONDARY or PRIMARY
+        self._read_preference = read_preference or self._write_preference
+        self._tag_sets = tag_sets
+        self._local_threshold = local_threshold
+        self._max_staleness = max_staleness
+        self._args, self._kwargs = args, kwargs
+        self._dbname = kwargs.get('dbname')
+        self._slave_okay = kwargs.get('slave_okay', False) or secondary_only
+        self._routes_cursors = True
+        self._pools = {} # (host, port) -> ConnectionPool
+        self._lock = Lock()
+        self._backend = self._topology._backend
+        self._standby = standby
+        if standby:
+            self._kwargs['mincached'] = max(kwargs.get('mincached', 0), standby)
+            self._kwargs['warmup'] = True
+            self._topology.add_listener(self._keep_standby)
+
+    def member_pool(self, address):
+        """the connection pool of the member at `address`, created on first use"""
+        self._lock.acquire()
+        try:
+            pool = self._pools.get(address)
+            if pool is None:
+                pool = ConnectionPool(host=address[0], port=address[1], *self._args, **self._kwargs)
+                self._pools[address] = pool
+        finally:
+            self._lock.release()
+        return pool
+
+    def connection(self, callback=None, timeout=None, read_preference=None, tag_sets=None, address=None,
+                   exclude=()):
+        """get a connection to a member chosen by read preference
+
+        While no suitable member is known yet and `callback` is given, None is returned and
+        `callback(connection, error)` is called once the heartbeats found one, or with
+        `RSConnectionError` if they didn't. See `ConnectionPool.connection`.
+
+        :Parameters:
+          - `read_preference` (optional): one of `topology.READ_PREFERENCES`, None for the primary
+          - `tag_sets` (optional): overrides the pool's `tag_sets`
+          - `address` (optional): (host, port) of the member to use regardless of its state,
+            ie: to get more results of a cursor or to kill it
+          - `exclude` (optional): (host, port) of members not to use, ie: to hedge a query
+        """
+        self._topology.start()
+        if address is not None:
+            return self.member_pool(address).connection(callback=callback, timeout=timeout)
+        if tag_sets is None:
+            tag_sets = self._tag_sets
+        select = partial(self._select, read_preference or self._write_preference, tag_sets, exclude)
+        member = select(self._topology)
+        if member is not None:
+            return self.member_pool(member.address).connection(callback=callback, timeout=timeout)
+        if callback is None:
+            raise RSConnectionError("No suitable member of replica set %s is known" % self._topology.rs)
+        self._topology.wait_for(select, partial(self._selected, callback, timeout))
+        return None
+
+    def _keep_standby(self, topology):
+        """open and warm up the standby connections of members that are up and hold data"""
+        for member in topology.members.values():
+            if member.state not in (PRIMARY, SECONDARY):
+                continue
+            if member.address not in self._pools:
+                # warms up `standby` connections as it is created
+                self.member_pool(member.address)
+                continue
+            pool = self._pools[member.address]
+            if pool._connections + len(pool._idle_cache) < self._standby:
+                # some were closed since, ie: when the member went down
+                pool.warm_up()
+
+    def _select(self, read_preference, tag_sets, exclude, topology):
+        return topology.select(read_preference, tag_sets, self._local_threshold, self._max_staleness, exclude)
+
+    def _selected(self, callback, timeout, member, error):
+        if error:
+            callback(None, error)
+            return
+        try:
+            con = self.member_pool(member.address).connection(callback=callback, timeout=timeout)
+        except Exception, e:
+            callback(None, e)
+            return
+        if con is not None:
+            callback(con, None)
+
+    def member_failed(self, address, error):
+        """a request to the member at `address` failed with a "not master" reply or a broken
+        connection. The member is taken out of the topology for all connections of the pool
+        and the heartbeats go out right away, so the retry finds the new primary
+
+        @returns True, the request may be retried on the member its read preference picks now
+        """
+        self._topology.member_failed(address, error)
+        if not isinstance(error, NotMasterError):
+            # the other idle connections to it are most likely broken too
+            pool = self._pools.get(address)
+            if pool is not None:
+                pool.close()
+        return True
+
+    def close(self):
+        """Close the idle connections to all members."""
+        for pool in self._pools.values():
+            pool.close()
+
+    def stats(self):
+        """usage statistics of the member pools by "host:port", and the member table"""
+        stats = dict(("%s:%s" % address, pool.stats()) for address, pool in self._pools.items())
+        return dict(pools=stats, members=self._topology.describe())
+
+
+class _Router(object):
+    """a mongos of a `MongosConnectionPool`"""
+    # the ping connection uses the router as its pool
+    _dbname = None
+
+    def __init__(self, host, port, pool):
+        self.host = host
+        self.port = port
+        self.pool = pool
+        self.rtt = None # seconds, moving average of the ping round trips
+        self.ejected_until = 0
+        self.failures = 0
+        self.error = None
+        self.ping_connection = None
+
+    @property
+    def address(self):
+        return (self.host, self.port)
+
+    def cache(self, con):
+        pass
+
+    def describe(self):
+        return dict(host=self.host, port=self.port, rtt=self.rtt, outstanding=self.pool._outstanding(),
+                    ejected=self.ejected_until > time.time(), failures=self.failures,
+                    error=self.error and str(self.error))
+
+
+class MongosConnectionPool(object):
+    """Connection pools to several mongos routers of a sharded cluster.
+
+    Every router gets a `ConnectionPool` of its own and each request goes to the router
+    with the fewest outstanding requests, or the lowest ping round trip time. A router a
+    request or ping failed on is ejected for `eject_time` seconds; it is pinged every
+    `ping_interval` seconds and takes requests again once the time is up and a ping went
+    through. When all routers are ejected the requests go to all of them.
+
+    :Parameters:
+      - `mongos`: list of (host, port) of the routers
+      - `balance` (optional): `least_outstanding` or `latency`
+      - `ping_interval` (optional): seconds between the ismaster pings to every router
+      - `eject_time` (optional): seconds a failed router gets no requests
+      - `*args`, `**kwargs`: passed to `ConnectionPool` for every router, ie: `maxconnections`
+        is a limit per router
+    """
+    # weight of the latest round trip in the moving average
+    RTT_ALPHA = 0.2
+
+    def __init__(self, mongos, balance='least_outstanding', ping_interval=10, eject_time=30, *args, **kwargs):
+        assert isinstance(mongos, (list, tuple)) and mongos
+        assert balance in ('least_outstanding', 'latency')
+        assert isinstance(ping_interval, (int, float)) and ping_interval > 0
+        assert isinstance(eject_time, (int, float))
+        assert not kwargs.get('autoscale'), "an Autoscaler sizes a single pool"
+        self._balance = balance
+        self._ping_interval = ping_interval
+        self._eject_time = eject_time
+        self._args, self._kwargs = args, kwargs
+        self._dbname = kwargs.get('dbname')
+        self._slave_okay = kwargs.get('slave_okay', False)
+        self._read_preference = None
+        self._routes_cursors = True
+        self._backend = load_backend(kwargs.get('backend', 'tornado'))
+        self._routers = {} # (host, port) -> _Router
+        for host, port in mongos:
+            pool = ConnectionPool(host=host, port=port, *args, **kwargs)
+            self._routers[(host, port)] = _Router(host, port, pool)
+        self._ping_kwargs = {}
+        if 'io_loop' in kwargs:
+            self._ping_kwargs['io_loop'] = kwargs['io_loop']
+        self._pid = os.getpid()
+        self._generation = 0
+        self._started = False
+
+    def _start(self):
+        """start the pings in this process"""
+        if self._pid != os.getpid():
+            # the parent keeps using the ping connections, drop them without closing
+            self._pid = os.getpid()
+            self._generation += 1
+            self._started = False
+            for router in self._routers.values():
+                router.ping_connection = None
+        if not self._started:
+            self._started = True
+            self._ping(self._generation)
+
+    def _ping(self, generation):
+        if generation != self._generation:
+            # scheduled before the process forked
+            return
+        for router in self._routers.values():
+            con = router.ping_connection
+            if con is None:
+                con = Connection(host=router.host, port=router.port, pool=router,
+                                 backend=self._kwargs.get('backend', 'tornado'),
+                                 connect_timeout=self._kwargs.get('connect_timeout'), pipelined=True,
+                                 **self._ping_kwargs)
+                router.ping_connection = con
+            msg = message.query(0, "admin.$cmd", 0, -1, SON([("ismaster", 1)]))
+            try:
+                con.send_message(msg, callback=partial(self._on_ping, router, time.time()))
+            except Exception, e:
+                self._on_ping(router, time.time(), None, e)
+        self._backend.add_timeout(self._ping_interval, partial(self._ping, generation),
+                                  io_loop=self._kwargs.get('io_loop'))
+
+    def _on_ping(self, router, start, response, error=None):
+        if error:
+            logging.debug("Ping to mongos %s:%s failed: %s", router.host, router.port, error)
+            self._eject(router, error)
+            return
+        rtt = time.time() - start
+        if router.rtt is None:
+            router.rtt = rtt
+        else:
+            router.rtt += self.RTT_ALPHA * (rtt - router.rtt)
+        if router.failures and router.ejected_until <= time.time():
+            logging.info("mongos %s:%s is back", router.host, router.port)
+            router.failures = 0
+            router.error = None
+
+    def _eject(self, router, error):
+        router.failures += 1
+        router.error = error
+        router.ejected_until = time.time() + self._eject_time
+        con, router.ping_connection = router.ping_connection, None
+        if con is not None:
+            con.close()
+        # the other idle connections to it are most likely broken too
+        router.pool.close()
+
+    def connection(self, callback=None, timeout=None, address=None, exclude=(), **route):
+        """get a connection to the least loaded router, see `ConnectionPool.connection`
+
+        :Parameters:
+          - `address` (optional): (host, port) of the router to use, ie: to get more results
+            of a cursor or to kill it
+          - `exclude` (optional): (host, port) of routers not to use
+        """
+        self._start()
+        if address is not None:
+            return self._routers[address].pool.connection(callback=callback, timeout=timeout)
+        return self._pick(exclude).pool.connection(callback=callback, timeout=timeout)
+
+    def _pick(self, exclude=()):
+        # an ejected router is taken back by the first ping that goes through after its time is up
+        candidates = [router for router in self._routers.values()
+                      if router.address not in exclude and not router.failures]
+        if not candidates:
+            # better to try an ejected router than to fail right away
+            candidates = [router for router in self._routers.values() if router.address not in exclude] or self._routers.values()
+        if self._balance == 'latency':
+            key = lambda router: (router.rtt or 0, router.pool._outstanding())
+        else:
+            key = lambda router: (router.pool._outstanding(), router.rtt or 0)
+        best = min(key(router) for router in candidates)
+        return random.choice([router for router in candidates if key(router) == best])
+
+    def member_failed(self, address, error):
+        """a request to the router at `address` failed; a "not master" reply is about the
+        shard behind it, a broken connection ejects the router
+
+        @returns True, the request may be retried on another router
+        """
+        router = self._routers.get(address)
+        if router is not None and not isinstance(error, NotMasterError):
+            logging.debug("Request to mongos %s:%s failed: %s", address[0], address[1], error)
+            self._eject(router, error)
+        return True
+
+    def close(self):
+        """Close the idle connections to all routers."""
+        for router in self._routers.values():
+            router.pool.close()
+
+    def stats(self):
+        """usage statistics of the router pools by "host:port", and the router table"""
+        stats = dict(("%s:%s" % address, router.pool.stats()) for address, router in self._routers.items())
+        routers = [router.describe() for router in sorted(self._routers.values(), key=lambda r: r.address)]
+        return dict(pools=stats, routers=routers)
 
@@ -0,0 +1,138 @@
+#!/bin/env python
+#
+# Copyright 2014 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import time
+import socket
+import logging
+import threading
+import functools
+import Queue
+
+
+class Resolver(object):
+    """
+    Host name resolver that runs `getaddrinfo` on a pool of worker threads and keeps
+    the results in a TTL cache, so connecting and reconnecting never blocks the IOLoop
+    on DNS. One instance is shared by every connection using the same backend.
+
+    :Parameters:
+      - `backend`: async backend used to hand results back to the IOLoop thread
+      - `num_threads` (optional): number of resolver threads
+      - `ttl` (optional): seconds a resolved address is reused before it is looked up again
+      - `family` (optional): address family to resolve to, IPv4 like the connections always
+        used; `socket.AF_UNSPEC` for the first address of any family
+    """
+    def __init__(self, backend, num_threads=2, ttl=300, family=socket.AF_INET):
+        assert isinstance(num_threads, int) and num_threads > 0
+        assert isinstance(ttl, (int, float))
+        self._backend = backend
+        self._num_threads = num_threads
+        self._ttl = ttl
+        self._family = family
+        self._cache = {} # (host, port) -> (expires, (family, sockaddr))
+        self._waiting = {} # (host, port) -> [(callback, kwargs)] for lookups in progress
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = os.getpid()
+
+    def resolve(self, host, port, callback, **kwargs):
+        """resolve `host`:`port` to an address to connect to
+
+        :Parameters:
+          - `callback`: called on the IOLoop thread with ((family, sockaddr), None), or with
+            (None, error) if the lookup failed. None to only warm the cache
+          - `**kwargs`: passed to the backend's `add_callback` (ie: `io_loop`)
+        """
+        key = (host, port)
+        try:
+            # numeric addresses don't need a lookup, AI_NUMERICHOST never blocks
+            info = socket.getaddrinfo(host, port, self._family, socket.SOCK_STREAM, 0,
+                                      socket.AI_NUMERICHOST)
+        except socket.gaierror:
+            pass
+        else:
+            if callback:
+                callback((info[0][0], info[0][4]), None)
+            return
+
+        if self._pid != os.getpid():
+            # the worker threads did not survive a fork, start new ones when they are needed
+            self._lock = threading.Lock()
+            self._waiting = {}
+            self._queue = None
+            self._pid = os.getpid()
+
+        self._lock.acquire()
+        try:
+            cached = self._cache.get(key)
+            if cached and cached[0] > time.time():
+                address = cached[1]
+            else:
+                address = None
+                if key in self._waiting:
+                    # a lookup for this host is already running
+                    self._waiting[key].append((callback, kwargs))
+                    return
+                self._waiting[key] = [(callback, kwargs)]
+        finally:
+            self._lock.release()
+
+        if address:
+            if callback:
+                callback(address, None)
+            return
+        if self._queue is None:
+            self._start()
+        self._queue.put(key)
+
+    def invalidate(self, host, port):
+        """drop a cached address, the next `resolve` looks it up again"""
+        self._lock.acquire()
+        try:
+            self._cache.pop((host, port), None)
+        finally:
+            self._lock.release()
+
+    def _start(self):
+        self._queue = Queue.Queue()
+        for i in range(self._num_threads):
+            thread = threading.Thread(target=self._work, args=(self._queue,))
+            thread.daemon = True
+            thread.start()
+
+    def _work(self, queue):
+        while True:
+            host, port = queue.get()
+            address, error = None, None
+            try:
+                info = socket.getaddrinfo(host, port, self._family, socket.SOCK_STREAM)
+                address = (info[0][0], info[0][4])
+            except socket.error, e:
+                logging.debug("Failed to resolve %s:%s: %s", host, port, e)
+                error = e
+
+            self._lock.acquire()
+            try:
+                if address:
+                    self._cache[(host, port)] = (time.time() + self._ttl, address)
+                waiting = self._waiting.pop((host, port), [])
+            finally:
+                self._lock.release()
+
+            for callback, kwargs in waiting:
+                if callback:
+                    self._backend.add_callback(functools.partial(callback, address, error), **kwargs)
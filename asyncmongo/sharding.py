@@ -0,0 +1,287 @@
+#!/bin/env python
+#
+# Copyright 2014 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import bisect
+import hashlib
+import struct
+import logging
+from functools import partial
+
+import bson
+from bson.objectid import ObjectId
+
+from errors import DataError
+from client import Client
+import helpers
+
+
+class HashRing(object):
+    """
+    Consistent hash ring. Every node is placed on the ring `replicas` times and a key
+    belongs to the first node after it, so adding or removing a node only moves the keys
+    next to that node's points.
+
+    :Parameters:
+      - `nodes`: names of the nodes
+      - `replicas` (optional): points per node, more spread the keys more evenly
+    """
+    def __init__(self, nodes, replicas=160):
+        assert nodes
+        assert isinstance(replicas, int) and replicas > 0
+        self._ring = sorted((_hash("%s-%d" % (node, i)), node) for node in nodes for i in range(replicas))
+        self._points = [point for point, node in self._ring]
+
+    def node(self, key):
+        """the node `key` (a string) belongs to"""
+        i = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._ring[i][1]
+
+
+def _hash(key):
+    return struct.unpack("<I", hashlib.md5(key).digest()[:4])[0]
+
+
+class ShardedClient(object):
+    """
+    Client for collections sharded over independent servers (or replica sets) by the
+    application. Every shard has a connection pool of its own, documents are assigned
+    to shards by their `shard_key` on a consistent hash ring.
+
+    Requests that name a single shard key value go to its shard. Finds without one are
+    sent to all shards at once and their results are merged with `sort`, `skip` and
+    `limit` applied across shards; updates and removes without one go to all shards.
+
+    :Parameters:
+      - `pool_id`: unique id for this client, the pool of a shard is `pool_id:shard name`
+      - `shards`: dict of shard name to the `Client` kwargs of that shard, ie: host and port
+      - `shard_key` (optional): field the documents are sharded by
+      - `**kwargs`: passed to the `Client` of every shard, ie: `dbname`, `maxconnections`
+
+    Usage:
+        >>> db = asyncmongo.ShardedClient('users', {'a': dict(host='10.0.0.1', port=27017),
+        ...                                         'b': dict(host='10.0.0.2', port=27017)},
+        ...                               shard_key='user_id', dbname='app')
+        >>> db.events.find({'user_id': 12}, callback=...)
+        >>> db.events.find({'type': 'login'}, sort=[('ts', -1)], limit=20, callback=...)
+    """
+    def __init__(self, pool_id, shards, shard_key='_id', **kwargs):
+        assert isinstance(shards, dict) and shards
+        assert isinstance(shard_key, (str, unicode))
+        self._shard_key = shard_key
+        self._shards = {}
+        for name, shard_kwargs in shards.items():
+            client_kwargs = dict(kwargs)
+            client_kwargs.update(shard_kwargs)
+            self._shards[name] = Client(pool_id="%s:%s" % (pool_id, name), **client_kwargs)
+        self._ring = HashRing(sorted(self._shards))
+
+    def __getattr__(self, name):
+        """Get a collection by name."""
+        return self.connection(name)
+
+    def __getitem__(self, name):
+        """Get a collection by name."""
+        return self.connection(name)
+
+    def connection(self, collectionname, dbname=None):
+        """Get a `ShardedCursor` to a collection by name, see `Client.connection`"""
+        cursors = dict((name, client.connection(collectionname, dbname))
+                       for name, client in self._shards.items())
+        return ShardedCursor(cursors, self._ring, self._shard_key)
+
+    def shard(self, value):
+        """name of the shard documents with `value` as their shard key are on"""
+        return self._ring.node(bson.BSON.encode({'k': value}))
+
+
+class ShardedCursor(object):
+    """a collection on all shards, see `ShardedClient`"""
+    def __init__(self, cursors, ring, shard_key):
+        self._cursors = cursors
+        self._ring = ring
+        self._shard_key = shard_key
+
+    def _shard(self, spec):
+        """the shard a spec is limited to, or None when it may match documents on any shard"""
+        if not isinstance(spec, dict) or self._shard_key not in spec:
+            return None
+        value = spec[self._shard_key]
+        if isinstance(value, dict) and [key for key in value if key.startswith('$')]:
+            # an operator like $in or $gt, the documents can be anywhere
+            return None
+        return self._ring.node(bson.BSON.encode({'k': value}))
+
+    def save(self, doc, **kwargs):
+        assert isinstance(doc, dict)
+        self.insert(doc, **kwargs)
+
+    def insert(self, doc_or_docs, callback=None, **kwargs):
+        """Insert documents, each on the shard of its shard key; see `cursor.Cursor.insert`
+
+        With documents for several shards `callback` gets the first error, or the reply
+        of the last shard. Documents without an `_id` get one, as with pymongo.
+        """
+        docs = isinstance(doc_or_docs, dict) and [doc_or_docs] or doc_or_docs
+        by_shard = {}
+        for doc in docs:
+            if self._shard_key == '_id' and '_id' not in doc:
+                # the server would add one, but the shard is picked by it
+                doc['_id'] = ObjectId()
+            shard = self._shard(doc)
+            if shard is None:
+                raise DataError("documents need a plain %r to be inserted" % self._shard_key)
+            by_shard.setdefault(shard, []).append(doc)
+        gather = _gather(len(by_shard), callback)
+        for shard, docs in by_shard.items():
+            self._cursors[shard].insert(docs, callback=gather, **kwargs)
+
+    def update(self, spec, document, upsert=False, multi=False, callback=None, **kwargs):
+        """Update documents; on every shard unless `spec` has a plain shard key, see
+        `cursor.Cursor.update`
+
+        Without a shard key only `multi` updates are allowed, as each shard would update
+        a document of its own.
+        """
+        shard = self._shard(spec)
+        if shard is not None:
+            self._cursors[shard].update(spec, document, upsert=upsert, multi=multi, callback=callback, **kwargs)
+            return
+        if upsert:
+            raise DataError("upserts need a plain %r in the spec" % self._shard_key)
+        if not multi:
+            raise DataError("updates without a plain %r in the spec need multi=True" % self._shard_key)
+        gather = _gather(len(self._cursors), callback)
+        for cursor in self._cursors.values():
+            cursor.update(spec, document, multi=True, callback=gather, **kwargs)
+
+    def remove(self, spec_or_id=None, callback=None, **kwargs):
+        """Remove documents; from every shard unless the spec has a plain shard key, see
+        `cursor.Cursor.remove`"""
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {"_id": spec_or_id}
+        shard = self._shard(spec_or_id)
+        if shard is not None:
+            self._cursors[shard].remove(spec_or_id, callback=callback, **kwargs)
+            return
+        gather = _gather(len(self._cursors), callback)
+        for cursor in self._cursors.values():
+            cursor.remove(spec_or_id, callback=gather, **kwargs)
+
+    def find_one(self, spec_or_id, **kwargs):
+        """Get a single document, see `cursor.Cursor.find_one`"""
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {"_id": spec_or_id}
+        kwargs['limit'] = -1
+        self.find(spec_or_id, **kwargs)
+
+    def find(self, spec=None, skip=0, limit=0, sort=None, callback=None, **kwargs):
+        """Query the shard of the spec's shard key, or all of them; see `cursor.Cursor.find`
+
+        Every shard is asked for up to `skip` + `limit` documents in `sort` order, the
+        replies are merged and `skip` and `limit` applied to the merged list. A negative
+        `limit` gets a single batch from every shard.
+        """
+        if not callable(callback):
+            raise TypeError("callback must be callable")
+        shard = self._shard(spec)
+        if shard is not None:
+            self._cursors[shard].find(spec, skip=skip, limit=limit, sort=sort, callback=callback, **kwargs)
+            return
+        if limit is None:
+            limit = 0
+        # find_one (-1) gets a single document from every shard, no cursors are left open
+        if limit == -1:
+            shard_limit = -1
+        elif limit < 0:
+            shard_limit = -(skip - limit)
+        else:
+            shard_limit = limit and skip + limit
+        state = dict(pending=len(self._cursors), results=[], error=None)
+        merge = partial(self._merged, state, skip, limit, sort, callback)
+        for cursor in self._cursors.values():
+            cursor.find(spec, skip=0, limit=shard_limit, sort=sort, callback=merge, **kwargs)
+
+    def _merged(self, state, skip, limit, sort, callback, response, error=None):
+        state['pending'] -= 1
+        if error:
+            state['error'] = state['error'] or error
+        elif limit == -1:
+            # a shard without a match answers with an empty list
+            if isinstance(response, dict):
+                state['results'].append(response)
+        else:
+            state['results'].extend(response)
+        if state['pending']:
+            return
+        if state['error']:
+            callback(None, error=state['error'])
+            return
+        results = state['results']
+        if sort:
+            results.sort(cmp=partial(_compare, helpers._index_document(sort).items()))
+        if limit == -1:
+            callback(results and results[0] or None, error=None)
+            return
+        results = results[skip:]
+        if limit:
+            results = results[:abs(limit)]
+        callback(results, error=None)
+
+
+def _gather(count, callback):
+    """a callback for `count` requests that calls `callback` once all of them answered, with
+    their getlasterror replies added up"""
+    if callback is None:
+        return None
+    return partial(_gathered, dict(pending=count, error=None, reply=None, n=0, updated=False), callback)
+
+
+def _gathered(state, callback, response, error=None):
+    state['pending'] -= 1
+    if error:
+        logging.debug('shard request failed: %s' % error)
+        state['error'] = state['error'] or error
+    for reply in response or []:
+        state['reply'] = state['reply'] or dict(reply)
+        state['n'] += reply.get('n', 0)
+        state['updated'] = state['updated'] or reply.get('updatedExisting', False)
+    if state['pending']:
+        return
+    response = None
+    if state['reply'] is not None:
+        reply = state['reply']
+        reply['n'] = state['n']
+        if 'updatedExisting' in reply:
+            reply['updatedExisting'] = state['updated']
+        response = [reply]
+    callback(response, error=state['error'])
+
+
+def _compare(ordering, a, b):
+    """compare two documents by a list of (key, direction), dotted keys go into subdocuments"""
+    for key, direction in ordering:
+        result = cmp(_field(a, key), _field(b, key))
+        if result:
+            return direction < 0 and -result or result
+    return 0
+
+
+def _field(doc, key):
+    for part in key.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
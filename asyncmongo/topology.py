@@ -0,0 +1,472 @@
+#!/bin/env python
+#
+# Copyright 2014 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import time
+import json
+import random
+import calendar
+import logging
+from functools import partial
+from bson import SON
+
+import message
+import helpers
+from errors import RSConnectionError, NotMasterError
+from connection import Connection
+from backends import load_backend
+
+UNKNOWN = 'unknown'
+PRIMARY = 'primary'
+SECONDARY = 'secondary'
+ARBITER = 'arbiter'
+OTHER = 'other'
+DOWN = 'down'
+
+# read preferences, a request goes to
+PRIMARY_PREFERRED = 'primaryPreferred' # the primary, or a secondary while there is none
+SECONDARY_PREFERRED = 'secondaryPreferred' # a secondary, or the primary while there is none
+NEAREST = 'nearest' # the primary or a secondary, whichever is closer
+# PRIMARY and SECONDARY send it to that kind of member only
+READ_PREFERENCES = (PRIMARY, PRIMARY_PREFERRED, SECONDARY, SECONDARY_PREFERRED, NEAREST)
+
+
+class Member(object):
+    """a replica set member as the last heartbeat saw it"""
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.state = UNKNOWN
+        self.hidden = False
+        self.tags = {}
+        self.rtt = None # seconds, moving average of the ismaster round trips
+        self.updated = None
+        self.error = None
+        self.last_write = None # time of the member's last write, from ismaster
+        self.optime = None # time of the member's last write, from replSetGetStatus
+        self.lag = None # estimated seconds the member is behind the primary
+
+    @property
+    def address(self):
+        return (self.host, self.port)
+
+    def describe(self):
+        return dict(host=self.host, port=self.port, state=self.state, hidden=self.hidden,
+                    tags=self.tags, rtt=self.rtt, updated=self.updated, lag=self.lag,
+                    error=self.error and str(self.error))
+
+    def __repr__(self):
+        return "Member %s:%s, state = %s" % (self.host, self.port, self.state)
+
+
+class TopologyMonitor(object):
+    """
+    Keeps track of the members of a replica set for a connection pool. Every
+    `heartbeat_interval` seconds all members are sent an ismaster on a connection of their
+    own, new members are discovered from the replies and the member table is updated, so
+    the pool's connections can connect straight to the member they need.
+
+    :Parameters:
+      - `seed`: list of (host, port) to discover the replica set from
+      - `rs`: replica set name
+      - `heartbeat_interval` (optional): seconds between heartbeats
+      - `backend` (optional): async loop backend, default = tornado
+      - `connect_timeout` (optional): seconds to wait for a monitor connection to be established
+      - `cache_file` (optional): path of a file the member table is saved to after the heartbeat
+         rounds that changed it. A new monitor (ie: in a new process) starts from the saved table,
+         so requests go to the last known primary right away while the first round checks it
+      - `cache_ttl` (optional): seconds a saved member table is used for
+      - `**kwargs`: passed to `connection.Connection` for the monitor connections, ie: `io_loop`
+    """
+    # weight of the latest round trip in the moving average
+    RTT_ALPHA = 0.2
+
+    def __init__(self, seed, rs, heartbeat_interval=10, backend="tornado", connect_timeout=None,
+                 cache_file=None, cache_ttl=300, **kwargs):
+        assert isinstance(seed, (set, list))
+        assert isinstance(rs, str)
+        assert isinstance(heartbeat_interval, (int, float)) and heartbeat_interval > 0
+        assert isinstance(cache_file, (str, unicode, None.__class__))
+        assert isinstance(cache_ttl, (int, float))
+        self.rs = rs
+        self._heartbeat_interval = heartbeat_interval
+        self._backend_name = backend
+        self._backend = load_backend(backend)
+        self._connect_timeout = connect_timeout
+        self._kwargs = kwargs
+        self.members = {} # (host, port) -> Member
+        for host in seed:
+            self.members[tuple(host)] = Member(*host)
+        self._connections = {} # (host, port) -> monitor connection
+        self._pending = set() # members whose heartbeat of the current round is outstanding
+        self._rerun = False
+        self._timeout = None
+        self._waiters = [] # [select, callback] waiting for a member to show up
+        self._listeners = []
+        self._started = False
+        self._pid = os.getpid()
+        self.rounds = 0
+        self._cache_file = cache_file
+        self._cache_ttl = cache_ttl
+        self._saved = (None, 0) # (member table, time) last written to the cache file
+        if cache_file:
+            self._load()
+
+    # the monitor connections use the monitor as their pool
+    _dbname = None
+
+    def cache(self, con):
+        pass
+
+    def start(self):
+        """start the heartbeats, if they aren't running yet"""
+        if self._pid != os.getpid():
+            self._after_fork()
+        if not self._started:
+            self._started = True
+            self.refresh()
+
+    def _after_fork(self):
+        # the parent keeps using the monitor connections, drop them without closing
+        self._pid = os.getpid()
+        self._connections = {}
+        self._pending = set()
+        self._rerun = False
+        self._timeout = None
+        self._waiters = []
+        self._started = False
+
+    def add_listener(self, callback):
+        """call `callback(monitor)` after every heartbeat round"""
+        self._listeners.append(callback)
+
+    def refresh(self):
+        """send a round of heartbeats now instead of at the next interval"""
+        if self._pending:
+            self._rerun = True
+            return
+        if self._timeout is not None:
+            self._backend.remove_timeout(self._timeout, io_loop=self._kwargs.get('io_loop'))
+            self._timeout = None
+        self._pending = set(self.members)
+        for address in list(self._pending):
+            self._heartbeat(address)
+
+    def _scheduled_round(self):
+        self._timeout = None
+        self.refresh()
+
+    def _heartbeat(self, address):
+        con = self._connections.get(address)
+        if con is None:
+            # pipelined, so replSetGetStatus doesn't have to wait for the heartbeat
+            con = Connection(host=address[0], port=address[1], pool=self, backend=self._backend_name,
+                             connect_timeout=self._connect_timeout, pipelined=True, **self._kwargs)
+            self._connections[address] = con
+        msg = message.query(0, "admin.$cmd", 0, -1, SON([("ismaster", 1)]))
+        start = time.time()
+        try:
+            con.send_message(msg, callback=partial(self._on_ismaster, address, start))
+        except Exception, e:
+            self._on_ismaster(address, start, None, e)
+
+    def _on_ismaster(self, address, start, response, error=None):
+        member = self.members.get(address)
+        if not error:
+            try:
+                assert len(response["data"]) == 1
+                res = response["data"][0]
+            except Exception:
+                error = RSConnectionError("Invalid response data: %r" % (response and response.get("data")))
+        if not error and res.get("setName") and res["setName"] != self.rs:
+            error = RSConnectionError("Wrong replica set: %s, expected: %s" % (res["setName"], self.rs))
+
+        if member is not None:
+            if error:
+                logging.debug("Heartbeat to %s:%s failed: %s", address[0], address[1], error)
+                self._mark_down(member, error)
+            else:
+                self._update(member, res, time.time() - start)
+            self._check_waiters()
+
+        self._pending.discard(address)
+        if not self._pending:
+            self._round_done()
+
+    def _update(self, member, res, rtt):
+        """update `member` from its ismaster reply and discover the members it knows about"""
+        if member.rtt is None:
+            member.rtt = rtt
+        else:
+            member.rtt += self.RTT_ALPHA * (rtt - member.rtt)
+        member.hidden = bool(res.get("hidden"))
+        member.tags = res.get("tags") or {}
+        member.updated = time.time()
+        member.error = None
+        last_write = res.get("lastWrite", {}).get("lastWriteDate")
+        member.last_write = last_write and _timestamp(last_write)
+        if res.get("ismaster"):
+            for other in self.members.values():
+                if other.state == PRIMARY and other is not member:
+                    # stepped down, its next heartbeat tells what it is now
+                    other.state = UNKNOWN
+            member.state = PRIMARY
+        elif res.get("secondary"):
+            member.state = SECONDARY
+        elif res.get("arbiterOnly"):
+            member.state = ARBITER
+        else:
+            member.state = OTHER
+
+        hosts = res.get("hosts", []) + res.get("passives", [])
+        if res.get("primary"):
+            hosts.append(res["primary"])
+        for host in hosts:
+            address = helpers._parse_host(host)
+            if address not in self.members:
+                logging.debug("Discovered replica set member %s:%s", *address)
+                self.members[address] = Member(*address)
+                self._pending.add(address)
+                self._heartbeat(address)
+
+    def _mark_down(self, member, error):
+        member.state = DOWN
+        member.error = error
+        con = self._connections.pop(member.address, None)
+        if con is not None:
+            con.close()
+
+    def member_failed(self, address, error):
+        """a request to `address` failed with a "not master" reply or a broken connection;
+        keep requests away from the member and send a round of heartbeats now instead of
+        waiting for the next interval to find out what happened"""
+        member = self.members.get(address)
+        if member is None or member.state in (UNKNOWN, DOWN):
+            # already marked by an earlier failure, the round it started tells the rest
+            return
+        logging.debug("Request to %s:%s failed: %s", address[0], address[1], error)
+        if isinstance(error, NotMasterError):
+            # still up, but no longer the primary
+            member.state = UNKNOWN
+            member.error = error
+        else:
+            self._mark_down(member, error)
+        self.refresh()
+
+    def _round_done(self):
+        self.rounds += 1
+        self._update_lag()
+        if self._cache_file:
+            self._save()
+        for listener in self._listeners:
+            try:
+                listener(self)
+            except Exception:
+                logging.exception("Error in topology listener")
+        self._check_waiters(final=True)
+        if self._rerun:
+            self._rerun = False
+            self.refresh()
+            return
+        self._timeout = self._backend.add_timeout(self._heartbeat_interval, self._scheduled_round,
+                                                  io_loop=self._kwargs.get('io_loop'))
+
+    def _load(self):
+        """start from the member table in the cache file, if it is recent and of this replica set"""
+        try:
+            f = open(self._cache_file)
+            try:
+                cached = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError), e:
+            logging.debug("Not using topology cache %s: %s", self._cache_file, e)
+            return
+        if cached.get("setName") != self.rs or cached.get("saved", 0) + self._cache_ttl < time.time():
+            return
+        for saved in cached["members"]:
+            member = Member(str(saved["host"]), saved["port"])
+            member.state = saved["state"]
+            member.hidden = saved["hidden"]
+            member.tags = saved["tags"]
+            member.rtt = saved["rtt"]
+            self.members[member.address] = member
+        logging.debug("Loaded replica set %s from %s, primary: %s", self.rs, self._cache_file, cached.get("primary"))
+
+    def _save(self):
+        """write the member table to the cache file if it changed, or once half its ttl passed"""
+        members = sorted(self.members.values(), key=lambda m: m.address)
+        table = [(m.address, m.state, m.hidden, m.tags) for m in members]
+        now = time.time()
+        if table == self._saved[0] and self._saved[1] + self._cache_ttl / 2.0 > now:
+            return
+        primary = self.primary()
+        cached = dict(setName=self.rs, saved=now, primary=primary and "%s:%s" % primary.address,
+                      members=[dict(host=m.host, port=m.port, state=m.state, hidden=m.hidden,
+                                    tags=m.tags, rtt=m.rtt) for m in members])
+        # written next to it and renamed, so other processes only ever read a complete file
+        tmp = "%s.%d.tmp" % (self._cache_file, os.getpid())
+        try:
+            f = open(tmp, "w")
+            try:
+                json.dump(cached, f)
+            finally:
+                f.close()
+            os.rename(tmp, self._cache_file)
+        except (IOError, OSError), e:
+            logging.warning("Failed to save topology cache %s: %s", self._cache_file, e)
+            return
+        self._saved = (table, now)
+
+    def _update_lag(self):
+        """estimate how far each secondary is behind the primary"""
+        primary = self.primary()
+        members = [m for m in self.members.values() if m.state in (PRIMARY, SECONDARY)]
+        writes = [m.last_write for m in members if m.last_write is not None]
+        need_status = False
+        for member in members:
+            if member.state == PRIMARY:
+                member.lag = 0
+            elif member.last_write is not None:
+                if primary and primary.last_write is not None:
+                    # both replied at different times, so compare how old their last writes were
+                    member.lag = max((member.updated - member.last_write) -
+                                     (primary.updated - primary.last_write), 0)
+                else:
+                    member.lag = max(writes) - member.last_write
+            else:
+                # servers before 3.4 don't report lastWrite, ask the primary for all optimes
+                need_status = True
+                if primary and primary.optime is not None and member.optime is not None:
+                    member.lag = max(primary.optime - member.optime, 0)
+        con = primary and self._connections.get(primary.address)
+        if need_status and con is not None:
+            msg = message.query(0, "admin.$cmd", 0, -1, SON([("replSetGetStatus", 1)]))
+            try:
+                con.send_message(msg, callback=self._on_status)
+            except Exception, e:
+                logging.debug("replSetGetStatus failed: %s", e)
+
+    def _on_status(self, response, error=None):
+        try:
+            if error:
+                raise error
+            res = response["data"][0]
+            assert res.get("ok") == 1, res.get("errmsg")
+            for status in res["members"]:
+                member = self.members.get(helpers._parse_host(status["name"]))
+                if member is not None and status.get("optimeDate"):
+                    member.optime = _timestamp(status["optimeDate"])
+        except Exception, e:
+            # ie: the monitor connections aren't authorized to run it
+            logging.debug("replSetGetStatus failed: %s", e)
+            return
+        primary = self.primary()
+        for member in self.secondaries():
+            if member.last_write is None and primary and primary.optime is not None and member.optime is not None:
+                member.lag = max(primary.optime - member.optime, 0)
+
+    def wait_for(self, select, callback):
+        """call `callback(member, None)` with the first member `select(monitor)` returns, or
+        `callback(None, RSConnectionError)` if a whole heartbeat round didn't turn one up"""
+        member = select(self)
+        if member is not None:
+            callback(member, None)
+            return
+        self._waiters.append([select, callback])
+        self.start()
+        if not self._pending:
+            self.refresh()
+
+    def _check_waiters(self, final=False):
+        for waiter in list(self._waiters):
+            select, callback = waiter
+            member = select(self)
+            if member is None and not final:
+                continue
+            self._waiters.remove(waiter)
+            if member is None:
+                callback(None, RSConnectionError("No suitable member of replica set %s, tried: %s" %
+                                                 (self.rs, sorted(self.members))))
+            else:
+                callback(member, None)
+
+    def primary(self):
+        """the primary, or None"""
+        for member in self.members.values():
+            if member.state == PRIMARY:
+                return member
+        return None
+
+    def secondaries(self):
+        """the secondaries that take reads, hidden members don't"""
+        return [member for member in self.members.values()
+                if member.state == SECONDARY and not member.hidden]
+
+    def select(self, read_preference=PRIMARY, tag_sets=None, local_threshold=0.015, max_staleness=None,
+               exclude=()):
+        """a member to send a request to, or None
+
+        :Parameters:
+          - `read_preference` (optional): one of `READ_PREFERENCES`
+          - `tag_sets` (optional): list of tag dicts, a secondary (or with `NEAREST` any member)
+            is only picked if it has all tags of the first tag set some member matches
+          - `local_threshold` (optional): seconds of round trip time, a random member of those
+            at most this much slower than the fastest one is picked
+          - `max_staleness` (optional): seconds a secondary may be behind the primary to be
+            picked. Secondaries whose lag isn't known yet are picked
+          - `exclude` (optional): (host, port) of members not to pick
+        """
+        assert read_preference in READ_PREFERENCES, "unknown read preference %r" % read_preference
+        primary = self.primary()
+        if primary and primary.address in exclude:
+            primary = None
+        if read_preference == PRIMARY:
+            return primary
+        secondaries = [member for member in self.secondaries() if member.address not in exclude]
+        if max_staleness is not None:
+            secondaries = [member for member in secondaries
+                           if member.lag is None or member.lag <= max_staleness]
+        if read_preference == PRIMARY_PREFERRED:
+            return primary or self._nearest(secondaries, tag_sets, local_threshold)
+        if read_preference == SECONDARY:
+            return self._nearest(secondaries, tag_sets, local_threshold)
+        if read_preference == SECONDARY_PREFERRED:
+            return self._nearest(secondaries, tag_sets, local_threshold) or primary
+        candidates = secondaries
+        if primary:
+            candidates.append(primary)
+        return self._nearest(candidates, tag_sets, local_threshold)
+
+    def _nearest(self, members, tag_sets, local_threshold):
+        for tags in tag_sets or [{}]:
+            matching = [member for member in members
+                        if all(member.tags.get(key) == value for key, value in tags.items())]
+            if matching:
+                break
+        else:
+            return None
+        fastest = min(member.rtt for member in matching)
+        return random.choice([member for member in matching if member.rtt <= fastest + local_threshold])
+
+    def describe(self):
+        """the member table"""
+        return [member.describe() for member in sorted(self.members.values(), key=lambda m: m.address)]
+
+
+def _timestamp(date):
+    """seconds since the epoch of a naive UTC datetime as bson decodes it"""
+    return calendar.timegm(date.utctimetuple()) + date.microsecond / 1e6
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of the per request overhead of the connection pool, with and without locking.
+
+Connections are replaced by stubs that answer right away, so only the pool and cursor
+bookkeeping is measured, no network or mongod is involved.
+
+    python test/bench_pool.py [iterations]
+"""
+
+import sys
+import os
+import time
+app_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if app_dir not in sys.path:
+    sys.path.insert(0, app_dir)
+
+from asyncmongo.pool import ConnectionPool
+from asyncmongo.cursor import Cursor
+
+
+class StubConnection(object):
+    """answers every message at once and goes back to the pool, like a connection to a fast mongod"""
+    def __init__(self, pool):
+        self.pool = pool
+        self._host, self._port = '127.0.0.1', 27017
+        self.usage_count = 0
+        self.in_flight = 0
+        self.idle_since = None
+
+    def send_message(self, message, callback):
+        self.usage_count += 1
+        self.pool.cache(self)
+        if callback:
+            callback({'data': [{'_id': 1}], 'cursor_id': 0})
+
+    def _close(self):
+        pass
+
+    def close(self):
+        self.pool.cache(self)
+
+
+class StubPool(ConnectionPool):
+    def new_connection(self):
+        return StubConnection(self)
+
+
+def done(response, error=None):
+    pass
+
+
+def bench(name, iterations, threadsafe, operation):
+    pool = StubPool(maxconnections=10, dbname='test', threadsafe=threadsafe)
+    cursor = Cursor('test', 'bench', pool)
+    start = time.time()
+    for i in xrange(iterations):
+        operation(pool, cursor)
+    elapsed = time.time() - start
+    print '%-10s threadsafe=%-5s %8.2f usec/op' % (name, threadsafe, elapsed / iterations * 1e6)
+    return elapsed
+
+
+def checkout(pool, cursor):
+    pool.cache(pool.connection())
+
+
+def find(pool, cursor):
+    cursor.find_one({'_id': 1}, callback=done)
+
+
+def insert(pool, cursor):
+    cursor.insert({'_id': 1}, callback=done)
+
+
+if __name__ == '__main__':
+    iterations = len(sys.argv) > 1 and int(sys.argv[1]) or 100000
+    for name, operation in (('checkout', checkout), ('find', find), ('insert', insert)):
+        locked = bench(name, iterations, True, operation)
+        unlocked = bench(name, iterations, False, operation)
+        print '%-10s saved %.2f usec/op (%.0f%%)' % (name, (locked - unlocked) / iterations * 1e6,
+                                                  (locked - unlocked) / locked * 100)
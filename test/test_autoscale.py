@@ -0,0 +1,53 @@
+import unittest
+
+import tornado.ioloop
+
+from asyncmongo.autoscale import Autoscaler
+from asyncmongo.pool import ConnectionPool
+
+
+class AutoscaleTest(unittest.TestCase):
+    def setUp(self):
+        # connections are only opened when a message is sent, so none of this touches the network
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.autoscale = Autoscaler(2, 6, grow_step=2, hysteresis=2)
+        self.pool = ConnectionPool(maxconnections=4, maxcached=4, autoscale=self.autoscale,
+                                   host='127.0.0.1', port=27018, dbname='test', io_loop=self.io_loop)
+
+    def test_grow(self):
+        connections = [self.pool.connection() for i in range(4)]
+        # a single busy evaluation is not enough
+        self.assertEqual(None, self.autoscale.evaluate())
+        self.assertEqual(4, self.pool._maxconnections)
+        self.assertEqual('grow', self.autoscale.evaluate())
+        self.assertEqual(6, self.pool._maxconnections)
+        connections.append(self.pool.connection())
+
+        # already at the upper bound
+        connections.append(self.pool.connection())
+        self.autoscale.evaluate()
+        self.assertEqual(None, self.autoscale.evaluate())
+        self.assertEqual(6, self.pool._maxconnections)
+        for con in connections:
+            self.pool.cache(con)
+
+    def test_shrink(self):
+        connections = [self.pool.connection() for i in range(4)]
+        for con in connections:
+            self.pool.cache(con)
+        self.autoscale.evaluate() # the peak of the checkouts above
+        self.assertEqual(None, self.autoscale.evaluate())
+        self.assertEqual('shrink', self.autoscale.evaluate())
+        stats = self.pool.stats()
+        self.assertEqual(3, stats['maxconnections'])
+        # idle connections beyond the smaller pool are closed
+        self.assertEqual(3, stats['idle'])
+        self.assertEqual(1, stats['autoscale']['shrinks'])
+        self.assertEqual('shrink', stats['autoscale']['decisions'][-1][1])
+
+        self.autoscale.evaluate()
+        self.autoscale.evaluate()
+        self.assertEqual(2, self.pool._maxconnections)
+        self.autoscale.evaluate()
+        self.assertEqual(None, self.autoscale.evaluate())
+        self.assertEqual(2, self.pool._maxconnections)
@@ -0,0 +1,70 @@
+import unittest
+import time
+import tornado.ioloop
+
+import asyncmongo
+from asyncmongo import breaker
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_open_and_probe(self):
+        b = breaker.CircuitBreaker('a', 27017, threshold=2, backoff=1, max_backoff=4)
+        b.failed()
+        self.assertEqual(breaker.CLOSED, b.state)
+        b.failed()
+        self.assertEqual(breaker.OPEN, b.state)
+        self.assert_(0.5 <= b.retry_in() <= 1)
+        self.assertEqual(False, b.allow())
+
+        # one probe once the backoff passed
+        b.retry_at = time.time()
+        self.assertEqual(True, b.allow())
+        self.assertEqual(breaker.HALF_OPEN, b.state)
+        self.assertEqual(False, b.allow())
+        self.assertEqual(2, b.rejected)
+
+        # a failed probe opens it for longer
+        b.failed()
+        self.assertEqual(breaker.OPEN, b.state)
+        self.assert_(1 <= b.retry_in() <= 2)
+        b.retry_at = time.time()
+        b.allow()
+        b.failed()
+        b.retry_at = time.time()
+        b.allow()
+        b.failed()
+        self.assert_(2 <= b.retry_in() <= 4)
+
+        b.retry_at = time.time()
+        b.allow()
+        b.succeeded()
+        self.assertEqual(breaker.CLOSED, b.state)
+        self.assertEqual(True, b.allow())
+
+
+class PoolBreakerTest(unittest.TestCase):
+    def test_fail_fast(self):
+        """
+        Once a connect to a host failed, the next requests fail right away.
+        """
+        loop = tornado.ioloop.IOLoop()
+        # nothing listens there
+        db = asyncmongo.Client(pool_id='testbreaker', host='127.0.0.1', port=27099, dbname='test',
+                               breaker_threshold=1, breaker_backoff=60, breaker_max_backoff=60, io_loop=loop)
+        errors = []
+        def callback(response, error):
+            errors.append(error)
+            loop.stop()
+
+        db.test_breaker.find_one({}, callback=callback)
+        loop.start()
+        db.test_breaker.find_one({}, callback=callback)
+        loop.start()
+
+        self.assertEqual(2, len(errors))
+        self.assert_(isinstance(errors[1], asyncmongo.InterfaceError))
+        self.assert_('circuit breaker open' in str(errors[1]), errors)
+        self.assert_('circuit breaker open' not in str(errors[0]), errors)
+        stats = db._pool.stats()['breakers']
+        self.assertEqual('open', stats[0]['state'])
+        self.assertEqual(1, stats[0]['rejected'])
@@ -4,7 +4,7 @@ import time
 
 import test_shunt
 import asyncmongo
-from asyncmongo.errors import DataError
+from asyncmongo.errors import DataError, InterfaceError
 
 TEST_TIMESTAMP = int(time.time())
 
@@ -57,3 +57,19 @@ class ConnectionTest(test_shunt.MongoTest):
         
         tornado.ioloop.IOLoop.instance().start()
         test_shunt.assert_called("got_record")
+
+    def test_connect_error(self):
+        test_shunt.setup()
+        db = asyncmongo.Client(pool_id='test_connect_error', host='127.0.0.1', port=27099, dbname='test',
+                               connect_timeout=1)
+
+        def callback(response, error):
+            tornado.ioloop.IOLoop.instance().stop()
+            assert response is None
+            assert isinstance(error, InterfaceError)
+            test_shunt.register_called('connect_error')
+
+        # connecting happens on the IOLoop, so nothing is raised here
+        db.test_users.find_one({}, callback=callback)
+        tornado.ioloop.IOLoop.instance().start()
+        test_shunt.assert_called('connect_error')
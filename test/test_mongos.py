@@ -0,0 +1,96 @@
+import unittest
+import time
+import tornado.ioloop
+
+import test_shunt
+import asyncmongo
+from asyncmongo.pool import MongosConnectionPool
+from asyncmongo.autoscale import Autoscaler
+
+A = ('a', 27017)
+B = ('b', 27017)
+
+
+class BalanceTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = MongosConnectionPool([A, B], dbname='test', io_loop=tornado.ioloop.IOLoop())
+        self.routers = self.pool._routers
+
+    def test_least_outstanding(self):
+        self.routers[A].pool._connections = 3
+        self.routers[B].pool._connections = 1
+        self.assertEqual(B, self.pool._pick().address)
+        self.routers[B].pool._waiting = 5
+        self.assertEqual(A, self.pool._pick().address)
+        self.assertEqual(B, self.pool._pick(exclude=[A]).address)
+
+    def test_latency(self):
+        self.pool._balance = 'latency'
+        self.routers[A].rtt = 0.010
+        self.routers[B].rtt = 0.002
+        self.routers[B].pool._connections = 3
+        self.assertEqual(B, self.pool._pick().address)
+
+    def test_eject(self):
+        self.assertEqual(True, self.pool.member_failed(A, asyncmongo.InterfaceError('connection closed')))
+        self.assertEqual(set([B]), set(self.pool._pick().address for i in range(20)))
+
+        # a ping before the time is up doesn't take it back
+        self.pool._on_ping(self.routers[A], time.time(), {'data': [{'ok': 1}]})
+        self.assertEqual(1, self.routers[A].failures)
+        self.routers[A].ejected_until = time.time()
+        self.pool._on_ping(self.routers[A], time.time(), {'data': [{'ok': 1}]})
+        self.assertEqual(0, self.routers[A].failures)
+        self.routers[B].pool._connections = 5
+        self.assertEqual(A, self.pool._pick().address)
+
+    def test_autoscale(self):
+        # every router has a pool of its own, one Autoscaler can't size them all
+        self.assertRaises(AssertionError, MongosConnectionPool, [A, B], dbname='test',
+                          autoscale=Autoscaler(1, 5), io_loop=tornado.ioloop.IOLoop())
+
+    def test_all_ejected(self):
+        self.pool._on_ping(self.routers[A], time.time(), None, asyncmongo.InterfaceError('connection refused'))
+        self.pool._on_ping(self.routers[B], time.time(), None, asyncmongo.InterfaceError('connection refused'))
+        self.assert_(self.pool._pick().address in (A, B))
+
+
+class MongosTest(test_shunt.MongoTest):
+    def test_query(self):
+        """
+        Requests are spread over the routers and routers are pinged.
+        """
+        test_shunt.setup()
+        db = asyncmongo.Client(pool_id='testmongos', mongos=[('127.0.0.1', 27018), ('localhost', 27018)],
+                               dbname='test', ping_interval=0.1)
+        loop = tornado.ioloop.IOLoop.instance()
+
+        def insert_callback(response, error):
+            loop.stop()
+            assert error is None
+            test_shunt.register_called('inserted')
+
+        db.test_mongos.insert({'_id': 1}, callback=insert_callback)
+        loop.start()
+        test_shunt.assert_called('inserted')
+
+        def query_callback(response, error):
+            assert error is None
+            assert response['_id'] == 1
+            state['pending'] -= 1
+            if not state['pending']:
+                loop.stop()
+
+        # both are in use at the same time
+        state = dict(pending=2)
+        db.test_mongos.find_one({'_id': 1}, callback=query_callback)
+        db.test_mongos.find_one({'_id': 1}, callback=query_callback)
+        loop.start()
+
+        loop.add_timeout(time.time() + 0.3, loop.stop)
+        loop.start()
+        stats = db._pool.stats()
+        assert [router['rtt'] is not None for router in stats['routers']] == [True, True], stats
+        assert [pool['idle'] for pool in stats['pools'].values()] == [1, 1], stats
+        # stop pinging, the next tests restart mongod
+        db._pool._generation += 1
@@ -0,0 +1,66 @@
+import tornado.ioloop
+import logging
+import time
+
+import test_shunt
+import asyncmongo
+from asyncmongo.errors import TooManyConnections
+
+TEST_TIMESTAMP = int(time.time())
+
+class PipeliningTest(test_shunt.MongoTest):
+    def test_pipelining(self):
+        """
+        Many concurrent queries share a single pipelined connection, and each
+        reply makes it back to the callback of the query it answers.
+        """
+        test_shunt.setup()
+        db = asyncmongo.Client(pool_id='testpipelining', host='127.0.0.1', port=27018, dbname='test',
+                               maxconnections=1, max_in_flight=0)
+
+        def insert_callback(response, error):
+            tornado.ioloop.IOLoop.instance().stop()
+            assert len(response) == 1
+            test_shunt.register_called('inserted')
+
+        db.test_pipelining.insert([{"_id": i, "ts": TEST_TIMESTAMP} for i in range(20)], callback=insert_callback)
+        tornado.ioloop.IOLoop.instance().start()
+        test_shunt.assert_called('inserted')
+
+        results = {}
+        def query_callback(i, response, error):
+            assert error is None
+            assert response['_id'] == i
+            results[i] = response
+            if len(results) == 20:
+                tornado.ioloop.IOLoop.instance().stop()
+
+        for i in range(20):
+            db.test_pipelining.find_one({"_id": i},
+                callback=lambda response, error, i=i: query_callback(i, response, error))
+        assert db._pool._connections == 1
+
+        tornado.ioloop.IOLoop.instance().start()
+        assert len(results) == 20
+        assert db._pool._connections == 0
+        assert len(db._pool._idle_cache) == 1
+
+    def test_in_flight_limit(self):
+        db = asyncmongo.Client(pool_id='testpipelining_limit', host='127.0.0.1', port=27018, dbname='test',
+                               maxconnections=2, max_in_flight=2)
+
+        called = []
+        def callback(response, error):
+            assert error is None
+            called.append(response)
+            if len(called) == 4:
+                tornado.ioloop.IOLoop.instance().stop()
+
+        for i in range(4):
+            db.test_pipelining.find_one({"_id": i}, callback=callback)
+        assert db._pool._connections == 2
+        self.assertRaises(TooManyConnections,
+                          lambda: db.test_pipelining.find_one({"_id": 5}, callback=callback))
+
+        tornado.ioloop.IOLoop.instance().start()
+        assert len(called) == 4
@@ -1,7 +1,9 @@
 import tornado.ioloop
 import logging
 import time
-from asyncmongo.errors import TooManyConnections
+import threading
+import os
+from asyncmongo.errors import TooManyConnections, ProgrammingError
 
 import test_shunt
 import asyncmongo
@@ -66,3 +68,171 @@ class PooledDBTest(test_shunt.MongoTest):
             lambda: clients[2].connection('foo').find({}, callback=callback)
         )
 
+
+    def test_idle_reaper(self):
+        """
+        The most recently cached connection is reused first, and connections idle
+        for longer than max_idle_time are closed down to mincached.
+        """
+        client = asyncmongo.Client('id3', mincached=1, max_idle_time=0.1, host='127.0.0.1', port=27018, dbname='test')
+        pool = client._pool
+        connections = [pool.connection() for i in range(3)]
+        for con in connections:
+            pool.cache(con)
+        assert pool.stats()['idle'] == 3
+        con = pool.connection()
+        assert con is connections[-1]
+        pool.cache(con)
+
+        io_loop = tornado.ioloop.IOLoop.instance()
+        io_loop.add_timeout(time.time() + 0.3, io_loop.stop)
+        io_loop.start()
+        assert pool.stats()['idle'] == 1
+        assert pool.stats()['reaped'] == 2
+        assert pool.connection() is connections[-1]
+
+    def test_warm_up(self):
+        """
+        A warmed up pool has its mincached connections connected before the first request.
+        """
+        def ready_callback(error):
+            tornado.ioloop.IOLoop.instance().stop()
+            assert error is None
+            test_shunt.register_called('ready')
+
+        client = asyncmongo.Client('id4', mincached=2, warmup=True, ready_callback=ready_callback,
+                                   host='127.0.0.1', port=27018, dbname='test')
+        assert client._pool.stats()['connections'] == 2
+        tornado.ioloop.IOLoop.instance().start()
+        test_shunt.assert_called('ready')
+        stats = client._pool.stats()
+        assert stats['connections'] == 0
+        assert stats['idle'] == 2
+
+    def test_warm_up_error(self):
+        def ready_callback(error):
+            tornado.ioloop.IOLoop.instance().stop()
+            assert isinstance(error, asyncmongo.InterfaceError)
+            test_shunt.register_called('failed')
+
+        asyncmongo.Client('id5', mincached=1, warmup=True, ready_callback=ready_callback,
+                          host='127.0.0.1', port=27099, dbname='test')
+        tornado.ioloop.IOLoop.instance().start()
+        test_shunt.assert_called('failed')
+
+    def test_single_threaded(self):
+        client = asyncmongo.Client('id6', maxconnections=2, threadsafe=False, host='127.0.0.1', port=27018, dbname='test')
+        pool = client._pool
+        con = pool.connection()
+        pool.cache(con)
+        # a second return of the same connection is ignored
+        pool.cache(con)
+        assert pool.stats()['idle'] == 1
+        assert pool.stats()['connections'] == 0
+        assert pool.connection() is con
+
+    def test_partitioned(self):
+        """
+        Each thread gets its own partition of a partitioned pool, and maxconnections
+        is shared by all of them.
+        """
+        client = asyncmongo.Client('id7', maxconnections=2, partitioned=True, host='127.0.0.1', port=27018, dbname='test')
+        pool = client._pool
+        con = pool.connection()
+
+        other = []
+        def run():
+            client.bind_io_loop(tornado.ioloop.IOLoop())
+            other.append(pool.partition())
+            other.append(pool.connection())
+            try:
+                pool.connection()
+            except TooManyConnections:
+                other.append('limit')
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+
+        assert other[0] is not pool.partition()
+        assert other[2] == 'limit'
+        stats = pool.stats()
+        assert stats['partitions'] == 2
+        assert stats['connections'] == 2
+        other[0].cache(other[1])
+        pool.partition().cache(con)
+        assert pool.stats()['idle'] == 2
+
+    def test_partitioned_thread_loop(self):
+        """
+        A thread sends its queries on its own IOLoop, threads that didn't bind one can't send any.
+        """
+        client = asyncmongo.Client('id9', partitioned=True, host='127.0.0.1', port=27018, dbname='test')
+        results = []
+        def run():
+            try:
+                client.test_partitioned.find_one({}, callback=lambda response, error: None)
+            except ProgrammingError:
+                results.append('unbound')
+            loop = tornado.ioloop.IOLoop()
+            client.bind_io_loop(loop)
+            def query_callback(response, error):
+                results.append((response, error))
+                loop.stop()
+            def insert_callback(response, error):
+                client.test_partitioned.find_one({'_id': 1}, callback=query_callback)
+            client.test_partitioned.insert({'_id': 1}, callback=insert_callback)
+            loop.add_timeout(time.time() + 5, loop.stop)
+            loop.start()
+            results.append(client._pool.partition()._kwargs['io_loop'] is loop)
+            loop.close()
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+
+        assert results == ['unbound', ({'_id': 1}, None), True], results
+        # nothing was registered on the global IOLoop
+        assert client._pool.partition()._kwargs.get('io_loop') is None
+
+    def test_partitioned_thread_timers(self):
+        """
+        Cursor kills and timers of a thread run on the thread's own IOLoop.
+        """
+        client = asyncmongo.Client('id10', partitioned=True, host='127.0.0.1', port=27018, dbname='test')
+        results = []
+        def run():
+            loop = tornado.ioloop.IOLoop()
+            client.bind_io_loop(loop)
+            cursor = client.test_partitioned
+            cursor._kill_cursor(12345, None)
+            cursor._add_timeout(0.01, loop.stop)
+            loop.add_timeout(time.time() + 5, loop.stop)
+            loop.start()
+            reaper = asyncmongo.cursor._reapers[client._pool.partition()]
+            results.append(reaper._pending)
+            loop.close()
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+
+        assert results == [{}], results
+
+    def test_fork(self):
+        """
+        A forked child drops the connections it inherited and opens its own.
+        """
+        client = asyncmongo.Client('id8', mincached=1, host='127.0.0.1', port=27018, dbname='test')
+        pool = client._pool
+        inherited = pool._idle_cache[-1]
+        pid = os.fork()
+        if not pid:
+            try:
+                con = pool.connection()
+                assert con is not inherited
+                assert pool.stats()['connections'] == 1
+                pool.cache(con)
+                assert pool.stats()['idle'] == 1
+            except BaseException:
+                os._exit(1)
+            os._exit(0)
+        assert os.waitpid(pid, 0)[1] == 0
+        assert pool.connection() is inherited
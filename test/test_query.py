@@ -1,6 +1,8 @@
 import tornado.ioloop
 import logging
+import struct
 import time
+import unittest
 
 import test_shunt
 import asyncmongo
@@ -34,6 +36,266 @@ class QueryTest(test_shunt.MongoTest, test_shunt.SynchronousMongoTest):
         after = self.get_open_cursors()
         assert before == after, "%d cursors left open (should be 0)" % (after - before)
 
+    def test_find_all(self):
+        """
+        find returns every result, not only those in the first reply.
+        """
+        db = asyncmongo.Client(pool_id='test_find_all', host='127.0.0.1', port=int(self.mongod_options[0][1]), dbname='test')
+        loop = tornado.ioloop.IOLoop.instance()
+        results = {}
+
+        def query_callback(name, response, error):
+            loop.stop()
+            assert error is None
+            results[name] = response
+
+        db.foo.find({}, batch_size=30, callback=lambda r, error: query_callback('all', r, error))
+        loop.start()
+        assert sorted(doc['i'] for doc in results['all']) == range(200)
+
+        db.foo.find({}, batch_size=30, limit=75, callback=lambda r, error: query_callback('limit', r, error))
+        loop.start()
+        assert len(results['limit']) == 75
+
+    def test_exhaust(self):
+        """
+        An exhaust query gets all batches without getMores and gives its connection back after the last one.
+        """
+        db = asyncmongo.Client(pool_id='test_exhaust', host='127.0.0.1', port=int(self.mongod_options[0][1]), dbname='test',
+                               maxconnections=1, wait_queue_timeout=5)
+        loop = tornado.ioloop.IOLoop.instance()
+        results = {}
+
+        def query_callback(name, response, error):
+            assert error is None
+            results[name] = response
+            if len(results) == 2:
+                loop.stop()
+
+        db.foo.find({}, exhaust=True, batch_size=30, callback=lambda r, error: query_callback('exhaust', r, error))
+        # waits for the connection until the exhaust query is done
+        db.foo.find_one({'i': 5}, callback=lambda r, error: query_callback('one', r, error))
+        loop.start()
+        assert sorted(doc['i'] for doc in results['exhaust']) == range(200)
+        assert results['one']['i'] == 5
+        assert db._pool.stats()['idle'] == 1
+
+    def test_stream(self):
+        """
+        A stream hands out the results a batch at a time and kills its cursor when stopped early.
+        """
+        db = asyncmongo.Client(pool_id='test_stream', host='127.0.0.1', port=int(self.mongod_options[0][1]), dbname='test')
+        loop = tornado.ioloop.IOLoop.instance()
+        before = self.get_open_cursors()
+        batches = []
+
+        def batch_callback(batch, error):
+            assert error is None
+            if batch is None:
+                loop.stop()
+            else:
+                batches.append(len(batch))
+
+        stream = db.foo.stream({}, batch_size=50)
+        stream.each_batch(batch_callback)
+        loop.start()
+        assert batches == [50, 50, 50, 50], batches
+        assert not stream.alive
+
+        def stop_callback(batch, error):
+            assert error is None
+            batches.append(len(batch))
+            loop.add_timeout(time.time() + .1, loop.stop)
+            return False
+
+        batches = []
+        stream = db.foo.stream({}, sort=[('i', 1)], batch_size=20)
+        stream.each_batch(stop_callback)
+        loop.start()
+        assert batches == [20]
+        assert stream.closed
+        after = self.get_open_cursors()
+        assert before == after, "%d cursors left open (should be 0)" % (after - before)
+
+    def test_tail(self):
+        """
+        A tail hands out the documents inserted later, querying again after its cursor ended.
+        """
+        db = asyncmongo.Client(pool_id='test_tail', host='127.0.0.1', port=int(self.mongod_options[0][1]), dbname='test')
+        loop = tornado.ioloop.IOLoop.instance()
+        docs = []
+
+        def tail_callback(documents, error):
+            assert error is None
+            docs.extend(doc['i'] for doc in documents)
+            if len(docs) == 200:
+                self.pymongo_conn.test.foo.insert([{'i': i} for i in xrange(200, 203)])
+            elif len(docs) == 203:
+                loop.add_timeout(time.time() + .1, loop.stop)
+                return False
+
+        tail = db.foo.tail({}, callback=tail_callback, await_data=False, retry_delay=0.05, batch_size=80)
+        loop.start()
+        assert docs == range(203), docs
+        assert tail.closed
+        assert tail.last is not None
+
+class RecordingConnection(object):
+    def __init__(self, pool, address):
+        self.pool = pool
+        self.address = address
+        self._host, self._port = address or ('127.0.0.1', 27017)
+
+    def send_message(self, message, callback):
+        self.pool.sent.append((self.address, message, callback))
+
+
+class RecordingPool(object):
+    """a pool whose connections record the messages sent and never answer"""
+    _slave_okay = False
+    _read_preference = None
+    _routes_cursors = True
+
+    def __init__(self, io_loop):
+        self._backend = asyncmongo.backends.load_backend('tornado')
+        self._kwargs = dict(io_loop=io_loop)
+        self.sent = []
+
+    def connection(self, callback=None, address=None, **route):
+        return RecordingConnection(self, address)
+
+    def member_failed(self, address, error):
+        return False
+
+
+def killed(pool):
+    """(address, cursor ids) of the killCursors messages sent on `pool`"""
+    killed = []
+    for address, (request_id, data), callback in pool.sent:
+        if struct.unpack("<i", data[12:16])[0] == 2007:
+            count = struct.unpack("<i", data[20:24])[0]
+            killed.append((address, struct.unpack("<%dq" % count, data[24:])))
+    return killed
+
+
+class KillCursorsTest(unittest.TestCase):
+    def test_batched(self):
+        """
+        Cursors killed in one loop iteration go out in one message per server.
+        """
+        loop = tornado.ioloop.IOLoop()
+        pool = RecordingPool(loop)
+        cursor = asyncmongo.cursor.Cursor('test', 'foo', pool)
+        cursor._kill_cursor(1, ('a', 27017))
+        cursor._kill_cursor(2, ('b', 27017))
+        asyncmongo.cursor.Cursor('test', 'bar', pool)._kill_cursor(3, ('a', 27017))
+        self.assertEqual([], pool.sent)
+
+        loop.add_callback(loop.stop)
+        loop.start()
+        self.assertEqual([(('a', 27017), (1, 3)), (('b', 27017), (2,))], sorted(killed(pool)))
+
+        cursor._kill_cursor(4, ('a', 27017))
+        loop.add_callback(loop.stop)
+        loop.start()
+        self.assertEqual((('a', 27017), (4,)), killed(pool)[-1])
+
+
+class SingleBatchTest(unittest.TestCase):
+    def test_negative_limit(self):
+        """
+        A negative limit gets a single batch of that many documents, with no getMore.
+        """
+        loop = tornado.ioloop.IOLoop()
+        pool = RecordingPool(loop)
+        results = []
+        cursor = asyncmongo.cursor.Cursor('test', 'foo', pool)
+        cursor.find({}, limit=-5, callback=lambda response, error: results.append((response, error)))
+        pool.sent[0][2]({'data': [{'i': i} for i in range(5)], 'cursor_id': 0})
+        self.assertEqual([([{'i': i} for i in range(5)], None)], results)
+        self.assertEqual(1, len(pool.sent))
+
+        stream = cursor.stream({}, limit=-3, batch_size=3)
+        batches = []
+        stream.each_batch(lambda batch, error: batches.append(batch))
+        pool.sent[1][2]({'data': [{'i': i} for i in range(3)], 'cursor_id': 0})
+        self.assertEqual([[{'i': i} for i in range(3)], None], batches)
+        self.assertEqual(2, len(pool.sent))
+
+
+class LegacyReplicaSetTest(unittest.TestCase):
+    def test_first_reply(self):
+        """
+        Without a pool that sends getMores to the member of a cursor, finds get the first reply only.
+        """
+        loop = tornado.ioloop.IOLoop()
+        pool = RecordingPool(loop)
+        pool._routes_cursors = False
+        results = []
+        cursor = asyncmongo.cursor.Cursor('test', 'foo', pool)
+        cursor.find({}, callback=lambda response, error: results.append((response, error)))
+        pool.sent[0][2]({'data': [{'i': i} for i in range(101)], 'cursor_id': 12345})
+        self.assertEqual([([{'i': i} for i in range(101)], None)], results)
+        self.assertEqual(1, len(pool.sent))
+        self.assertRaises(asyncmongo.ProgrammingError, cursor.stream, {})
+        self.assertRaises(asyncmongo.ProgrammingError, cursor.find, {}, exhaust=True, callback=results.append)
+
+        # the cursor is killed instead of followed
+        loop.add_callback(loop.stop)
+        loop.start()
+        self.assertEqual([(('127.0.0.1', 27017), (12345,))], killed(pool))
+
+
+class CoalesceTest(unittest.TestCase):
+    def test_coalesce(self):
+        """
+        Identical queries in flight share one request and its reply.
+        """
+        pool = RecordingPool(tornado.ioloop.IOLoop())
+        results = []
+        def callback(response, error):
+            results.append((response, error))
+
+        cursor = asyncmongo.cursor.Cursor('test', 'foo', pool)
+        for i in range(3):
+            cursor.find_one({'_id': 1}, coalesce=True, callback=callback)
+        asyncmongo.cursor.Cursor('test', 'foo', pool).find_one({'_id': 1}, coalesce=True, callback=callback)
+        # a different query, and one that doesn't coalesce
+        cursor.find_one({'_id': 2}, coalesce=True, callback=callback)
+        cursor.find_one({'_id': 1}, callback=callback)
+        self.assertEqual(3, len(pool.sent))
+
+        pool.sent[0][2]({'data': [{'_id': 1}], 'cursor_id': 0})
+        self.assertEqual([({'_id': 1}, None)] * 4, results)
+
+        # the first batch is the same size, but not the limit
+        cursor.find({}, limit=2, batch_size=2, coalesce=True, callback=callback)
+        cursor.find({}, limit=100, batch_size=2, coalesce=True, callback=callback)
+        self.assertEqual(5, len(pool.sent))
+        pool.sent[3][2]({'data': [{'_id': 1}, {'_id': 2}], 'cursor_id': 0})
+        pool.sent[4][2]({'data': [{'_id': 1}, {'_id': 2}], 'cursor_id': 0})
+
+        # the next one goes over the wire again
+        cursor.find_one({'_id': 1}, coalesce=True, callback=callback)
+        self.assertEqual(6, len(pool.sent))
+        pool.sent[5][2](None, asyncmongo.InterfaceError('connection closed'))
+        self.assert_(isinstance(results[-1][1], asyncmongo.InterfaceError))
+
+    def test_partitioned(self):
+        """
+        Queries are only coalesced with the ones of the same partition.
+        """
+        pool = RecordingPool(tornado.ioloop.IOLoop())
+        partitions = [RecordingPool(tornado.ioloop.IOLoop()), RecordingPool(tornado.ioloop.IOLoop())]
+        pool.partition = lambda: partitions[0]
+        cursor = asyncmongo.cursor.Cursor('test', 'foo', pool)
+        cursor.find_one({'_id': 1}, coalesce=True, callback=lambda response, error: None)
+        partitions.reverse()
+        cursor.find_one({'_id': 1}, coalesce=True, callback=lambda response, error: None)
+        self.assertEqual(2, len(pool.sent))
+        self.assertEqual(1, len(asyncmongo.cursor._coalesced[partitions[0]]))
+        self.assertEqual(1, len(asyncmongo.cursor._coalesced[partitions[1]]))
+
+
 if __name__ == '__main__':
-    import unittest
     unittest.main()
@@ -0,0 +1,66 @@
+import socket
+import unittest
+
+import tornado.ioloop
+
+import asyncmongo
+from asyncmongo.backends.tornado_backend import AsyncBackend
+from asyncmongo.resolver import Resolver
+
+
+class ResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.resolver = Resolver(AsyncBackend(), ttl=60)
+
+    def resolve(self, host, port, wait=True):
+        results = []
+        def callback(address, error):
+            results.append((address, error))
+            self.io_loop.stop()
+        self.resolver.resolve(host, port, callback, io_loop=self.io_loop)
+        if wait and not results:
+            self.io_loop.start()
+        return results
+
+    def test_numeric_host(self):
+        # ip addresses are answered right away, without going through a thread
+        results = self.resolve('127.0.0.1', 27018, wait=False)
+        self.assertEqual([((socket.AF_INET, ('127.0.0.1', 27018)), None)], results)
+
+    def test_cache(self):
+        results = self.resolve('localhost', 27018)
+        address, error = results[0]
+        assert error is None
+        assert address[1][1] == 27018
+
+        # the second lookup is served from the cache
+        self.assertEqual(results, self.resolve('localhost', 27018, wait=False))
+
+        self.resolver.invalidate('localhost', 27018)
+        self.assertEqual([], self.resolve('localhost', 27018, wait=False))
+        self.io_loop.start()
+
+    def test_ipv4(self):
+        # localhost resolves to 127.0.0.1 even where ::1 comes first
+        results = self.resolve('localhost', 27018)
+        self.assertEqual(((socket.AF_INET, ('127.0.0.1', 27018)), None), results[0])
+
+    def test_invalidate_on_connect_failure(self):
+        """
+        A host that can't be connected to is looked up again on the next connect.
+        """
+        db = asyncmongo.Client(pool_id='testresolverfailure', host='localhost', port=27099, dbname='test',
+                               io_loop=self.io_loop)
+        errors = []
+        def callback(response, error):
+            errors.append(error)
+            self.io_loop.stop()
+
+        db.test.find_one({}, callback=callback)
+        self.io_loop.start()
+        assert isinstance(errors[0], asyncmongo.InterfaceError)
+        assert ('localhost', 27099) not in AsyncBackend.resolver._cache
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import unittest
+import tornado.ioloop
+
+import test_shunt
+import asyncmongo
+from asyncmongo.sharding import HashRing, ShardedCursor
+
+
+class HashRingTest(unittest.TestCase):
+    def test_spread(self):
+        ring = HashRing(['a', 'b', 'c'])
+        counts = {}
+        for i in range(3000):
+            node = ring.node(str(i))
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(['a', 'b', 'c'], sorted(counts))
+        for count in counts.values():
+            self.assert_(700 < count < 1300, counts)
+
+    def test_add_node(self):
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+        moved = [i for i in range(3000) if before.node(str(i)) != after.node(str(i))]
+        # only the keys that go to the new node move
+        self.assertEqual(['d'], sorted(set(after.node(str(i)) for i in moved)))
+        self.assert_(len(moved) < 1200, len(moved))
+
+
+class StubCursor(object):
+    """a shard's collection that answers right away"""
+    def __init__(self, found, write_reply):
+        self.found = found
+        self.finds = []
+        self.inserted = []
+        self.write_reply = write_reply
+        self.updates = []
+
+    def find(self, spec, callback=None, **kwargs):
+        self.finds.append(kwargs)
+        callback(self.found, error=None)
+
+    def update(self, spec, document, callback=None, **kwargs):
+        self.updates.append(kwargs)
+        callback([dict(self.write_reply)], error=None)
+
+    def insert(self, docs, callback=None, **kwargs):
+        self.inserted.extend(docs)
+        callback([dict(self.write_reply)], error=None)
+
+    def remove(self, spec, callback=None, **kwargs):
+        callback([dict(self.write_reply)], error=None)
+
+
+class ScatterTest(unittest.TestCase):
+    def setUp(self):
+        self.cursors = {'a': StubCursor([], {'n': 0, 'updatedExisting': False, 'err': None}),
+                        'b': StubCursor({'_id': 1}, {'n': 2, 'updatedExisting': True, 'err': None})}
+        self.collection = ShardedCursor(self.cursors, HashRing(['a', 'b']), 'user')
+        self.results = []
+
+    def callback(self, response, error):
+        self.results.append((response, error))
+
+    def test_find_one_empty_shard(self):
+        self.collection.find_one({'n': 1}, callback=self.callback)
+        self.collection.find_one({'n': 1}, sort=[('_id', 1)], callback=self.callback)
+        self.assertEqual([({'_id': 1}, None)] * 2, self.results)
+
+    def test_negative_limit(self):
+        self.cursors['a'].found = [{'_id': 1}, {'_id': 3}]
+        self.cursors['b'].found = [{'_id': 2}, {'_id': 4}]
+        self.collection.find({}, limit=-5, sort=[('_id', 1)], callback=self.callback)
+        self.collection.find({}, skip=1, limit=-2, sort=[('_id', 1)], callback=self.callback)
+        self.assertEqual([([{'_id': 1}, {'_id': 2}, {'_id': 3}, {'_id': 4}], None),
+                          ([{'_id': 2}, {'_id': 3}], None)], self.results)
+        self.assertEqual([-5, -3], [find['limit'] for find in self.cursors['a'].finds])
+
+    def test_insert_without_id(self):
+        collection = ShardedCursor(self.cursors, HashRing(['a', 'b']), '_id')
+        docs = [{'n': i} for i in range(20)]
+        collection.insert(docs, callback=self.callback)
+        self.assertEqual(1, len(self.results))
+        self.assertEqual(20, len(self.cursors['a'].inserted) + len(self.cursors['b'].inserted))
+        self.assert_(self.cursors['a'].inserted and self.cursors['b'].inserted)
+        self.assertEqual(20, len(set(doc['_id'] for doc in docs)))
+
+    def test_update(self):
+        self.assertRaises(asyncmongo.DataError, self.collection.update, {'n': 1}, {'$set': {'n': 2}},
+                          callback=self.callback)
+        self.collection.update({'n': 1}, {'$set': {'n': 2}}, multi=True, callback=self.callback)
+        self.assertEqual([([{'n': 2, 'updatedExisting': True, 'err': None}], None)], self.results)
+        self.assertEqual([{'multi': True}], self.cursors['a'].updates)
+
+    def test_remove(self):
+        self.collection.remove({'n': 1}, callback=self.callback)
+        self.assertEqual(2, self.results[0][0][0]['n'])
+
+
+class ShardingTest(test_shunt.MongoTest):
+    def test_scatter_gather(self):
+        """
+        Documents are spread over the shards by their shard key, finds without one
+        are merged across shards.
+        """
+        test_shunt.setup()
+        db = asyncmongo.ShardedClient('testsharding', {'a': dict(dbname='shard_a'), 'b': dict(dbname='shard_b')},
+                                      shard_key='user', host='127.0.0.1', port=27018)
+        loop = tornado.ioloop.IOLoop.instance()
+
+        def insert_callback(response, error):
+            loop.stop()
+            assert error is None
+            test_shunt.register_called('inserted')
+
+        db.test_sharding.insert([{'_id': i, 'user': 'user%d' % i, 'n': i % 7} for i in range(20)],
+                                callback=insert_callback)
+        loop.start()
+        test_shunt.assert_called('inserted')
+        assert set([db.shard('user%d' % i) for i in range(20)]) == set(['a', 'b'])
+
+        results = {}
+        def query_callback(name, response, error):
+            loop.stop()
+            assert error is None
+            results[name] = response
+
+        db.test_sharding.find_one({'user': 'user3'}, callback=lambda r, error: query_callback('one', r, error))
+        loop.start()
+        assert results['one']['_id'] == 3
+
+        db.test_sharding.find({}, sort=[('n', -1), ('_id', 1)], skip=2, limit=5,
+                              callback=lambda r, error: query_callback('page', r, error))
+        loop.start()
+        expected = sorted(range(20), key=lambda i: (-(i % 7), i))[2:7]
+        assert [doc['_id'] for doc in results['page']] == expected, results['page']
+
+        db.test_sharding.find_one({'n': 6}, callback=lambda r, error: query_callback('scatter', r, error))
+        loop.start()
+        assert results['scatter']['_id'] in (6, 13)
+
+        self.assertRaises(asyncmongo.DataError, db.test_sharding.insert, {'_id': 100}, callback=insert_callback)
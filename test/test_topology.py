@@ -0,0 +1,407 @@
+import os
+import json
+import unittest
+import time
+import datetime
+import tempfile
+
+import tornado.ioloop
+
+import test_shunt
+import asyncmongo
+from asyncmongo import topology
+
+
+class Monitor(topology.TopologyMonitor):
+    """a monitor that records heartbeats instead of sending them"""
+    def _heartbeat(self, address):
+        self.sent.append(address)
+
+
+class TopologyTest(unittest.TestCase):
+    def setUp(self):
+        self.monitor = Monitor([('a', 27017)], 'rs0', heartbeat_interval=10, io_loop=tornado.ioloop.IOLoop())
+        self.monitor.sent = []
+
+    def ismaster(self, address, rtt=0.01, **res):
+        res.setdefault('setName', 'rs0')
+        self.monitor._pending.add(address)
+        self.monitor._on_ismaster(address, time.time() - rtt, {'data': [res]})
+
+    def test_discovery(self):
+        self.ismaster(('a', 27017), ismaster=True, hosts=['a:27017', 'b:27017'], passives=['c:27017'])
+        # the new members get a heartbeat of their own
+        self.assertEqual([('b', 27017), ('c', 27017)], sorted(self.monitor.sent))
+        self.ismaster(('b', 27017), secondary=True, tags={'dc': 'east'})
+        self.ismaster(('c', 27017), secondary=True, hidden=True)
+
+        self.assertEqual(('a', 27017), self.monitor.primary().address)
+        # hidden members don't take reads
+        self.assertEqual([('b', 27017)], [m.address for m in self.monitor.secondaries()])
+        self.assertEqual({'dc': 'east'}, self.monitor.members[('b', 27017)].tags)
+        self.assertEqual(1, self.monitor.rounds)
+
+    def test_read_preferences(self):
+        self.ismaster(('a', 27017), rtt=0.001, ismaster=True, hosts=['a:27017', 'b:27017', 'c:27017', 'd:27017'])
+        self.ismaster(('b', 27017), rtt=0.002, secondary=True, tags={'dc': 'east'})
+        self.ismaster(('c', 27017), rtt=0.005, secondary=True, tags={'dc': 'west'})
+        self.ismaster(('d', 27017), rtt=0.100, secondary=True, tags={'dc': 'east'})
+
+        def select(*args, **kwargs):
+            return set(self.monitor.select(*args, **kwargs).host for i in range(50))
+
+        self.assertEqual(set('a'), select(topology.PRIMARY))
+        self.assertEqual(set('a'), select(topology.PRIMARY_PREFERRED))
+        # d is outside of the latency window
+        self.assertEqual(set('bc'), select(topology.SECONDARY))
+        self.assertEqual(set('bcd'), select(topology.SECONDARY, local_threshold=1))
+        self.assertEqual(set('abc'), select(topology.NEAREST))
+        self.assertEqual(set('bd'), select(topology.SECONDARY, tag_sets=[{'dc': 'east'}], local_threshold=1))
+        # the first tag set that matches a member wins
+        self.assertEqual(set('c'), select(topology.SECONDARY_PREFERRED, tag_sets=[{'dc': 'north'}, {'dc': 'west'}]))
+        self.assertEqual(set('a'), select(topology.SECONDARY_PREFERRED, tag_sets=[{'dc': 'north'}]))
+        self.assertEqual(None, self.monitor.select(topology.SECONDARY, tag_sets=[{'dc': 'north'}]))
+
+        self.ismaster(('a', 27017), rtt=0.001, secondary=True)
+        self.assertEqual(None, self.monitor.select(topology.PRIMARY))
+        self.assertEqual(set('abc'), select(topology.PRIMARY_PREFERRED))
+
+    def test_max_staleness(self):
+        now = datetime.datetime.utcnow()
+        def last_write(seconds_ago):
+            return {'lastWriteDate': now - datetime.timedelta(seconds=seconds_ago)}
+        self.ismaster(('a', 27017), ismaster=True, hosts=['a:27017', 'b:27017', 'c:27017'], lastWrite=last_write(0))
+        self.ismaster(('b', 27017), secondary=True, lastWrite=last_write(2))
+        self.ismaster(('c', 27017), secondary=True, lastWrite=last_write(120))
+        self.assertAlmostEqual(120, self.monitor.members[('c', 27017)].lag, places=0)
+
+        def select():
+            return set(self.monitor.select(topology.SECONDARY, local_threshold=1, max_staleness=60).host
+                       for i in range(50))
+        self.assertEqual(set('b'), select())
+
+        # c caught up
+        self.monitor._pending.update(self.monitor.members)
+        self.ismaster(('a', 27017), ismaster=True, lastWrite=last_write(0))
+        self.ismaster(('b', 27017), secondary=True, lastWrite=last_write(0))
+        self.ismaster(('c', 27017), secondary=True, lastWrite=last_write(1))
+        self.assertEqual(set('bc'), select())
+
+    def test_lag_from_status(self):
+        self.ismaster(('a', 27017), ismaster=True, hosts=['a:27017', 'b:27017'])
+        self.ismaster(('b', 27017), secondary=True)
+        now = datetime.datetime.utcnow()
+        self.monitor._on_status({'data': [{'ok': 1, 'members': [
+            {'name': 'a:27017', 'optimeDate': now},
+            {'name': 'b:27017', 'optimeDate': now - datetime.timedelta(seconds=30)}]}]})
+        self.assertAlmostEqual(30, self.monitor.members[('b', 27017)].lag, places=0)
+        self.assertEqual(None, self.monitor.select(topology.SECONDARY, max_staleness=10))
+
+    def test_rtt(self):
+        self.ismaster(('a', 27017), rtt=0.01, ismaster=True)
+        self.ismaster(('a', 27017), rtt=0.11, ismaster=True)
+        self.assertAlmostEqual(0.03, self.monitor.members[('a', 27017)].rtt, places=2)
+
+    def test_step_down(self):
+        self.ismaster(('a', 27017), ismaster=True, hosts=['a:27017', 'b:27017'])
+        self.ismaster(('b', 27017), ismaster=True)
+        self.assertEqual(('b', 27017), self.monitor.primary().address)
+        self.assertEqual(topology.UNKNOWN, self.monitor.members[('a', 27017)].state)
+
+    def test_wrong_set_name(self):
+        self.ismaster(('a', 27017), ismaster=True, setName='rs1')
+        member = self.monitor.members[('a', 27017)]
+        self.assertEqual(topology.DOWN, member.state)
+        self.assert_(isinstance(member.error, asyncmongo.RSConnectionError))
+
+    def test_wait_for(self):
+        results = []
+        self.monitor.wait_for(lambda m: m.primary(), lambda member, error: results.append((member, error)))
+        self.assertEqual([('a', 27017)], self.monitor.sent)
+        self.assertEqual([], results)
+        self.ismaster(('a', 27017), secondary=True)
+        # the round is over and there is no primary
+        self.assertEqual(1, len(results))
+        self.assert_(isinstance(results[0][1], asyncmongo.RSConnectionError))
+
+    def test_member_failed(self):
+        self.ismaster(('a', 27017), ismaster=True, hosts=['a:27017', 'b:27017'])
+        self.ismaster(('b', 27017), secondary=True)
+        self.monitor.sent = []
+        self.monitor.member_failed(('a', 27017), asyncmongo.NotMasterError('master has changed'))
+        self.assertEqual(None, self.monitor.primary())
+        self.assertEqual([('a', 27017), ('b', 27017)], sorted(self.monitor.sent))
+        # the other requests that failed on it don't start another round
+        self.monitor.member_failed(('a', 27017), asyncmongo.NotMasterError('master has changed'))
+        self.assertEqual(2, len(self.monitor.sent))
+        self.assertEqual(False, self.monitor._rerun)
+
+        self.ismaster(('b', 27017), ismaster=True)
+        self.ismaster(('a', 27017), secondary=True)
+        self.assertEqual(('b', 27017), self.monitor.primary().address)
+
+        self.monitor.member_failed(('b', 27017), asyncmongo.InterfaceError('connection closed'))
+        self.assertEqual(topology.DOWN, self.monitor.members[('b', 27017)].state)
+
+    def test_exclude(self):
+        self.ismaster(('a', 27017), ismaster=True, hosts=['a:27017', 'b:27017', 'c:27017'])
+        self.ismaster(('b', 27017), secondary=True)
+        self.ismaster(('c', 27017), secondary=True)
+        self.assertEqual(('c', 27017), self.monitor.select(topology.SECONDARY, local_threshold=1,
+                                                           exclude=[('b', 27017)]).address)
+        self.assertEqual(None, self.monitor.select(topology.PRIMARY, exclude=[('a', 27017)]))
+
+    def test_cache_file(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.monitor._cache_file = path
+            self.ismaster(('a', 27017), ismaster=True, hosts=['a:27017', 'b:27017'])
+            self.ismaster(('b', 27017), secondary=True, tags={'dc': 'east'})
+            self.assertEqual('a:27017', json.load(open(path))['primary'])
+
+            # a new process knows where to go before its first heartbeat
+            monitor = Monitor([('b', 27017)], 'rs0', cache_file=path, io_loop=tornado.ioloop.IOLoop())
+            self.assertEqual(('a', 27017), monitor.primary().address)
+            self.assertEqual({'dc': 'east'}, monitor.secondaries()[0].tags)
+
+            # expired or of another replica set
+            monitor = Monitor([('b', 27017)], 'rs0', cache_file=path, cache_ttl=-1, io_loop=tornado.ioloop.IOLoop())
+            self.assertEqual(None, monitor.primary())
+            monitor = Monitor([('b', 27017)], 'rs1', cache_file=path, io_loop=tornado.ioloop.IOLoop())
+            self.assertEqual(None, monitor.primary())
+        finally:
+            os.remove(path)
+
+    def test_cache_file_missing(self):
+        monitor = Monitor([('a', 27017)], 'rs0', cache_file='/nonexistent/topology', io_loop=tornado.ioloop.IOLoop())
+        self.assertEqual([('a', 27017)], monitor.members.keys())
+
+    def test_pool_autoscale(self):
+        # every member has a pool of its own, one Autoscaler can't size them all
+        self.assertRaises(AssertionError, asyncmongo.pool.ReplicaSetConnectionPool, 'rs0', [('a', 27017)], 1,
+                          dbname='test', autoscale=asyncmongo.autoscale.Autoscaler(1, 5),
+                          io_loop=tornado.ioloop.IOLoop())
+
+
+class StubConnection(object):
+    """answers with the next reply of its pool"""
+    def __init__(self, pool, address):
+        self.pool = pool
+        self._host, self._port = address
+
+    def send_message(self, message, callback):
+        response, error = self.pool.replies.pop(0)
+        if callback:
+            callback(response, error)
+
+
+class FailoverPool(object):
+    """a replica set pool whose primary moves from a to b once a request to a failed"""
+    _dbname = 'test'
+    _slave_okay = False
+    _read_preference = None
+
+    def __init__(self, replies):
+        self.replies = replies
+        self.primary = ('a', 27017)
+        self.failed = []
+
+    def connection(self, callback=None, timeout=None, **route):
+        return StubConnection(self, self.primary)
+
+    def member_failed(self, address, error):
+        self.failed.append((address, error.__class__))
+        self.primary = ('b', 27017)
+        return True
+
+
+class FailoverTest(unittest.TestCase):
+    def run_find(self, pool, **kwargs):
+        results = []
+        cursor = asyncmongo.cursor.Cursor('test', 'failover', pool)
+        cursor.find_one({'_id': 1}, callback=lambda response, error: results.append((response, error)), **kwargs)
+        return results
+
+    def test_read_retried(self):
+        pool = FailoverPool([(None, asyncmongo.NotMasterError('master has changed')),
+                             ({'data': [{'_id': 1}], 'cursor_id': 0}, None)])
+        self.assertEqual([({'_id': 1}, None)], self.run_find(pool))
+        self.assertEqual([(('a', 27017), asyncmongo.NotMasterError)], pool.failed)
+
+    def test_retried_once(self):
+        pool = FailoverPool([(None, asyncmongo.InterfaceError('connection closed')),
+                             (None, asyncmongo.InterfaceError('connection closed'))])
+        results = self.run_find(pool)
+        self.assertEqual(1, len(results))
+        self.assert_(isinstance(results[0][1], asyncmongo.InterfaceError))
+        # both members were reported
+        self.assertEqual([('a', 27017), ('b', 27017)], [address for address, error in pool.failed])
+
+    def test_write_not_retried(self):
+        pool = FailoverPool([({'data': [{'err': 'not master', 'code': 10058, 'ok': 1}]},
+                              asyncmongo.IntegrityError('not master', code=10058))])
+        results = []
+        cursor = asyncmongo.cursor.Cursor('test', 'failover', pool)
+        cursor.insert({'_id': 1}, callback=lambda response, error: results.append((response, error)))
+        self.assertEqual(1, len(results))
+        self.assert_(isinstance(results[0][1], asyncmongo.IntegrityError))
+        self.assertEqual([(('a', 27017), asyncmongo.NotMasterError)], pool.failed)
+
+    def test_command_not_master(self):
+        pool = FailoverPool([({'data': [{'ok': 0, 'errmsg': 'not master'}]}, None),
+                             ({'data': [{'ok': 1, 'n': 3}], 'cursor_id': 0}, None)])
+        cursor = asyncmongo.cursor.Cursor('test', '$cmd', pool)
+        results = []
+        cursor.find_one({'count': 'failover'}, _must_use_master=True, _is_command=True,
+                        callback=lambda response, error: results.append((response, error)))
+        self.assertEqual([({'ok': 1, 'n': 3}, None)], results)
+
+
+class MonitoredPoolTest(test_shunt.MongoTest):
+    def test_query(self):
+        """
+        A pool with a topology monitor sends its requests to the member the heartbeats found.
+        """
+        test_shunt.setup()
+        db = asyncmongo.Client(pool_id='testtopology', rs='rs0', seed=[('127.0.0.1', 27018)],
+                               heartbeat_interval=1, dbname='test', maxconnections=2)
+
+        def insert_callback(response, error):
+            tornado.ioloop.IOLoop.instance().stop()
+            assert error is None
+            test_shunt.register_called('inserted')
+
+        db.test_topology.insert({'_id': 1}, callback=insert_callback)
+        tornado.ioloop.IOLoop.instance().start()
+        test_shunt.assert_called('inserted')
+
+        def query_callback(response, error):
+            tornado.ioloop.IOLoop.instance().stop()
+            assert error is None
+            assert response['_id'] == 1
+            test_shunt.register_called('retrieved')
+
+        db.test_topology.find_one({'_id': 1}, callback=query_callback)
+        tornado.ioloop.IOLoop.instance().start()
+        test_shunt.assert_called('retrieved')
+
+        # without a secondary the query falls back to the primary
+        test_shunt.setup()
+        db.test_topology.find_one({'_id': 1}, read_preference=asyncmongo.SECONDARY_PREFERRED, callback=query_callback)
+        tornado.ioloop.IOLoop.instance().start()
+        test_shunt.assert_called('retrieved')
+
+        stats = db._pool.stats()
+        assert stats['members'][0]['state'] == 'primary'
+        assert stats['members'][0]['rtt'] is not None
+        assert stats['pools']['127.0.0.1:27018']['idle'] == 1
+
+    def test_standby(self):
+        """
+        Standby connections to the members are opened as the heartbeats find them.
+        """
+        test_shunt.setup()
+        db = asyncmongo.Client(pool_id='teststandby', rs='rs0', seed=[('127.0.0.1', 27018)],
+                               heartbeat_interval=1, dbname='test', maxconnections=4, standby=2)
+        pool = db._pool
+        pool._topology.start()
+        loop = tornado.ioloop.IOLoop.instance()
+        loop.add_timeout(time.time() + 0.5, loop.stop)
+        loop.start()
+
+        assert pool.stats()['pools']['127.0.0.1:27018']['idle'] == 2
+
+        def query_callback(response, error):
+            loop.stop()
+            assert error is None
+            test_shunt.register_called('retrieved')
+
+        db.test_standby.find_one({'_id': 1}, callback=query_callback)
+        loop.start()
+        test_shunt.assert_called('retrieved')
+        # the query took a standby connection instead of opening a new one
+        assert pool.stats()['pools']['127.0.0.1:27018']['idle'] == 2
+
+
+class HedgeConnection(object):
+    """keeps the callbacks so the test decides which member answers first"""
+    def __init__(self, pool, address):
+        self.pool = pool
+        self._host, self._port = address
+
+    def send_message(self, message, callback):
+        self.pool.sent.append(((self._host, self._port), message, callback))
+
+    def release(self):
+        pass
+
+
+class HedgePool(object):
+    """two secondaries, a and b, and a backend that runs timeouts and callbacks when the test says so"""
+    _dbname = 'test'
+    _slave_okay = False
+    _read_preference = asyncmongo.SECONDARY
+    _routes_cursors = True
+    _kwargs = {}
+
+    def __init__(self):
+        self.sent = []
+        self.timeouts = []
+        self.callbacks = []
+        self._backend = self
+
+    def connection(self, callback=None, timeout=None, read_preference=None, tag_sets=None,
+                   address=None, exclude=()):
+        if address is None:
+            address = [a for a in [('a', 27017), ('b', 27017)] if a not in exclude][0]
+        return HedgeConnection(self, address)
+
+    def member_failed(self, address, error):
+        return True
+
+    def add_timeout(self, delay, callback, **kwargs):
+        self.timeouts.append(callback)
+        return callback
+
+    def remove_timeout(self, timeout, **kwargs):
+        self.timeouts.remove(timeout)
+
+    def add_callback(self, callback, **kwargs):
+        self.callbacks.append(callback)
+
+
+class HedgeTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = HedgePool()
+        self.results = []
+        cursor = asyncmongo.cursor.Cursor('test', 'hedge', self.pool)
+        cursor.find({}, hedge_delay=0.01, callback=lambda response, error: self.results.append((response, error)))
+
+    def test_first_answers(self):
+        self.assertEqual([('a', 27017)], [address for address, msg, callback in self.pool.sent])
+        self.pool.sent[0][2]({'data': [{'_id': 1}], 'cursor_id': 0})
+        self.assertEqual([([{'_id': 1}], None)], self.results)
+        # no hedge once answered
+        self.assertEqual([], self.pool.timeouts)
+
+    def test_hedge_wins(self):
+        self.pool.timeouts.pop()()
+        self.assertEqual([('a', 27017), ('b', 27017)], [address for address, msg, callback in self.pool.sent])
+        self.pool.sent[1][2]({'data': [{'_id': 2}], 'cursor_id': 0})
+        self.assertEqual([([{'_id': 2}], None)], self.results)
+
+        # the slow member's cursor is killed where it lives
+        self.pool.sent[0][2]({'data': [{'_id': 1}], 'cursor_id': 12345})
+        self.assertEqual(1, len(self.results))
+        self.pool.callbacks.pop()()
+        self.assertEqual(('a', 27017), self.pool.sent[2][0])
+        self.assertEqual(None, self.pool.sent[2][2])
+
+    def test_hedge_error(self):
+        self.pool.timeouts.pop()()
+        self.pool.sent[1][2](None, asyncmongo.InterfaceError('connection closed'))
+        self.assertEqual([], self.results)
+        self.pool.sent[0][2]({'data': [{'_id': 1}], 'cursor_id': 0})
+        self.assertEqual([([{'_id': 1}], None)], self.results)
+
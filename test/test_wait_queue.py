@@ -0,0 +1,99 @@
+import tornado.ioloop
+import logging
+import time
+
+import test_shunt
+import asyncmongo
+from asyncmongo.errors import TooManyConnections
+
+TEST_TIMESTAMP = int(time.time())
+
+class WaitQueueTest(test_shunt.MongoTest):
+    def test_wait_queue(self):
+        """
+        Requests past maxconnections wait for a connection in FIFO order
+        instead of raising TooManyConnections.
+        """
+        test_shunt.setup()
+        db = asyncmongo.Client(pool_id='testwaitqueue', host='127.0.0.1', port=27018, dbname='test',
+                               maxconnections=2, wait_queue_timeout=None)
+
+        def insert_callback(response, error):
+            tornado.ioloop.IOLoop.instance().stop()
+            assert len(response) == 1
+            test_shunt.register_called('inserted')
+
+        db.test_wait_queue.insert([{"_id": i, "ts": TEST_TIMESTAMP} for i in range(10)], callback=insert_callback)
+        tornado.ioloop.IOLoop.instance().start()
+        test_shunt.assert_called('inserted')
+
+        order = []
+        def query_callback(i, response, error):
+            assert error is None
+            assert response['_id'] == i
+            order.append(i)
+            if len(order) == 10:
+                tornado.ioloop.IOLoop.instance().stop()
+
+        for i in range(10):
+            db.test_wait_queue.find_one({"_id": i},
+                callback=lambda response, error, i=i: query_callback(i, response, error))
+        assert db._pool._connections == 2
+        assert db._pool.stats()['waiting'] == 8
+
+        tornado.ioloop.IOLoop.instance().start()
+        assert sorted(order) == range(10)
+        stats = asyncmongo.pool.ConnectionPools.stats('testwaitqueue')
+        assert stats['connections'] == 0
+        assert stats['waiting'] == 0
+        assert stats['waits'] == 8
+        assert stats['max_waiting'] == 8
+        assert stats['wait_timeouts'] == 0
+
+    def test_wait_queue_timeout(self):
+        db = asyncmongo.Client(pool_id='testwaitqueue_timeout', host='127.0.0.1', port=27018, dbname='test',
+                               maxconnections=1, wait_queue_timeout=0.01)
+        pool = db._pool
+        con = pool.connection()
+
+        def callback(response, error):
+            tornado.ioloop.IOLoop.instance().stop()
+            assert response is None
+            assert isinstance(error, TooManyConnections)
+            test_shunt.register_called('timed_out')
+
+        db.test_wait_queue.find_one({"_id": 1}, callback=callback)
+        tornado.ioloop.IOLoop.instance().start()
+        test_shunt.assert_called('timed_out')
+        assert pool.stats()['wait_timeouts'] == 1
+        assert pool.stats()['waiting'] == 0
+        pool.cache(con)
+
+        # without a callback there is nothing to wait with
+        con = pool.connection()
+        self.assertRaises(TooManyConnections, pool.connection)
+        pool.cache(con)
+
+    def test_wait_queue_fifo(self):
+        db = asyncmongo.Client(pool_id='testwaitqueue_fifo', host='127.0.0.1', port=27018, dbname='test',
+                               maxconnections=1, wait_queue_timeout=None)
+        pool = db._pool
+        con = pool.connection()
+
+        served = []
+        def callback(i, connection, error):
+            assert error is None
+            assert connection is con
+            served.append(i)
+            if len(served) == 3:
+                tornado.ioloop.IOLoop.instance().stop()
+            else:
+                pool.cache(connection)
+
+        for i in range(3):
+            assert pool.connection(callback=lambda connection, error, i=i: callback(i, connection, error)) is None
+        pool.cache(con)
+        tornado.ioloop.IOLoop.instance().start()
+        assert served == [0, 1, 2]
+        pool.cache(con)
+        assert pool.stats()['idle'] == 1